@@ -36,7 +36,14 @@ from opentelemetry.sdk.trace.export import BatchSpanProcessor
 
 from config import get_settings, ConfigSettings
 from users.api_registry import api_registry
+from module_keycloak.ops_admin import admin_tokens
+from module_keycloak.ops_user import openid_clients
+from services.write_behind.last_login import last_login_queue
+from services.write_behind.last_login import write_spool
+from users.ops_user import user_directory
+from users.permissions.permissions import policy_store
 from resources.error_handler import APIException
+from resources.http_clients import http_clients
 
 
 def create_app():
@@ -64,6 +71,27 @@ def create_app():
             content=exc.content,
         )
 
+    @app.on_event('startup')
+    async def startup():
+        await http_clients.start()
+        await policy_store.start()
+        await openid_clients.start(
+            [(ConfigSettings.KEYCLOAK_CLIENT_ID, ConfigSettings.KEYCLOAK_REALM, ConfigSettings.KEYCLOAK_SECRET)]
+        )
+        await admin_tokens.start()
+        await last_login_queue.start()
+        await write_spool.start()
+        await user_directory.start()
+
+    @app.on_event('shutdown')
+    async def shutdown():
+        await policy_store.stop()
+        await openid_clients.stop()
+        await admin_tokens.stop()
+        await last_login_queue.stop()
+        await write_spool.stop()
+        await user_directory.stop()
+        await http_clients.stop()
 
     api_registry(app)
 
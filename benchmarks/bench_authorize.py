@@ -0,0 +1,99 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Compare /v1/authorize decision throughput with a per-request enforcer and with the shared policy store.
+
+The shared store is measured with and without its decision cache.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_authorize --rules 500 --seconds 5
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import casbin
+import casbin_sqlalchemy_adapter
+
+from benchmarks.synthetic_policy import create_policy_db
+from benchmarks.synthetic_policy import generate_policy
+from benchmarks.synthetic_policy import sample_requests
+from users.permissions.policy_store import PolicyStore
+
+MODEL_PATH = 'users/permissions/model.conf'
+
+
+def run_for(seconds, requests, decide, warmup=False):
+    if warmup:
+        for request in requests:
+            decide(*request)
+
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        role, zone, resource, operation = requests[count % len(requests)]
+        decide(role, zone, resource, operation)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=500)
+    parser.add_argument('--groupings', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    # casbin logs every decision, keep the numbers about the decision path itself
+    logging.disable(logging.CRITICAL)
+
+    policies, groupings = generate_policy(args.rules, args.groupings)
+    requests = sample_requests(policies, 1000)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_policy_db(f'sqlite:///{os.path.join(tmp, "casbin.db")}', policies, groupings)
+
+        def per_request(role, zone, resource, operation):
+            adapter = casbin_sqlalchemy_adapter.Adapter(engine)
+            enforcer = casbin.Enforcer(MODEL_PATH, adapter)
+            return enforcer.enforce(role, zone, resource, operation)
+
+        uncached = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0, cache_size=0)
+        cached = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0)
+
+        before = run_for(args.seconds, requests, per_request)
+        shared = run_for(args.seconds, requests, uncached.load().enforce, warmup=True)
+        shared_cached = run_for(args.seconds, requests, cached.load().enforce, warmup=True)
+
+    sys.stdout.write(f'rules: {args.rules} p / {args.groupings} g\n')
+    sys.stdout.write(f'per-request enforcer:         {before:12.1f} req/s\n')
+    sys.stdout.write(f'shared policy store:          {shared:12.1f} req/s ({shared / before:.1f}x)\n')
+    sys.stdout.write(f'shared store, decision cache: {shared_cached:12.1f} req/s ({shared_cached / before:.1f}x)\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Latency of the login path against a local Keycloak stand-in, before and after sharing the OpenID client.
+
+``per-request client`` replays what ``UserAuth.post`` used to do on every login: build a KeycloakOpenID client,
+fetch the discovery document, get the token and ask userinfo for the username. ``shared client`` gets the token
+from the worker's shared client and reads the username from the token, verified against the cached realm keys.
+Every stand-in request sleeps ``--upstream-latency-ms`` to play the network and Keycloak::
+
+    python -m benchmarks.bench_login --logins 300 --upstream-latency-ms 5
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from keycloak import KeycloakOpenID
+
+from benchmarks.keycloak_standin import KeycloakStandIn
+from module_keycloak.openid_clients import OpenIDClients
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def measure(standin, login, logins):
+    standin.requests.clear()
+    samples = []
+    for index in range(logins):
+        start = time.perf_counter()
+        username = login(f'user{index}')
+        samples.append(time.perf_counter() - start)
+        assert username == f'user{index}', username
+    upstream = sum(standin.requests.values())
+    return samples, upstream / logins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=300)
+    parser.add_argument('--upstream-latency-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    with KeycloakStandIn(latency=args.upstream_latency_ms / 1000) as standin:
+
+        def per_request_client(username):
+            keycloak_openid = KeycloakOpenID(
+                server_url=standin.server_url, client_id='client', realm_name=standin.realm, client_secret_key='secret'
+            )
+            keycloak_openid.well_know()
+            token = keycloak_openid.token(username, 'password')
+            return keycloak_openid.userinfo(token['access_token'])['preferred_username']
+
+        clients = OpenIDClients(standin.server_url)
+
+        def shared_client(username):
+            client = clients.get('client', standin.realm, 'secret')
+            token = client.keycloak_openid.token(username, 'password')
+            return client.token_verifier.verify(token['access_token'])['preferred_username']
+
+        # the shared client fetches the discovery document and the keys once per worker
+        shared_client('warmup')
+        results = [
+            ('per-request client', measure(standin, per_request_client, args.logins)),
+            ('shared client', measure(standin, shared_client, args.logins)),
+        ]
+
+    sys.stdout.write(f'logins: {args.logins}, upstream latency: {args.upstream_latency_ms} ms per request\n')
+    for name, (samples, upstream) in results:
+        sys.stdout.write(f'{name:20s} p50 {percentile(samples, 0.5) * 1000:7.2f} ms  '
+                         f'p99 {percentile(samples, 0.99) * 1000:7.2f} ms  '
+                         f'{upstream:.1f} Keycloak requests per login\n')
+
+
+if __name__ == '__main__':
+    main()
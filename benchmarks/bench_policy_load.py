@@ -0,0 +1,142 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Compare policy load time and resident memory of a full load, a zone filtered load and a shared snapshot.
+
+Every load runs in a fresh interpreter so the memory numbers are not polluted by the previous run. The shared
+snapshot is published by a loader in this process, the measured worker only maps it, the way the workers of a pod
+do when ``CASBIN_SNAPSHOT_DIR`` is set.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_policy_load --rules 100000 --zones 10 --serve zone0
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from benchmarks.synthetic_policy import create_policy_db
+from benchmarks.synthetic_policy import generate_policy
+from users.permissions.policy_store import PolicyStore
+
+MODEL_PATH = 'users/permissions/model.conf'
+
+
+def resident_memory() -> int:
+    """Current resident set size in bytes, falling back to the peak where /proc is not available."""
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_once(db_uri, zones, snapshot_dir):
+    """Load the policy in this process and print the measurements as json."""
+
+    logging.disable(logging.CRITICAL)
+    engine = create_engine(db_uri)
+    store = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0, zones=zones or None, snapshot_dir=snapshot_dir)
+
+    before = resident_memory()
+    start = time.perf_counter()
+    store.refresh()
+    elapsed = time.perf_counter() - start
+    stats = store.stats()
+    sys.stdout.write(json.dumps({
+        'seconds': elapsed,
+        'rss': resident_memory() - before,
+        'rules': stats['rules'],
+        'groupings': stats['groupings'],
+    }) + '\n')
+
+
+def measure(db_uri, zones, repeat, snapshot_dir=None):
+    runs = []
+    for _ in range(repeat):
+        command = [sys.executable, '-m', 'benchmarks.bench_policy_load', '--child', '--db-uri', db_uri]
+        command += ['--serve', ','.join(zones)]
+        if snapshot_dir:
+            command += ['--snapshot-dir', snapshot_dir]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return min(runs, key=lambda run: run['seconds'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=100000)
+    parser.add_argument('--groupings', type=int, default=5000)
+    parser.add_argument('--zones', type=int, default=10, help='number of zones in the synthetic policy')
+    parser.add_argument('--serve', default='zone0', help='comma separated zones loaded by the filtered store')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--db-uri', help='measure an existing casbin_rule table instead of a synthetic one')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--snapshot-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    serve = [zone for zone in args.serve.split(',') if zone]
+    if args.child:
+        load_once(args.db_uri, serve, args.snapshot_dir)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_uri = args.db_uri
+        if db_uri is None:
+            zones = [f'zone{index}' for index in range(args.zones)] + ['*']
+            policies, groupings = generate_policy(args.rules, args.groupings, zones=zones)
+            db_uri = f'sqlite:///{os.path.join(tmp, "casbin.db")}'
+            create_policy_db(db_uri, policies, groupings).dispose()
+
+        full = measure(db_uri, [], args.repeat)
+        filtered = measure(db_uri, serve, args.repeat)
+
+        snapshot_dir = os.path.join(tmp, 'snapshot')
+        logging.disable(logging.CRITICAL)
+        engine = create_engine(db_uri)
+        loader = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0, snapshot_dir=snapshot_dir)
+        loader.refresh()
+        mapped = measure(db_uri, [], args.repeat, snapshot_dir)
+
+    sys.stdout.write(f'full load:          {full["rules"]:7d} p / {full["groupings"]:5d} g '
+                     f'{full["seconds"]:8.2f} s {full["rss"] / 2 ** 20:8.1f} MiB\n')
+    sys.stdout.write(f'filtered ({args.serve}): {filtered["rules"]:7d} p / {filtered["groupings"]:5d} g '
+                     f'{filtered["seconds"]:8.2f} s {filtered["rss"] / 2 ** 20:8.1f} MiB\n')
+    sys.stdout.write(f'shared snapshot:    {mapped["rules"]:7d} p / {mapped["groupings"]:5d} g '
+                     f'{mapped["seconds"]:8.2f} s {mapped["rss"] / 2 ** 20:8.1f} MiB\n')
+    sys.stdout.write(f'filtered: load time {full["seconds"] / filtered["seconds"]:.1f}x faster, '
+                     f'{full["rss"] / max(filtered["rss"], 1):.1f}x less memory\n')
+    sys.stdout.write(f'shared:   load time {full["seconds"] / mapped["seconds"]:.1f}x faster, '
+                     f'{full["rss"] / max(mapped["rss"], 1):.1f}x less memory per worker\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Offline benchmark suite of ``users/permissions``, emitting JSON to track regressions across releases.
+
+The policy is synthetic and lives in SQLite, on disk or in memory. The suite measures:
+
+* construction: casbin enforcer, policy store load (enforcer and compiled matrix), mapping a shared snapshot
+* decision latency p50/p99 of the casbin matcher, the compiled matrix, the mapped matrix and the cached store
+* batch throughput of ``/v1/authorize/batch`` sized batches, with and without the decision cache
+* reload time of the policy store, and of a worker switching to a new shared snapshot
+
+Run from the repository root::
+
+    python -m benchmarks.bench_suite --rules 5000 --output bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timezone
+
+import casbin
+import casbin_sqlalchemy_adapter
+from casbin_sqlalchemy_adapter.adapter import CasbinRule
+from sqlalchemy.pool import StaticPool
+
+from benchmarks.synthetic_policy import create_policy_db
+from benchmarks.synthetic_policy import generate_policy
+from benchmarks.synthetic_policy import sample_requests
+from users.permissions.policy_store import PolicyStore
+
+MODEL_PATH = 'users/permissions/model.conf'
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summary_ms(samples):
+    return {
+        'min': min(samples) * 1000,
+        'p50': percentile(samples, 0.5) * 1000,
+        'max': max(samples) * 1000,
+        'runs': len(samples),
+    }
+
+
+def timed(action, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        action()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def latency_us(decide, requests):
+    """Per-decision latency, after one warm-up pass over the requests."""
+
+    for request in requests:
+        decide(*request)
+    samples = []
+    for request in requests:
+        start = time.perf_counter()
+        decide(*request)
+        samples.append(time.perf_counter() - start)
+    return {
+        'p50': percentile(samples, 0.5) * 1e6,
+        'p99': percentile(samples, 0.99) * 1e6,
+        'mean': sum(samples) / len(samples) * 1e6,
+        'decisions': len(samples),
+    }
+
+
+def batch_throughput(snapshot, requests, batch_size, seconds):
+    """Batches of ``batch_size`` checks decided the way ``/v1/authorize/batch`` does."""
+
+    batches = [requests[start:start + batch_size] for start in range(0, len(requests) - batch_size + 1, batch_size)]
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for role, zone, resource, operation in batches[count % len(batches)]:
+            snapshot.enforce(role, zone, resource, operation)
+        count += 1
+    elapsed = time.perf_counter() - start
+    return {'batch_size': batch_size, 'batches_per_s': count / elapsed, 'checks_per_s': count * batch_size / elapsed}
+
+
+def touch_policy(engine, index):
+    """Change the policy so the next refresh has something to reload."""
+
+    with engine.begin() as conn:
+        conn.execute(CasbinRule.__table__.insert(), [
+            {'ptype': 'p', 'v0': f'bench-role{index}', 'v1': 'core', 'v2': 'file', 'v3': 'view'},
+        ])
+
+
+def git_revision():
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return output.stdout.decode().strip() or None
+
+
+def run(args, tmp):
+    policies, groupings = generate_policy(args.rules, args.groupings)
+    if args.storage == 'memory':
+        engine_options = {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        engine = create_policy_db('sqlite://', policies, groupings, **engine_options)
+    else:
+        engine = create_policy_db(f'sqlite:///{os.path.join(tmp, "casbin.db")}', policies, groupings)
+    requests = sample_requests(policies, args.requests)
+
+    snapshot_dir = os.path.join(tmp, 'snapshot')
+    store = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0, cache_size=0)
+    cached_store = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0)
+    loader = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0, snapshot_dir=snapshot_dir)
+    follower = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0, cache_size=0, snapshot_dir=snapshot_dir)
+
+    enforcer = casbin.Enforcer(MODEL_PATH, casbin_sqlalchemy_adapter.Adapter(engine))
+    construction = {
+        'casbin_enforcer_ms': summary_ms(timed(
+            lambda: casbin.Enforcer(MODEL_PATH, casbin_sqlalchemy_adapter.Adapter(engine)), args.repeat
+        )),
+        'store_load_ms': summary_ms(timed(store.load, args.repeat)),
+        'shared_snapshot_publish_ms': summary_ms(timed(loader.load, args.repeat)),
+    }
+    loader.refresh()
+    construction['shared_snapshot_map_ms'] = summary_ms(timed(
+        lambda: PolicyStore(lambda: engine, MODEL_PATH, snapshot_dir=snapshot_dir).refresh(), args.repeat
+    ))
+
+    snapshot = store.snapshot
+    cached_store.load()
+    follower.refresh()
+    decision_requests = requests[:args.latency_requests]
+    latency = {
+        'casbin_matcher': latency_us(enforcer.enforce, decision_requests[:args.casbin_requests]),
+        'matrix': latency_us(snapshot.matrix.enforce, decision_requests),
+        'mapped_matrix': latency_us(follower.snapshot.matrix.enforce, decision_requests),
+        'store_cached': latency_us(cached_store.snapshot.enforce, decision_requests),
+    }
+
+    batch = {
+        'uncached': batch_throughput(snapshot, requests, args.batch_size, args.seconds),
+        'cached': batch_throughput(cached_store.snapshot, requests, args.batch_size, args.seconds),
+        'mapped': batch_throughput(follower.snapshot, requests, args.batch_size, args.seconds),
+    }
+
+    store_reloads, follower_reloads = [], []
+    for index in range(args.repeat):
+        touch_policy(engine, index)
+        store_reloads += timed(store.refresh, 1)
+        loader.refresh()
+        follower_reloads += timed(follower.refresh, 1)
+    reload = {'store_ms': summary_ms(store_reloads), 'shared_snapshot_switch_ms': summary_ms(follower_reloads)}
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'storage': args.storage,
+            'rules': args.rules,
+            'groupings': args.groupings,
+            'compiled': snapshot.matrix is not None,
+        },
+        'construction': construction,
+        'decision_latency_us': latency,
+        'batch_throughput': batch,
+        'reload': reload,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=5000)
+    parser.add_argument('--groupings', type=int, default=500)
+    parser.add_argument('--storage', choices=['file', 'memory'], default='file')
+    parser.add_argument('--requests', type=int, default=10000, help='sampled requests replayed by the suite')
+    parser.add_argument('--latency-requests', type=int, default=5000)
+    parser.add_argument('--casbin-requests', type=int, default=200, help='the casbin matcher is slow, sample less')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each construction and reload measurement')
+    parser.add_argument('--seconds', type=float, default=2, help='duration of each throughput measurement')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    # casbin logs every decision, keep the numbers about the decision path itself
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(args, tmp)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Local stand-in for the Keycloak OpenID endpoints used by the login path.
+
+It serves the discovery document, the realm keys, the password grant and userinfo for any username and password,
+with an optional delay per request to play the network and Keycloak itself. Tokens are RS256 signed, like the
+realm tokens.
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import rsa
+from jose import jwk
+from jose import jwt
+
+_OPENID = '/protocol/openid-connect/'
+
+
+class KeycloakStandIn:
+    """Serve a realm on ``127.0.0.1`` from a background thread."""
+
+    def __init__(self, realm: str = 'testrealm', latency: float = 0.0):
+        self.realm = realm
+        self.latency = latency
+        self.requests = Counter()
+        # same key size as the realm keys of Keycloak, generating it takes a few seconds
+        _, private_key = rsa.newkeys(2048)
+        pem = private_key.save_pkcs1()
+        # parsing the PEM is slower than signing, do it once
+        self._signing_key = jwk.construct(pem, 'RS256')
+        self.kid = uuid.uuid4().hex
+        self._jwk = dict(self._signing_key.public_key().to_dict(), kid=self.kid, use='sig')
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def server_url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/auth/'
+
+    @property
+    def issuer(self) -> str:
+        return f'{self.server_url}realms/{self.realm}'
+
+    def __enter__(self) -> 'KeycloakStandIn':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def issue_token(self, username: str) -> dict:
+        now = int(time.time())
+        claims = {
+            'iss': self.issuer, 'iat': now, 'exp': now + 300, 'sub': str(uuid.uuid5(uuid.NAMESPACE_DNS, username)),
+            'typ': 'Bearer', 'azp': 'client', 'preferred_username': username,
+            'realm_access': {'roles': ['offline_access', 'uma_authorization']},
+        }
+        access_token = jwt.encode(claims, self._signing_key, algorithm='RS256', headers={'kid': self.kid})
+        return {
+            'access_token': access_token, 'expires_in': 300, 'refresh_expires_in': 1800,
+            'refresh_token': uuid.uuid4().hex, 'token_type': 'bearer', 'scope': 'email profile',
+        }
+
+    def respond(self, method: str, path: str, headers, body: bytes) -> dict:
+        self.requests[path.rsplit('/', 1)[-1]] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        prefix = f'/auth/realms/{self.realm}'
+        if path == f'{prefix}/.well-known/openid-configuration':
+            return {
+                'issuer': self.issuer,
+                'token_endpoint': f'{self.issuer}{_OPENID}token',
+                'userinfo_endpoint': f'{self.issuer}{_OPENID}userinfo',
+                'jwks_uri': f'{self.issuer}{_OPENID}certs',
+            }
+        if path == f'{prefix}{_OPENID}certs':
+            return {'keys': [self._jwk]}
+        if method == 'POST' and path == f'{prefix}{_OPENID}token':
+            return self.issue_token(parse_qs(body.decode())['username'][0])
+        if path == f'{prefix}{_OPENID}userinfo':
+            claims = jwt.get_unverified_claims(headers['Authorization'].split(' ', 1)[1])
+            return {'sub': claims['sub'], 'preferred_username': claims['preferred_username']}
+        raise KeyError(path)
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, the way Keycloak serves clients that reuse their connections
+            protocol_version = 'HTTP/1.1'
+            # one segment per response, or delayed acks add tens of milliseconds to every request
+            disable_nagle_algorithm = True
+            wbufsize = -1
+
+            def _serve(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    status, content = 200, standin.respond(method, self.path.split('?')[0], self.headers, body)
+                except KeyError:
+                    status, content = 404, {'error': 'not found'}
+                data = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._serve('GET')
+
+            def do_POST(self):
+                self._serve('POST')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,110 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Synthetic casbin policies shaped like the production ``pilot_casbin.casbin_rule`` table."""
+
+import itertools
+import random
+from typing import List
+from typing import Tuple
+
+from casbin_sqlalchemy_adapter.adapter import Base
+from casbin_sqlalchemy_adapter.adapter import CasbinRule
+from sqlalchemy import create_engine
+
+ROLES = ['admin', 'contributor', 'collaborator', 'member']
+ZONES = ['greenroom', 'core', '*']
+RESOURCES = ['file', 'folder', 'project', 'dataset', 'announcement', 'notification', 'workbench', 'copyrequest']
+OPERATIONS = ['view', 'upload', 'download', 'delete', 'update', 'create', 'copy', 'export', '*']
+
+Rule = Tuple[str, ...]
+
+
+def generate_policy(
+    num_rules: int, num_groupings: int = 0, seed: int = 0, zones: List[str] = ZONES
+) -> Tuple[List[Rule], List[Rule]]:
+    """Generate ``num_rules`` distinct ``p`` rules and ``num_groupings`` distinct ``g`` rules over ``zones``.
+
+    The first rules use the plain project roles, larger policies add project scoped roles (``project7-admin``) so
+    the table keeps growing the way it does when projects are onboarded.
+    """
+
+    rng = random.Random(seed)
+    policies = []
+    for project in itertools.count():
+        roles = ROLES if project == 0 else [f'project{project}-{role}' for role in ROLES]
+        for role, zone, resource in itertools.product(roles, zones, RESOURCES):
+            for operation in OPERATIONS:
+                if rng.random() < 0.5:
+                    policies.append((role, zone, resource, operation))
+                    if len(policies) == num_rules:
+                        break
+            if len(policies) == num_rules:
+                break
+        if len(policies) == num_rules:
+            break
+
+    subjects = sorted({rule[0] for rule in policies})
+    groupings = set()
+    while len(groupings) < num_groupings:
+        user = f'user{rng.randrange(num_groupings * 2)}'
+        groupings.add((user, rng.choice(subjects), rng.choice(zones)))
+
+    return policies, sorted(groupings)
+
+
+def request_space(policies: List[Rule], groupings: List[Rule]) -> List[Rule]:
+    """Every (role, zone, resource, operation) request that can be built from the values used in the policy."""
+
+    subjects = {rule[0] for rule in policies} | {rule[0] for rule in groupings} | {'platform_admin', 'unknown'}
+    zones = {rule[1] for rule in policies} | {rule[2] for rule in groupings}
+    resources = {rule[2] for rule in policies} | {'unknown'}
+    operations = {rule[3] for rule in policies} | {'unknown'}
+    return list(itertools.product(sorted(subjects), sorted(zones), sorted(resources), sorted(operations)))
+
+
+def sample_requests(policies: List[Rule], count: int, seed: int = 0) -> List[Rule]:
+    """Mix of granted and denied requests that resembles the traffic hitting ``/v1/authorize``."""
+
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        role, zone, resource, operation = rng.choice(policies)
+        if rng.random() < 0.3:
+            operation = rng.choice(OPERATIONS[:-1])
+        if rng.random() < 0.3:
+            zone = rng.choice(ZONES[:-1])
+        requests.append((role, zone, resource, operation))
+    return requests
+
+
+def create_policy_db(url: str, policies: List[Rule], groupings: List[Rule], **engine_options):
+    """Create a ``casbin_rule`` table at ``url`` holding the given rules and return its engine."""
+
+    engine = create_engine(url, **engine_options)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    rows = [{'ptype': 'p', 'v0': r[0], 'v1': r[1], 'v2': r[2], 'v3': r[3]} for r in policies]
+    rows += [{'ptype': 'g', 'v0': r[0], 'v1': r[1], 'v2': r[2], 'v3': None} for r in groupings]
+    with engine.begin() as conn:
+        for start in range(0, len(rows), 5000):
+            conn.execute(CasbinRule.__table__.insert(), rows[start:start + 5000])
+    return engine
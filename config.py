@@ -73,6 +73,14 @@ class Settings(BaseSettings):
     NEO4J_SERVICE: str
     EMAIL_SERVICE: str
     UTILITY_SERVICE: str
+    # connection pool of each of keycloak, neo4j, email and utility, per worker
+    UPSTREAM_TIMEOUT: float = 30
+    UPSTREAM_MAX_CONNECTIONS: int = 100
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    # seconds an idle connection is kept open
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 5
+    # requires the h2 package
+    UPSTREAM_HTTP2: bool = False
 
     EMAIL_SUPPORT: str
     EMAIL_ADMIN: str
@@ -98,6 +106,40 @@ class Settings(BaseSettings):
     RDS_SCHEMA_DEFAULT: str
     RDS_DB_URI: str
 
+    # casbin policy
+    CASBIN_POLICY_VERSION_POLL_INTERVAL: int = 2
+    # only used when the database has no casbin_policy_version table
+    CASBIN_POLICY_REFRESH_INTERVAL: int = 30
+    CASBIN_DECISION_CACHE_SIZE: int = 10000
+    CASBIN_POLICY_COMPILE: bool = True
+    # comma separated zones served by this deployment, empty loads the policy of every zone
+    CASBIN_POLICY_ZONES: str = ''
+    # directory shared by the workers of a pod, preferably on tmpfs, empty makes every worker load the policy itself
+    CASBIN_SNAPSHOT_DIR: str = ''
+
+    # last_login write-behind queue, logins of a user within the window are written once
+    LAST_LOGIN_COALESCE_WINDOW: float = 5
+    LAST_LOGIN_FLUSH_INTERVAL: float = 1
+    LAST_LOGIN_BATCH_SIZE: int = 100
+    LAST_LOGIN_QUEUE_SIZE: int = 10000
+    # sqlite file keeping the deferred writes that could not be applied yet, shared by the workers of a pod
+    WRITE_SPOOL_PATH: str = 'spool/write_behind.db'
+    WRITE_SPOOL_MAX_ROWS: int = 100000
+    WRITE_SPOOL_BATCH_SIZE: int = 100
+    WRITE_SPOOL_REPLAY_INTERVAL: float = 5
+    # seconds between replays after a failure, doubled on every further failure up to the max
+    WRITE_SPOOL_BACKOFF: float = 1
+    WRITE_SPOOL_MAX_BACKOFF: float = 300
+
+    # copy of the keycloak users serving /v1/users, see migration 9d2f6b3a8c41
+    USER_DIRECTORY_ENABLED: bool = True
+    # seconds between polls of the keycloak admin and user events
+    USER_DIRECTORY_EVENT_POLL_INTERVAL: float = 5
+    # seconds between comparisons of every keycloak user with the copy
+    USER_DIRECTORY_RECONCILE_INTERVAL: float = 900
+    # /v1/users is answered by keycloak while the copy is older than this
+    USER_DIRECTORY_MAX_STALENESS: float = 3600
+
     # Keycloak config
     KEYCLOAK_GRANT_TYPE: str
     KEYCLOAK_ID: str
@@ -105,6 +147,21 @@ class Settings(BaseSettings):
     KEYCLOAK_CLIENT_ID: str
     KEYCLOAK_SECRET: str
     KEYCLOAK_REALM: str
+    # seconds before its expiry the admin token is refreshed
+    KEYCLOAK_ADMIN_TOKEN_REFRESH_MARGIN: float = 30
+    # seconds the realm roles are kept by name before listing them again
+    KEYCLOAK_REALM_ROLE_TTL: int = 300
+    # project realm roles created at the same time
+    KEYCLOAK_ROLE_CREATE_CONCURRENCY: int = 5
+    # members of the realm roles fetched at the same time
+    KEYCLOAK_ROLE_USERS_CONCURRENCY: int = 10
+    # seconds the members of a realm role are served, then refreshed in the background until they are max stale
+    KEYCLOAK_ROLE_MEMBERS_TTL: float = 30
+    KEYCLOAK_ROLE_MEMBERS_MAX_STALE: float = 300
+    # seconds the OpenID discovery document is served before being refreshed
+    KEYCLOAK_WELL_KNOWN_TTL: int = 3600
+    # audience required by /v1/users/token/verify, in aud or azp, defaults to KEYCLOAK_CLIENT_ID
+    KEYCLOAK_TOKEN_AUDIENCE: str = ''
 
     DOMAIN_NAME: str
     START_PATH: str
@@ -133,6 +190,8 @@ class Settings(BaseSettings):
 
         self.NEO4J_SERVICE += '/v1/neo4j/'
         self.EMAIL_SERVICE += '/v1/email'
+        if not self.KEYCLOAK_TOKEN_AUDIENCE:
+            self.KEYCLOAK_TOKEN_AUDIENCE = self.KEYCLOAK_CLIENT_ID
 
 
 @lru_cache(1)
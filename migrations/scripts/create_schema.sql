@@ -21,3 +21,4 @@
 \c auth
 create schema if not exists pilot_invitation;
 create schema if not exists pilot_casbin;
+create schema if not exists pilot_user_directory;
@@ -0,0 +1,53 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Add user directory state.
+
+Revision ID: 5b8e2c7d1a93
+Revises: 9d2f6b3a8c41
+Create Date: 2022-05-10 14:12:53.902117
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '5b8e2c7d1a93'
+down_revision = '9d2f6b3a8c41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_directory_state',
+    sa.Column('id', sa.INTEGER(), autoincrement=False, nullable=False),
+    sa.Column('event_time', sa.BIGINT(), nullable=True),
+    sa.Column('poll_claimed_at', sa.DateTime(), nullable=True),
+    sa.Column('polled_at', sa.DateTime(), nullable=True),
+    sa.Column('reconcile_claimed_at', sa.DateTime(), nullable=True),
+    sa.Column('reconciled_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id', name='user_directory_state_pkey'),
+    schema='pilot_user_directory'
+    )
+    op.execute('INSERT INTO pilot_user_directory.user_directory_state (id) VALUES (1)')
+
+
+def downgrade():
+    op.drop_table('user_directory_state', schema='pilot_user_directory')
@@ -0,0 +1,69 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Add user directory.
+
+Revision ID: 9d2f6b3a8c41
+Revises: c3e8f1a27b64
+Create Date: 2022-05-03 09:47:26.318540
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '9d2f6b3a8c41'
+down_revision = 'c3e8f1a27b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_directory',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('username', sa.String(), nullable=False),
+    sa.Column('first_name', sa.String(), nullable=True),
+    sa.Column('last_name', sa.String(), nullable=True),
+    sa.Column('email', sa.String(), nullable=True),
+    sa.Column('time_created', sa.DateTime(), nullable=True),
+    sa.Column('last_login', sa.String(), nullable=True),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('is_admin', sa.Boolean(), nullable=False),
+    sa.Column('synced_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id', name='user_directory_pkey'),
+    sa.UniqueConstraint('username', name='user_directory_username_key'),
+    schema='pilot_user_directory'
+    )
+
+    # /v1/users sorts by any of these columns, with the id breaking ties
+    for column in ('email', 'first_name', 'last_name', 'time_created', 'last_login', 'status'):
+        op.create_index(f'ix_user_directory_{column}', 'user_directory', [column, 'id'], schema='pilot_user_directory')
+
+    # username and email are searched case-insensitively on any part of the value
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in ('username', 'email'):
+        op.execute(
+            f'CREATE INDEX ix_user_directory_{column}_trgm ON pilot_user_directory.user_directory '
+            f'USING gin (lower({column}) gin_trgm_ops)'
+        )
+
+
+def downgrade():
+    op.drop_table('user_directory', schema='pilot_user_directory')
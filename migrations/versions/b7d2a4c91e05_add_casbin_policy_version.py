@@ -0,0 +1,70 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Add casbin policy version.
+
+Revision ID: b7d2a4c91e05
+Revises: e86797550c26
+Create Date: 2022-04-12 10:21:44.381920
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = 'b7d2a4c91e05'
+down_revision = 'e86797550c26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('casbin_policy_version',
+    sa.Column('id', sa.INTEGER(), autoincrement=False, nullable=False),
+    sa.Column('version', sa.BIGINT(), server_default='0', nullable=False),
+    sa.Column('last_txid', sa.BIGINT(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id', name='casbin_policy_version_pkey'),
+    schema='pilot_casbin'
+    )
+    op.execute('INSERT INTO pilot_casbin.casbin_policy_version (id, version) VALUES (1, 0)')
+
+    # bump the version at most once per transaction, whatever the number of statements touching casbin_rule
+    op.execute("""
+        CREATE FUNCTION pilot_casbin.bump_casbin_policy_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE pilot_casbin.casbin_policy_version
+               SET version = version + 1, last_txid = txid_current(), updated_at = now()
+             WHERE id = 1 AND last_txid IS DISTINCT FROM txid_current();
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER casbin_rule_bump_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pilot_casbin.casbin_rule
+        FOR EACH STATEMENT EXECUTE PROCEDURE pilot_casbin.bump_casbin_policy_version()
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER casbin_rule_bump_version ON pilot_casbin.casbin_rule')
+    op.execute('DROP FUNCTION pilot_casbin.bump_casbin_policy_version()')
+    op.drop_table('casbin_policy_version', schema='pilot_casbin')
@@ -0,0 +1,47 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Add casbin rule indexes.
+
+Revision ID: c3e8f1a27b64
+Revises: b7d2a4c91e05
+Create Date: 2022-04-19 15:02:11.604218
+
+"""
+from alembic import op
+
+revision = 'c3e8f1a27b64'
+down_revision = 'b7d2a4c91e05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # p rules are looked up by role and zone, g rules by user and by zone
+    op.create_index('ix_casbin_rule_ptype_v0_v1', 'casbin_rule', ['ptype', 'v0', 'v1'], schema='pilot_casbin')
+    op.create_index('ix_casbin_rule_ptype_v1', 'casbin_rule', ['ptype', 'v1'], schema='pilot_casbin')
+    op.create_index('ix_casbin_rule_ptype_v2', 'casbin_rule', ['ptype', 'v2'], schema='pilot_casbin')
+
+
+def downgrade():
+    op.drop_index('ix_casbin_rule_ptype_v2', table_name='casbin_rule', schema='pilot_casbin')
+    op.drop_index('ix_casbin_rule_ptype_v1', table_name='casbin_rule', schema='pilot_casbin')
+    op.drop_index('ix_casbin_rule_ptype_v0_v1', table_name='casbin_rule', schema='pilot_casbin')
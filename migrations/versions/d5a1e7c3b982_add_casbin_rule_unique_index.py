@@ -0,0 +1,58 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Add casbin rule unique index.
+
+Revision ID: d5a1e7c3b982
+Revises: 5b8e2c7d1a93
+Create Date: 2022-05-17 09:41:26.118034
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = 'd5a1e7c3b982'
+down_revision = '5b8e2c7d1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest copy of the rules inserted twice before the index existed
+    op.execute("""
+        DELETE FROM pilot_casbin.casbin_rule duplicate
+         USING pilot_casbin.casbin_rule original
+         WHERE duplicate.id > original.id
+           AND duplicate.ptype = original.ptype
+           AND duplicate.v0 IS NOT DISTINCT FROM original.v0
+           AND duplicate.v1 IS NOT DISTINCT FROM original.v1
+           AND duplicate.v2 IS NOT DISTINCT FROM original.v2
+           AND duplicate.v3 IS NOT DISTINCT FROM original.v3
+    """)
+    # g rules have no v3, and nulls never conflict in a unique index
+    op.create_index(
+        'ix_casbin_rule_unique', 'casbin_rule', ['ptype', 'v0', 'v1', 'v2', sa.text("coalesce(v3, '')")],
+        unique=True, schema='pilot_casbin'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_casbin_rule_unique', table_name='casbin_rule', schema='pilot_casbin')
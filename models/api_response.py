@@ -19,6 +19,8 @@
 # 
 
 from enum import Enum
+from typing import Optional
+
 from pydantic import BaseModel
 from fastapi.responses import JSONResponse
 
@@ -42,4 +44,11 @@ class APIResponse(BaseModel):
     def json_response(self) -> JSONResponse:
         data = self.dict()
         data["code"] = self.code.value
-        return JSONResponse(status_code=self.code.value, content=data)
\ No newline at end of file
+        return JSONResponse(status_code=self.code.value, content=data)
+
+
+class CursorAPIResponse(APIResponse):
+    """Page of a listing paginated with a cursor, the total is only counted for the first page."""
+
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
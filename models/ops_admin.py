@@ -29,6 +29,8 @@ from pydantic import BaseModel
 from pydantic import Field
 from pydantic.types import constr
 
+from resources.pagination import MAX_LIMIT
+
 
 class UserGroupPOST(BaseModel):
 
@@ -50,4 +52,7 @@ class UserInRolePOST(BaseModel):
     page_size: int=10
     order_by: str=None
     order_type: str="asc"
-    status: str="active"
\ No newline at end of file
+    status: str="active"
+    # keyset pagination, instead of page and page_size
+    cursor: str=None
+    limit: int=Field(None, ge=1, le=MAX_LIMIT)
\ No newline at end of file
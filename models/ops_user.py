@@ -45,6 +45,12 @@ class UserTokenRefreshPOST(BaseModel):
     refreshtoken: str
 
 
+class UserTokenVerifyPOST(BaseModel):
+    """token verification model."""
+
+    token: str
+
+
 class UserLastLoginPOST(BaseModel):
 
     username: str
@@ -0,0 +1,68 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+from typing import List
+
+from pydantic import BaseModel
+from pydantic import Field
+
+
+class AuthorizeCheck(BaseModel):
+    """one permission check of a batch."""
+
+    role: str
+    zone: str
+    resource: str
+    operation: str
+
+
+class AuthorizeBatchPOST(BaseModel):
+
+    checks: List[AuthorizeCheck] = Field(..., max_items=500)
+
+
+class PolicyRule(BaseModel):
+    """p rule: the role may run the operation on the resource in the zone."""
+
+    role: str
+    zone: str
+    resource: str
+    operation: str
+
+
+class GroupingRule(BaseModel):
+    """g rule: the user has the role in the zone."""
+
+    user: str
+    role: str
+    zone: str
+
+
+class PoliciesPOST(BaseModel):
+
+    policies: List[PolicyRule] = Field([], max_items=10000)
+    groupings: List[GroupingRule] = Field([], max_items=10000)
+
+
+class PoliciesDELETE(BaseModel):
+
+    policies: List[PolicyRule] = Field([], max_items=10000)
+    groupings: List[GroupingRule] = Field([], max_items=10000)
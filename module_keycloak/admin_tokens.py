@@ -0,0 +1,153 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import time
+from typing import Dict
+from typing import Tuple
+
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from keycloak.exceptions import KeycloakGetError
+from keycloak.exceptions import raise_error_from_response
+
+from resources.http_clients import http_clients
+
+_logger = SrvLoggerFactory('admin_tokens').get_logger()
+
+# (server_url, realm_name, client_id, client_secret_key)
+TokenKey = Tuple[str, str, str, str]
+
+
+class AdminToken:
+    def __init__(self, token: dict):
+        self.token = token
+        self.access_token = token['access_token']
+        self.fetched_at = time.time()
+        self.expires_at = self.fetched_at + token.get('expires_in', 60)
+
+    def expires_in(self) -> float:
+        return self.expires_at - time.time()
+
+
+class AdminTokenManager:
+    """Client-credentials tokens of the admin operations, shared by the requests of the worker.
+
+    A token is fetched once per (server, realm, client) and served until ``refresh_margin`` seconds before it
+    expires. Within the margin it is still served while a single refresh runs in the background, and ``start``
+    refreshes the tokens in use before they get there. Concurrent requests needing a new token share one grant.
+    """
+
+    def __init__(self, refresh_margin: float = 30):
+        self._refresh_margin = refresh_margin
+        self._tokens: Dict[TokenKey, AdminToken] = {}
+        # grants in flight, a request needing the same token waits for it instead of asking for another one
+        self._pending: Dict[TokenKey, asyncio.Future] = {}
+        self._refresher = None
+        self.hits = 0
+        self.grants = 0
+        self.failures = 0
+        self.invalidated = 0
+
+    async def _grant(self, key: TokenKey) -> AdminToken:
+        server_url, realm_name, client_id, client_secret_key = key
+        try:
+            response = await http_clients.get('keycloak').post(
+                f'{server_url}realms/{realm_name}/protocol/openid-connect/token',
+                data={
+                    "client_id": client_id,
+                    "client_secret": client_secret_key,
+                    "grant_type": "client_credentials",
+                },
+            )
+            token = AdminToken(raise_error_from_response(response, KeycloakGetError))
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._pending.pop(key, None)
+        self.grants += 1
+        self._tokens[key] = token
+        return token
+
+    def _refresh(self, key: TokenKey) -> asyncio.Future:
+        pending = self._pending.get(key)
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending[key] = asyncio.ensure_future(self._grant(key))
+        return pending
+
+    async def get(self, key: TokenKey) -> AdminToken:
+        token = self._tokens.get(key)
+        if token is None or token.expires_in() <= 0:
+            return await asyncio.shield(self._refresh(key))
+        if token.expires_in() <= self._refresh_margin:
+            self._refresh(key).add_done_callback(self._log_failure)
+        self.hits += 1
+        return token
+
+    def invalidate(self, key: TokenKey, token: AdminToken) -> None:
+        """Forget a token Keycloak refused, unless it was already replaced."""
+
+        if self._tokens.get(key) is token:
+            del self._tokens[key]
+            self.invalidated += 1
+
+    def stats(self) -> dict:
+        return {
+            'tokens': [
+                {'realm': realm_name, 'client_id': client_id, 'expires_in': token.expires_in()}
+                for (_, realm_name, client_id, _), token in list(self._tokens.items())
+            ],
+            'hits': self.hits,
+            'grants': self.grants,
+            'failures': self.failures,
+            'invalidated': self.invalidated,
+        }
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            _logger.error(f'Error refreshing the admin token - {future.exception()}')
+
+    async def start(self) -> None:
+        if self._refresher is None:
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self) -> None:
+        if self._refresher is None:
+            return
+        self._refresher.cancel()
+        try:
+            await self._refresher
+        except asyncio.CancelledError:
+            pass
+        self._refresher = None
+
+    async def _refresh_forever(self) -> None:
+        # wake up often enough to refresh every token within its margin
+        interval = max(1, self._refresh_margin / 3)
+        while True:
+            await asyncio.sleep(interval)
+            for key, token in list(self._tokens.items()):
+                if token.expires_in() <= self._refresh_margin:
+                    try:
+                        await asyncio.shield(self._refresh(key))
+                    except Exception as e:
+                        _logger.error(f'Error refreshing the admin token of realm {key[1]} - {e}')
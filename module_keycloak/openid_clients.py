@@ -0,0 +1,153 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import threading
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from keycloak import KeycloakOpenID
+from starlette.concurrency import run_in_threadpool
+
+from module_keycloak.tokens import JWKSCache
+from module_keycloak.tokens import TokenVerifier
+
+_logger = SrvLoggerFactory('openid_clients').get_logger()
+
+
+class SharedOpenIDClient:
+    """KeycloakOpenID client reused by every request of a worker.
+
+    The client keeps its HTTP session, so the connections to the token endpoint stay alive between logins. The
+    discovery document and the realm keys are fetched once and then refreshed every ``well_known_ttl`` seconds;
+    until the refresh succeeds the previous ones keep being served.
+    """
+
+    def __init__(self, keycloak_openid: KeycloakOpenID, well_known_ttl: int):
+        self.keycloak_openid = keycloak_openid
+        self._well_known_ttl = well_known_ttl
+        self._well_known = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self.jwks = JWKSCache(keycloak_openid.certs, well_known_ttl)
+        self.token_verifier = TokenVerifier(self.jwks, lambda: self.well_known['issuer'])
+
+    @property
+    def well_known(self) -> dict:
+        """Return the discovery document, fetching it only when it was never fetched."""
+
+        if self._well_known is None:
+            self.refresh_well_known()
+        return self._well_known
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self._fetched_at >= self._well_known_ttl
+
+    def refresh_well_known(self) -> dict:
+        with self._lock:
+            # another thread may have fetched it while this one was waiting
+            if self._well_known is None or self.stale:
+                self._well_known = self.keycloak_openid.well_know()
+                self._fetched_at = time.time()
+            return self._well_known
+
+
+class OpenIDClients:
+    """One shared OpenID client per (client, realm), with the discovery documents refreshed in the background."""
+
+    def __init__(self, server_url: str, well_known_ttl: int = 3600):
+        self._server_url = server_url
+        self._well_known_ttl = well_known_ttl
+        self._clients: Dict[Tuple[str, str, Optional[str]], SharedOpenIDClient] = {}
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get(self, client_id: str, realm_name: str, client_secret_key: Optional[str]) -> SharedOpenIDClient:
+        key = (client_id, realm_name, client_secret_key)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    keycloak_openid = KeycloakOpenID(
+                        server_url=self._server_url,
+                        client_id=client_id,
+                        realm_name=realm_name,
+                        client_secret_key=client_secret_key,
+                    )
+                    client = SharedOpenIDClient(keycloak_openid, self._well_known_ttl)
+                    self._clients[key] = client
+        return client
+
+    def stats(self) -> list:
+        """Describe the clients in use by this worker."""
+
+        return [
+            dict(client.token_verifier.stats(), client_id=client_id, realm=realm_name)
+            for (client_id, realm_name, _), client in list(self._clients.items())
+        ]
+
+    async def start(self, preload: Iterable[Tuple[str, str, Optional[str]]] = ()) -> None:
+        """Fetch the discovery document and keys of the ``preload`` clients, then start refreshing them.
+
+        The first request of the worker then finds them cached; a client failing to load is fetched again on use.
+        """
+
+        for client_id, realm_name, client_secret_key in preload:
+            client = self.get(client_id, realm_name, client_secret_key)
+            try:
+                await run_in_threadpool(client.refresh_well_known)
+                await run_in_threadpool(client.jwks.refresh)
+            except Exception as e:
+                _logger.error(f'Error loading the OpenID discovery document or keys of {realm_name} - {e}')
+
+        if self._refresher is None and self._well_known_ttl > 0:
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self) -> None:
+        if self._refresher is None:
+            return
+        self._refresher.cancel()
+        try:
+            await self._refresher
+        except asyncio.CancelledError:
+            pass
+        self._refresher = None
+
+    async def _refresh_forever(self) -> None:
+        # wake up often enough that a document is never served much past its ttl
+        interval = max(1, self._well_known_ttl // 10)
+        while True:
+            await asyncio.sleep(interval)
+            for client in list(self._clients.values()):
+                try:
+                    if client.stale:
+                        await run_in_threadpool(client.refresh_well_known)
+                    if client.jwks.stale:
+                        await run_in_threadpool(client.jwks.refresh)
+                except Exception as e:
+                    _logger.error(f'Error refreshing the OpenID discovery document or keys - {e}')
+
@@ -18,33 +18,90 @@
 # permissions and limitations under the Licence.
 # 
 
-import requests
-from keycloak import KeycloakAdmin
+import asyncio
+
+from keycloak.exceptions import KeycloakGetError
+from keycloak.exceptions import raise_error_from_response
 
 from config import ConfigSettings
+from module_keycloak.admin_tokens import AdminTokenManager
+from module_keycloak.realm_roles import RealmRoleIndex
+from module_keycloak.role_members import RoleMembersCache
+from resources.http_clients import http_clients
+
+admin_tokens = AdminTokenManager(ConfigSettings.KEYCLOAK_ADMIN_TOKEN_REFRESH_MARGIN)
+realm_roles = RealmRoleIndex(ConfigSettings.KEYCLOAK_REALM_ROLE_TTL)
+role_members = RoleMembersCache(
+    ConfigSettings.KEYCLOAK_ROLE_MEMBERS_TTL, ConfigSettings.KEYCLOAK_ROLE_MEMBERS_MAX_STALE
+)
+
+# page size used to fetch every user or group of the realm
+_PAGE_SIZE = 100
 
 
 class OperationsAdmin:
+    """Keycloak admin REST API of a realm, called with the service account of the client.
+
+    The requests go through the shared async client of keycloak, the errors are raised as
+    python-keycloak exceptions. The admin token comes from the token manager of the worker, a request
+    refused with a 401 is sent once more with a new token.
+    """
+
     def __init__(
         self,
         realm_name,
         server_url=ConfigSettings.KEYCLOAK_SERVER_URL,
         client_id=ConfigSettings.KEYCLOAK_CLIENT_ID,
         client_secret_key=ConfigSettings.KEYCLOAK_SECRET,
-        verify=True,
     ):
-        self.keycloak_admin = KeycloakAdmin(
-            server_url=server_url,
-            client_id=client_id,
-            client_secret_key=client_secret_key,
-            realm_name=realm_name,
-            verify=verify,
-        )
+        self.server_url = server_url
+        self.client_id = client_id
+        self.client_secret_key = client_secret_key
         self.realm_name = realm_name
-        self.token = self.keycloak_admin.token
+        self.token_key = (server_url, realm_name, client_id, client_secret_key)
+
+    @property
+    def client(self):
+        return http_clients.get('keycloak')
+
+    async def get_token(self):
+        admin_token = await admin_tokens.get(self.token_key)
+        return admin_token.token
+
+    # raw response of an admin endpoint of the realm
+    async def send(self, method, path, **kwargs):
+        url = f'{self.server_url}admin/realms/{self.realm_name}/{path}'
+        if kwargs.get('params'):
+            # unset filters are left out, httpx would send them empty
+            kwargs['params'] = {key: value for key, value in kwargs['params'].items() if value is not None}
+        for _ in range(2):
+            admin_token = await admin_tokens.get(self.token_key)
+            headers = {'Authorization': 'Bearer ' + admin_token.access_token}
+            response = await self.client.request(method, url, headers=headers, **kwargs)
+            if response.status_code != 401:
+                break
+            # revoked or expired early, e.g. keycloak restarted
+            admin_tokens.invalidate(self.token_key, admin_token)
+        return response
+
+    async def request(self, method, path, expected_code=200, **kwargs):
+        response = await self.send(method, path, **kwargs)
+        return raise_error_from_response(response, KeycloakGetError, expected_code=expected_code)
+
+    async def fetch_all(self, path, query=None):
+        results = []
+        query = dict(query or {}, max=_PAGE_SIZE)
+        page = 0
+        while True:
+            query['first'] = page * _PAGE_SIZE
+            partial_results = await self.request('GET', path, params=query)
+            if not partial_results:
+                return results
+            results.extend(partial_results)
+            page += 1
 
     # create_user
-    def create_user(
+    async def create_user(
         self,
         username,
         password,
@@ -54,101 +111,157 @@ class OperationsAdmin:
         cred_type='password',
         enabled=True,
     ):
-        new_user = self.keycloak_admin.create_user(
-            {
+        user_id = await self.get_user_id(username)
+        if user_id is not None:
+            return user_id
+        response = await self.send(
+            'POST',
+            'users',
+            json={
                 "email": email,
                 "username": username,
                 "enabled": enabled,
                 "firstName": firstname,
                 "lastName": lastname,
                 "credentials": [{"value": password, "type": cred_type}]
-            }
+            },
         )
-        return new_user
+        raise_error_from_response(response, KeycloakGetError, expected_code=201)
+        return response.headers['Location'].rsplit('/', 1)[-1]
 
     # Delete User
-    def delete_user(self, userid):
-        response = self.keycloak_admin.delete_user(user_id=userid)
-        return response
+    async def delete_user(self, userid):
+        try:
+            return await self.request('DELETE', f'users/{userid}', expected_code=204)
+        finally:
+            role_members.invalidate_realm(self)
 
     # Get user ID from name
-    def get_user_id(self, username):
-        user_id = self.keycloak_admin.get_user_id(username)
-        return user_id
+    async def get_user_id(self, username):
+        users = await self.fetch_all('users', {"search": username})
+        return next((user["id"] for user in users if user["username"] == username), None)
 
     # Get User
-    def get_user_info(self, userid):
-        user = self.keycloak_admin.get_user(userid)
-        return user
+    async def get_user_info(self, userid):
+        return await self.request('GET', f'users/{userid}')
 
     # List all users
-    def get_users(self, query):
-        users = self.keycloak_admin.get_users()
-        return users
+    async def get_users(self, query=None):
+        return await self.fetch_all('users', query)
 
     # Get user by email
-    def get_user_by_email(self, email):
-        users = self.keycloak_admin.get_users({"email": email})
+    async def get_user_by_email(self, email):
+        users = await self.fetch_all('users', {"email": email})
         # Loop through search results and only return an exact match
         return next((user for user in users if user["email"] == email), None)
 
+    # Count the users matching the query
+    async def count_users(self, query=None):
+        return await self.request('GET', 'users/count', params=query)
+
+    # One page of the users matching the query
+    async def list_users(self, query=None):
+        return await self.request('GET', 'users', params=query)
+
+    # Users having a realm role, from the role members cache of the worker
+    async def get_role_users(self, role_name):
+        return await role_members.get(self, role_name)
+
+    # Users of each realm role, fetched concurrently
+    async def get_roles_users(self, role_names):
+        role_names = list(dict.fromkeys(role_names))
+        semaphore = asyncio.Semaphore(ConfigSettings.KEYCLOAK_ROLE_USERS_CONCURRENCY)
+
+        async def get_role_users(role_name):
+            async with semaphore:
+                return await self.get_role_users(role_name)
+
+        return dict(zip(role_names, await asyncio.gather(*[get_role_users(role_name) for role_name in role_names])))
+
     # Set password for user
-    def set_user_password(self, userid, password, temporary):
-        res = self.keycloak_admin.set_user_password(
-            userid, password, temporary)
-        return res
+    async def set_user_password(self, userid, password, temporary):
+        payload = {"type": "password", "temporary": temporary, "value": password}
+        return await self.request('PUT', f'users/{userid}/reset-password', expected_code=204, json=payload)
 
     # Update user
-    def update_user(self, userid, payload):
-        res = self.keycloak_admin.update_user(user_id=userid, payload=payload)
-        return res
-
-    # Assign role
-    def assign_user_role(self, userid, role_name):
-        client_id = ConfigSettings.KEYCLOAK_CLIENT_ID
-        realm_roles = self.keycloak_admin.get_realm_roles()
-        find_role = [
-            role for role in realm_roles if role['name'] == role_name][0]
-        role_id = find_role['id']
-        res = self.keycloak_admin.assign_realm_roles(
-            client_id=client_id, user_id=userid, roles=[find_role])
-        return res
-
-    def sync_user_trigger(self):
-        access_token = self.token['access_token']
-        headers = {
-            'Authorization': 'Bearer ' + access_token
-        }
-        url = f'{ConfigSettings.KEYCLOAK_SERVER_URL}admin/realms/{ConfigSettings.KEYCLOAK_REALM}/user-storage/{ConfigSettings.KEYCLOAK_ID}/sync?action=triggerChangedUsersSync'
-        res = requests.post(url=url, headers=headers)
-        return res
-
-    def create_project_realm_roles(self, project_roles, code):
-        access_token = self.token['access_token']
-        headers = {
-            'Authorization': 'Bearer ' + access_token
-        }
-        for role in project_roles:
-            payload = {
-                "name": "{}-{}".format(code, role)
-            }
-            url = f'{ConfigSettings.KEYCLOAK_SERVER_URL}admin/realms/{ConfigSettings.KEYCLOAK_REALM}/roles'
-            res = requests.post(url=url, headers=headers, json=payload)
-            if res.status_code != 201:
-                return res
-        return 'created'
-
-    def delete_role_of_user(self, userid, role_name):
-        access_token = self.token['access_token']
-        headers = {
-            'Authorization': 'Bearer ' + access_token
+    async def update_user(self, userid, payload):
+        return await self.request('PUT', f'users/{userid}', expected_code=204, json=payload)
+
+    # Groups
+    async def get_group_by_path(self, path):
+        groups = await self.fetch_all('groups')
+        return next((group for group in groups if group['path'] == path), None)
+
+    async def create_group(self, payload):
+        return await self.request('POST', 'groups', expected_code=201, json=payload)
+
+    async def group_user_add(self, userid, group_id):
+        return await self.request('PUT', f'users/{userid}/groups/{group_id}', expected_code=204)
+
+    async def group_user_remove(self, userid, group_id):
+        return await self.request('DELETE', f'users/{userid}/groups/{group_id}', expected_code=204)
+
+    # Realm role by name, from the role index of the worker
+    async def get_realm_role(self, role_name):
+        return await realm_roles.get(self, role_name)
+
+    # Assign role, the members of the role are fetched again on the next request
+    async def assign_user_role(self, userid, role_name):
+        try:
+            return await self.map_user_role(userid, role_name)
+        finally:
+            role_members.invalidate(self, role_name)
+
+    # a role deleted and created again since it was indexed is looked up once more
+    async def map_user_role(self, userid, role_name):
+        path = f'users/{userid}/role-mappings/realm'
+        find_role = await self.get_realm_role(role_name)
+        try:
+            return await self.request('POST', path, expected_code=204, json=[find_role])
+        except KeycloakGetError as e:
+            if e.response_code != 404:
+                raise
+        realm_roles.discard(self, role_name)
+        find_role = await self.get_realm_role(role_name)
+        return await self.request('POST', path, expected_code=204, json=[find_role])
+
+    async def sync_user_trigger(self):
+        return await self.send(
+            'POST',
+            f'user-storage/{ConfigSettings.KEYCLOAK_ID}/sync',
+            params={"action": "triggerChangedUsersSync"},
+        )
+
+    # create one realm role, a role that already exists counts as created
+    async def create_realm_role(self, role_name, semaphore):
+        async with semaphore:
+            res = await self.send('POST', 'roles', json={"name": role_name})
+            if res.status_code not in (201, 409):
+                return res.text
+            realm_roles.put(self, await self.request('GET', f'roles/{role_name}'))
+        return 'created' if res.status_code == 201 else 'exists'
+
+    # result of each role, so that a failed project creation can be retried as is
+    async def create_project_realm_roles(self, project_roles, code):
+        role_names = list(dict.fromkeys("{}-{}".format(code, role) for role in project_roles))
+        semaphore = asyncio.Semaphore(ConfigSettings.KEYCLOAK_ROLE_CREATE_CONCURRENCY)
+        results = await asyncio.gather(
+            *[self.create_realm_role(role_name, semaphore) for role_name in role_names], return_exceptions=True
+        )
+        return {
+            role_name: str(result) if isinstance(result, Exception) else result
+            for role_name, result in zip(role_names, results)
         }
-        realm_roles = self.keycloak_admin.get_realm_roles()
-        find_role = [
-            role for role in realm_roles if role['name'] == role_name][0]
-        url = f'{ConfigSettings.KEYCLOAK_SERVER_URL}admin/realms/{self.realm_name}/users/{userid}/role-mappings/realm'
+
+    async def delete_role_of_user(self, userid, role_name):
+        find_role = await self.get_realm_role(role_name)
         data = [
             find_role
         ]
-        delete_res = requests.delete(url, json=data, headers=headers)
+        delete_res = await self.send('DELETE', f'users/{userid}/role-mappings/realm', json=data)
+        if delete_res.status_code == 404:
+            realm_roles.discard(self, role_name)
+            data = [await self.get_realm_role(role_name)]
+            delete_res = await self.send('DELETE', f'users/{userid}/role-mappings/realm', json=data)
+        role_members.invalidate(self, role_name)
         return delete_res
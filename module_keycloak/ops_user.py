@@ -18,33 +18,72 @@
 # permissions and limitations under the Licence.
 # 
 
-from keycloak import KeycloakOpenID
+from keycloak.exceptions import KeycloakGetError
+from keycloak.exceptions import raise_error_from_response
+from keycloak.urls_patterns import URL_TOKEN
+from keycloak.urls_patterns import URL_USERINFO
+from starlette.concurrency import run_in_threadpool
 
 from config import ConfigSettings
+from module_keycloak.openid_clients import OpenIDClients
+from module_keycloak.tokens import UnknownSigningKey
+from resources.http_clients import http_clients
+
+openid_clients = OpenIDClients(ConfigSettings.KEYCLOAK_SERVER_URL, ConfigSettings.KEYCLOAK_WELL_KNOWN_TTL)
 
 
 class OperationsUser:
     def __init__(self, client_id, realm_name, client_secret_key):
-        self.keycloak_openid = KeycloakOpenID(
-            server_url=ConfigSettings.KEYCLOAK_SERVER_URL,
-            client_id=client_id,
-            realm_name=realm_name,
-            client_secret_key=client_secret_key,
-        )
-        self.config_well_know = self.keycloak_openid.well_know()
+        # the OpenID client and its discovery document are shared by the requests of the worker
+        self.shared_client = openid_clients.get(client_id, realm_name, client_secret_key)
+        self.keycloak_openid = self.shared_client.keycloak_openid
+        self.token_verifier = self.shared_client.token_verifier
         self.token = ""
 
-    # Get Token
-    def get_token(self, username, password):
-        self.token = self.keycloak_openid.token(username, password)
+    # Discovery document, loaded at startup; fetched on first use otherwise, so better read from the threadpool
+    @property
+    def config_well_know(self):
+        return self.shared_client.well_known
+
+    @property
+    def client(self):
+        return http_clients.get('keycloak')
+
+    def _url(self, url_pattern):
+        return self.keycloak_openid.connection.base_url + url_pattern.format(
+            **{"realm-name": self.keycloak_openid.realm_name}
+        )
+
+    async def _token_request(self, payload):
+        payload["client_id"] = self.keycloak_openid.client_id
+        if self.keycloak_openid.client_secret_key:
+            payload["client_secret"] = self.keycloak_openid.client_secret_key
+        response = await self.client.post(self._url(URL_TOKEN), data=payload)
+        self.token = raise_error_from_response(response, KeycloakGetError)
         return self.token
 
+    # Get Token
+    async def get_token(self, username, password):
+        return await self._token_request({"username": username, "password": password, "grant_type": "password"})
+
     # Get Userinfo
-    def get_userinfo(self):
-        userinfo = self.keycloak_openid.userinfo(self.token['access_token'])
-        return userinfo
+    async def get_userinfo(self):
+        response = await self.client.get(
+            self._url(URL_USERINFO), headers={"Authorization": "Bearer " + self.token['access_token']}
+        )
+        return raise_error_from_response(response, KeycloakGetError)
+
+    # Claims of the access token, verified locally, or the userinfo when the signing key cannot be found
+    async def get_token_claims(self):
+        try:
+            return await run_in_threadpool(self.token_verifier.verify, self.token['access_token'])
+        except UnknownSigningKey:
+            return await self.get_userinfo()
+
+    # Verify any token of the realm locally, may fetch the realm keys so better called from the threadpool
+    def verify_token(self, token, audience=None):
+        return self.token_verifier.verify(token, audience)
 
     # Refresh token
-    def get_refresh_token(self, token):
-        self.token = self.keycloak_openid.refresh_token(token)
-        return self.token
+    async def get_refresh_token(self, token):
+        return await self._token_request({"refresh_token": token, "grant_type": "refresh_token"})
@@ -0,0 +1,111 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import time
+from typing import Dict
+from typing import Tuple
+
+# (server_url, realm_name)
+RealmKey = Tuple[str, str]
+
+
+class RealmRoleIndex:
+    """Realm roles by name, shared by the admin operations of the worker.
+
+    The roles of a realm are listed once and kept for ``ttl`` seconds, concurrent requests share one listing. A name
+    missing from the index is looked up on its own and added, so roles created by another worker are found without
+    listing the realm again.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self._ttl = ttl
+        # realm -> (name -> RoleRepresentation, time it was listed)
+        self._roles: Dict[RealmKey, Tuple[Dict[str, dict], float]] = {}
+        self._pending: Dict[RealmKey, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def _key(admin) -> RealmKey:
+        return admin.server_url, admin.realm_name
+
+    async def _load(self, admin) -> Dict[str, dict]:
+        key = self._key(admin)
+        try:
+            roles = {role['name']: role for role in await admin.request('GET', 'roles')}
+        finally:
+            self._pending.pop(key, None)
+        self._roles[key] = (roles, time.time())
+        self.loads += 1
+        return roles
+
+    async def _index(self, admin) -> Dict[str, dict]:
+        key = self._key(admin)
+        roles, loaded_at = self._roles.get(key, (None, 0))
+        if roles is not None and time.time() - loaded_at < self._ttl:
+            return roles
+        pending = self._pending.get(key)
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending[key] = asyncio.ensure_future(self._load(admin))
+        return await asyncio.shield(pending)
+
+    async def get(self, admin, name: str) -> dict:
+        """Return the role named ``name``, raises KeycloakGetError when the realm has no such role."""
+
+        roles = await self._index(admin)
+        role = roles.get(name)
+        if role is not None:
+            self.hits += 1
+            return role
+        self.misses += 1
+        role = await admin.request('GET', f'roles/{name}')
+        roles[name] = role
+        return role
+
+    def put(self, admin, role: dict) -> None:
+        roles, _ = self._roles.get(self._key(admin), (None, 0))
+        if roles is not None:
+            roles[role['name']] = role
+
+    def discard(self, admin, name: str) -> None:
+        roles, _ = self._roles.get(self._key(admin), (None, 0))
+        if roles is not None:
+            roles.pop(name, None)
+        self.invalidated += 1
+
+    def stats(self) -> dict:
+        now = time.time()
+        lookups = self.hits + self.misses
+        return {
+            'realms': [
+                {'realm': realm_name, 'roles': len(roles), 'age': now - loaded_at}
+                for (_, realm_name), (roles, loaded_at) in list(self._roles.items())
+            ],
+            'ttl': self._ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+            'loads': self.loads,
+            'invalidated': self.invalidated,
+        }
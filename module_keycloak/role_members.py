@@ -0,0 +1,137 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+
+_logger = SrvLoggerFactory('role_members').get_logger()
+
+# (server_url, realm_name, role_name)
+RoleKey = Tuple[str, str, str]
+
+
+class RoleMembersCache:
+    """Members of the realm roles, shared by the admin operations of the worker.
+
+    The members of a role are served for ``ttl`` seconds. Until ``max_stale`` seconds they are still served while a
+    single request refreshes them in the background, after that the request waits for the members. The members of a
+    role this worker assigns or removes are fetched again on the next request, other workers see the change within
+    ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl: float = 30, max_stale: float = 300):
+        self._ttl = ttl
+        self._max_stale = max_stale
+        # role -> (members, time they were fetched)
+        self._members: Dict[RoleKey, Tuple[List[dict], float]] = {}
+        self._pending: Dict[RoleKey, asyncio.Future] = {}
+        # bumped by each invalidation, members fetched before it are not kept
+        self._generations: Dict[RoleKey, int] = defaultdict(int)
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.failures = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def _key(admin, role_name: str) -> RoleKey:
+        return admin.server_url, admin.realm_name, role_name
+
+    async def _fetch(self, admin, role_name: str) -> List[dict]:
+        key = self._key(admin, role_name)
+        generation = self._generations[key]
+        try:
+            members = await admin.request('GET', f'roles/{role_name}/users')
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            if self._pending.get(key) is asyncio.current_task():
+                del self._pending[key]
+        self.fetches += 1
+        if self._generations[key] == generation:
+            self._members[key] = (members, time.time())
+        return members
+
+    def _refresh(self, admin, role_name: str) -> asyncio.Future:
+        key = self._key(admin, role_name)
+        pending = self._pending.get(key)
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending[key] = asyncio.ensure_future(self._fetch(admin, role_name))
+        return pending
+
+    async def get(self, admin, role_name: str) -> List[dict]:
+        """Members of the role, the list is shared and must not be modified."""
+
+        members, fetched_at = self._members.get(self._key(admin, role_name), (None, 0))
+        age = time.time() - fetched_at
+        if members is None or age >= self._max_stale:
+            self.misses += 1
+            return await asyncio.shield(self._refresh(admin, role_name))
+        if age >= self._ttl:
+            self.stale_hits += 1
+            self._refresh(admin, role_name).add_done_callback(self._log_failure)
+        else:
+            self.hits += 1
+        return members
+
+    def invalidate(self, admin, role_name: str) -> None:
+        """Forget the members of a role after assigning or removing it."""
+
+        key = self._key(admin, role_name)
+        self._generations[key] += 1
+        self._members.pop(key, None)
+        self._pending.pop(key, None)
+        self.invalidated += 1
+
+    def invalidate_realm(self, admin) -> None:
+        """Forget the members of every role of the realm, e.g. after deleting a user."""
+
+        for key in set(self._members) | set(self._pending):
+            if key[:2] == (admin.server_url, admin.realm_name):
+                self.invalidate(admin, key[2])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'roles': len(self._members),
+            'ttl': self._ttl,
+            'max_stale': self._max_stale,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.stale_hits) / lookups if lookups else 0,
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'invalidated': self.invalidated,
+        }
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            _logger.error(f'Error refreshing the members of a role - {future.exception()}')
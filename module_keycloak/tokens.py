@@ -0,0 +1,174 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+from jose import JWTError
+from jose import jwt
+
+# never let the token header pick a symmetric algorithm, the realm keys are public
+_ASYMMETRIC_ALGORITHMS = ['RS256', 'RS384', 'RS512', 'PS256', 'PS384', 'PS512', 'ES256', 'ES384', 'ES512']
+
+
+class InvalidToken(Exception):
+    """The token is malformed, badly signed, expired or issued for someone else."""
+
+
+class UnknownSigningKey(InvalidToken):
+    """The token is signed with a key that is not in the cached JWKS."""
+
+
+class JWKSCache:
+    """Signing keys of a realm by ``kid``, fetched from the certs endpoint and kept for ``ttl`` seconds.
+
+    A token signed with an unknown key makes the cache fetch the keys again, at most once every
+    ``min_refresh_interval`` seconds so tokens with made-up key ids cannot hammer Keycloak.
+    """
+
+    def __init__(self, fetch: Callable[[], dict], ttl: int = 3600, min_refresh_interval: int = 10):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._min_refresh_interval = min_refresh_interval
+        self._keys: Dict[str, dict] = {}
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self._fetched_at >= self._ttl
+
+    def get(self, kid: Optional[str]) -> Optional[dict]:
+        """Return the key with this ``kid``, fetching the JWKS first when it is stale."""
+
+        if self.stale:
+            try:
+                self.refresh()
+            except Exception:
+                # keep verifying with the keys we have until the certs endpoint answers again
+                if not self._keys:
+                    raise
+        return self._keys.get(kid)
+
+    def get_or_refresh(self, kid: Optional[str]) -> Optional[dict]:
+        """Return the key with this ``kid``, fetching the JWKS again when the key is unknown.
+
+        Concurrent callers waiting for the same key share a single fetch.
+        """
+
+        key = self.get(kid)
+        if key is not None:
+            return key
+
+        with self._lock:
+            # the key may have arrived with the fetch another thread made while this one was waiting
+            key = self._keys.get(kid)
+            if key is None and time.time() - self._fetched_at >= self._min_refresh_interval:
+                self._load()
+                key = self._keys.get(kid)
+        return key
+
+    def refresh(self) -> None:
+        with self._lock:
+            # another thread may have fetched it while this one was waiting
+            if self.stale:
+                self._load()
+
+    def _load(self) -> None:
+        jwks = self._fetch()
+        self._keys = {key['kid']: key for key in jwks.get('keys', []) if 'kid' in key}
+        self._fetched_at = time.time()
+        self.refreshes += 1
+
+    def stats(self) -> dict:
+        return {'keys': sorted(self._keys), 'fetched_at': self._fetched_at, 'refreshes': self.refreshes}
+
+
+def _issued_to(claims: dict, audience: str) -> bool:
+    aud = claims.get('aud')
+    audiences = [aud] if isinstance(aud, str) else aud or []
+    return audience in audiences or claims.get('azp') == audience
+
+
+class TokenVerifier:
+    """Verify tokens of a realm in-process: signature against the JWKS, expiry and issuer.
+
+    Tokens without an expiry are rejected. When an audience is required, the token must list it in ``aud`` or have
+    been issued to it, per ``azp``: Keycloak only puts the client in ``aud`` with an audience mapper, by default the
+    access tokens of a client carry ``aud: account`` or no ``aud`` at all.
+    """
+
+    def __init__(self, jwks: JWKSCache, issuer: Callable[[], str], leeway: int = 30):
+        self.jwks = jwks
+        self._issuer = issuer
+        self._leeway = leeway
+        self.verified = 0
+        self.rejected = 0
+
+    def verify(self, token: str, audience: Optional[str] = None) -> dict:
+        """Return the claims of ``token``, checking the audience only when one is given."""
+
+        try:
+            claims = self._verify(token, audience)
+        except InvalidToken:
+            self.rejected += 1
+            raise
+        self.verified += 1
+        return claims
+
+    def _verify(self, token: str, audience: Optional[str]) -> dict:
+        try:
+            header = jwt.get_unverified_header(token)
+        except JWTError as e:
+            raise InvalidToken(f'malformed token: {e}')
+
+        kid = header.get('kid')
+        key = self.jwks.get_or_refresh(kid)
+        if key is None:
+            raise UnknownSigningKey(f'unknown signing key {kid}')
+
+        algorithms = [key['alg']] if 'alg' in key else _ASYMMETRIC_ALGORITHMS
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=algorithms,
+                issuer=self._issuer(),
+                options={
+                    'verify_aud': False,
+                    'require_exp': True,
+                    'verify_at_hash': False,
+                    'leeway': self._leeway,
+                },
+            )
+        except JWTError as e:
+            raise InvalidToken(str(e))
+
+        if audience is not None and not _issued_to(claims, audience):
+            raise InvalidToken('Invalid audience')
+        return claims
+
+    def stats(self) -> dict:
+        return {'verified': self.verified, 'rejected': self.rejected, 'jwks': self.jwks.stats()}
@@ -0,0 +1,102 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+from typing import Dict
+from typing import Iterable
+from typing import Tuple
+
+import httpx
+
+from config import ConfigSettings
+
+UPSTREAMS = ('keycloak', 'neo4j', 'email', 'utility')
+
+
+class HTTPClients:
+    """One pooled ``httpx.AsyncClient`` per upstream, shared by the requests of the worker to reuse its connections.
+
+    The clients are created by ``start`` when the app starts and closed by ``stop``. Connections belong to the event
+    loop that opened them, a client is created again when used from another loop, which only happens in tests.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 30,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 5,
+        http2: bool = False,
+    ):
+        self._timeout = timeout
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http2 = http2
+        # upstream -> (client, event loop it was created in)
+        self._clients: Dict[str, Tuple[httpx.AsyncClient, asyncio.AbstractEventLoop]] = {}
+
+    def _create(self) -> httpx.AsyncClient:
+        # http2 needs the h2 package, httpx raises an ImportError naming it when missing
+        return httpx.AsyncClient(timeout=self._timeout, limits=self._limits, http2=self._http2)
+
+    def get(self, upstream: str) -> httpx.AsyncClient:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        client, client_loop = self._clients.get(upstream, (None, None))
+        if client is None or client.is_closed or client_loop is not loop:
+            client = self._create()
+            self._clients[upstream] = (client, loop)
+        return client
+
+    def stats(self) -> dict:
+        return {
+            'upstreams': sorted(self._clients),
+            'max_connections': self._limits.max_connections,
+            'max_keepalive_connections': self._limits.max_keepalive_connections,
+            'keepalive_expiry': self._limits.keepalive_expiry,
+            'http2': self._http2,
+            'timeout': self._timeout,
+        }
+
+    async def start(self, upstreams: Iterable[str] = UPSTREAMS) -> None:
+        for upstream in upstreams:
+            self.get(upstream)
+
+    async def stop(self) -> None:
+        loop = asyncio.get_running_loop()
+        clients, self._clients = self._clients, {}
+        for client, client_loop in clients.values():
+            if client_loop is loop:
+                await client.aclose()
+
+
+http_clients = HTTPClients(
+    timeout=ConfigSettings.UPSTREAM_TIMEOUT,
+    max_connections=ConfigSettings.UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive_connections=ConfigSettings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=ConfigSettings.UPSTREAM_KEEPALIVE_EXPIRY,
+    http2=ConfigSettings.UPSTREAM_HTTP2,
+)
@@ -0,0 +1,98 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import base64
+import json
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+# largest page a client can ask for with ``limit``
+MAX_LIMIT = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Cursor(NamedTuple):
+    """Position of a keyset paginated listing, after the item having ``value`` and ``tie`` in the sort order.
+
+    Items are ordered by value then tie, the tie being unique, with None values last. A descending order is the
+    reverse, None values first.
+    """
+
+    order_by: str
+    descending: bool
+    value: Any
+    tie: Any
+
+
+def encode_cursor(cursor: Cursor) -> str:
+    data = json.dumps(list(cursor), default=lambda value: value.isoformat())
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """Read a cursor sent back by a client, datetimes are left as ISO strings."""
+
+    try:
+        order_by, descending, value, tie = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f'Invalid cursor {cursor}') from e
+    return Cursor(order_by, bool(descending), value, tie)
+
+
+def _key(value, tie) -> tuple:
+    return value is None, '' if value is None else value, tie
+
+
+def keyset_page(
+    items: List[Any],
+    order_by: str,
+    descending: bool,
+    value: Callable[[Any], Any],
+    tie: Callable[[Any], Any],
+    after: Optional[Cursor],
+    limit: int,
+) -> Tuple[List[Any], Optional[Cursor]]:
+    """The ``limit`` items following ``after``, and the cursor of the next page when there is one.
+
+    Used where the items can only be fetched all at once, the database applies the same order itself.
+    """
+
+    if limit < 1:
+        raise ValueError(f'Invalid limit {limit}, pages hold at least one item')
+
+    def key(item):
+        return _key(value(item), tie(item))
+
+    if after is not None:
+        bound = _key(after.value, after.tie)
+        items = [item for item in items if (key(item) < bound if descending else key(item) > bound)]
+    items = sorted(items, key=key, reverse=descending)
+    page = items[:limit]
+    if len(items) <= limit or not page:
+        return page, None
+    return page, Cursor(order_by, descending, value(page[-1]), tie(page[-1]))
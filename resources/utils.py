@@ -20,10 +20,10 @@
 
 from datetime import datetime
 
-import requests
 from pytz import timezone
 
 from config import ConfigSettings
+from resources.http_clients import http_clients
 
 
 def mask_email(email):
@@ -39,9 +39,9 @@ def get_formatted_datetime(tz):
     return now.strftime("%Y-%m-%d, %-I:%M%p (%Z)")
 
 
-def fetch_geid():
+async def fetch_geid():
     entity_id_url = ConfigSettings.UTILITY_SERVICE + f"/v1/utility/id"
-    response = requests.get(entity_id_url)
+    response = await http_clients.get('utility').get(entity_id_url)
     if response.status_code != 200:
         raise Exception('Entity id fetch failed: ' + entity_id_url + ": " + str(response.text))
     geid = response.json()['result']
@@ -20,6 +20,7 @@
 
 import ldap
 from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from starlette.concurrency import run_in_threadpool
 
 from config import ConfigSettings
 
@@ -136,3 +137,31 @@ class LdapClient:
         if not user_found:
             return None, None
         return user_found
+
+
+class AsyncLdapClient:
+    """LdapClient for the async handlers, python-ldap blocks so every call runs in the threadpool."""
+
+    def __init__(self):
+        self.client = LdapClient()
+
+    async def connect(self, dn_code):
+        return await run_in_threadpool(self.client.connect, dn_code)
+
+    async def disconnect(self):
+        return await run_in_threadpool(self.client.disconnect)
+
+    async def add_user_to_group(self, user_dn):
+        return await run_in_threadpool(self.client.add_user_to_group, user_dn)
+
+    async def remove_user_from_group(self, user_dn):
+        return await run_in_threadpool(self.client.remove_user_from_group, user_dn)
+
+    async def get_all_users(self):
+        return await run_in_threadpool(self.client.get_all_users)
+
+    async def get_user_by_email(self, email):
+        return await run_in_threadpool(self.client.get_user_by_email, email)
+
+    async def get_user_by_username(self, username):
+        return await run_in_threadpool(self.client.get_user_by_username, username)
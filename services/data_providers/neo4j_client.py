@@ -18,9 +18,8 @@
 # permissions and limitations under the Licence.
 # 
 
-import requests
-
 from config import ConfigSettings
+from resources.http_clients import http_clients
 
 
 def catch_internal(func):
@@ -28,9 +27,9 @@ def catch_internal(func):
     decorator to catch internal server error.
     '''
 
-    def inner(*args, **kwargs):
+    async def inner(*args, **kwargs):
         try:
-            return func(*args, **kwargs)
+            return await func(*args, **kwargs)
         except Exception as e:
             return {
                 "error_msg": str(e),
@@ -50,57 +49,61 @@ class Neo4jClient(object):
             "code": 200,
         }
 
+    @property
+    def client(self):
+        return http_clients.get('neo4j')
+
     # Shared
     @catch_internal
-    def node_create(self, label, data):
-        response = requests.post(
+    async def node_create(self, label, data):
+        response = await self.client.post(
             ConfigSettings.NEO4J_SERVICE + f"nodes/{label}", json=data)
         result = self.result.copy()
         result["result"] = response.json()
         return result
 
     @catch_internal
-    def node_query(self, label, data):
-        response = requests.post(
+    async def node_query(self, label, data):
+        response = await self.client.post(
             ConfigSettings.NEO4J_SERVICE + f"nodes/{label}/query", json=data)
         result = self.result.copy()
         result["result"] = response.json()
         return result
 
     @catch_internal
-    def get_relation(self, start_id, end_id):
+    async def get_relation(self, start_id, end_id):
         relation_query = {"start_id": start_id, "end_id": end_id}
-        response = requests.get(
+        response = await self.client.get(
             ConfigSettings.NEO4J_SERVICE + f"relations", params=relation_query)
         result = self.result.copy()
         result["result"] = response.json()
         return result
 
     @catch_internal
-    def create_relation(self, start_id, end_id, label, properties={}):
+    async def create_relation(self, start_id, end_id, label, properties={}):
         payload = {"start_id": start_id, "end_id": end_id}
         if properties:
             payload['properties'] = properties
-        response = requests.post(
+        response = await self.client.post(
             ConfigSettings.NEO4J_SERVICE + f"relations/{label}", json=payload)
         result = self.result.copy()
         result["result"] = response.json()
         return result
 
     @catch_internal
-    def update_node(self, label, node_id, data):
-        response = requests.put(
+    async def update_node(self, label, node_id, data):
+        response = await self.client.put(
             ConfigSettings.NEO4J_SERVICE + f"nodes/{label}/node/{node_id}", json=data)
         result = self.result.copy()
         result["result"] = response.json()
         return result
 
     @catch_internal
-    def update_relation(self, start_id, end_id, label, properties={}):
+    async def update_relation(self, start_id, end_id, label, properties={}):
         payload = {"start_id": start_id, "end_id": end_id, "new_label": label}
         if properties:
             payload['properties'] = properties
-        response = requests.put(
+        response = await self.client.put(
             ConfigSettings.NEO4J_SERVICE + f"relations/{label}", json=payload)
         result = self.result.copy()
         result["result"] = response.json()
@@ -108,8 +111,8 @@ class Neo4jClient(object):
 
     # Datasets
 
-    def get_container_by_geid(self, geid):
-        response = self.node_query("Container", {"global_entity_id": geid})
+    async def get_container_by_geid(self, geid):
+        response = await self.node_query("Container", {"global_entity_id": geid})
         if not response.get("result"):
             if not response.get("error_msg"):
                 self.result["error_msg"] = "Container not found"
@@ -119,8 +122,8 @@ class Neo4jClient(object):
         self.result["result"] = response["result"][0]
         return self.result
 
-    def get_container_by_code(self, code):
-        response = self.node_query("Container", {"code": code})
+    async def get_container_by_code(self, code):
+        response = await self.node_query("Container", {"code": code})
         if not response.get("result"):
             if not response.get("error_msg"):
                 response["error_msg"] = "Container not found"
@@ -130,12 +133,12 @@ class Neo4jClient(object):
         response["result"] = dataset_node
         return response
 
-    def get_container_role(self, dataset_geid, user_id):
-        response = self.get_container_by_geid(dataset_geid)
+    async def get_container_role(self, dataset_geid, user_id):
+        response = await self.get_container_by_geid(dataset_geid)
         if response.get("error_msg"):
             return response
         dataset_node = response["result"]
-        relation = self.get_relation(user_id, dataset_node["id"])
+        relation = await self.get_relation(user_id, dataset_node["id"])
         if not relation["result"]:
             self.result["error_msg"] = "Role not found"
             self.result["code"] = 404
@@ -143,8 +146,8 @@ class Neo4jClient(object):
         self.result["result"] = relation["result"][0]['r']['type']
         return self.result
 
-    def get_container_from_folder(self, geid):
-        response = self.node_query("Folder", {"global_entity_id": geid})
+    async def get_container_from_folder(self, geid):
+        response = await self.node_query("Folder", {"global_entity_id": geid})
         if not response.get("result"):
             if not response.get("error_msg"):
                 self.result["error_msg"] = "Folder not found"
@@ -152,7 +155,7 @@ class Neo4jClient(object):
             return self.result
         folder_node = response["result"][0]
 
-        response = self.node_query(
+        response = await self.node_query(
             "Container", {"code": folder_node["project_code"]})
         if not response.get("result"):
             if not response.get("error_msg"):
@@ -163,8 +166,8 @@ class Neo4jClient(object):
         return self.result
 
     # Users
-    def get_user_by_email(self, email):
-        response = self.node_query("User", {"email": email})
+    async def get_user_by_email(self, email):
+        response = await self.node_query("User", {"email": email})
         if not response.get("result"):
             if not response.get("error_msg"):
                 response["error_msg"] = "User not found"
@@ -173,34 +176,34 @@ class Neo4jClient(object):
         response["result"] = response["result"][0]
         return response
 
-    def create_user(self, user_data):
-        response = self.node_create("User", user_data)
+    async def create_user(self, user_data):
+        response = await self.node_create("User", user_data)
         response["result"] = response["result"][0]
         return response
 
-    def update_user(self, node_id, user_data):
+    async def update_user(self, node_id, user_data):
         if "time_lastmodified" in user_data:
             # auto managed by neo4j, otherwise will throws the error
             del user_data['time_lastmodified']
-        response = self.update_node("User", node_id, user_data)
+        response = await self.update_node("User", node_id, user_data)
         response["result"] = response["result"]
         return response
 
-    def get_user_linked_projects(self, user_id):
+    async def get_user_linked_projects(self, user_id):
         url = ConfigSettings.NEO4J_SERVICE + "relations/query"
         payload = {
             "start_label": "User",
             "end_label": "Container",
             "start_params": {"id": user_id}
         }
-        response = requests.post(
+        response = await self.client.post(
             url=url,
             json=payload
         )
         return response
 
-    def get_user_by_geid(self, geid):
-        response = self.node_query("User", {"global_entity_id": str(geid)})
+    async def get_user_by_geid(self, geid):
+        response = await self.node_query("User", {"global_entity_id": str(geid)})
         if not response.get("result"):
             if not response.get("error_msg"):
                 response["error_msg"] = "User not found"
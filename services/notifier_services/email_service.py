@@ -18,16 +18,13 @@
 # permissions and limitations under the Licence.
 # 
 
-import json
-
-import requests
-
 from config import ConfigSettings
 from models.service_meta_class import MetaService
+from resources.http_clients import http_clients
 
 
 class SrvEmail(metaclass=MetaService):
-    def send(self, subject, receiver, sender, content="", msg_type="plain", template=None, template_kwargs={}):
+    async def send(self, subject, receiver, sender, content="", msg_type="plain", template=None, template_kwargs={}):
         url = ConfigSettings.EMAIL_SERVICE
         payload = {
             "subject": subject,
@@ -40,8 +37,8 @@ class SrvEmail(metaclass=MetaService):
         if template:
             payload["template"] = template
             payload["template_kwargs"] = template_kwargs
-        res = requests.post(
+        res = await http_clients.get('email').post(
             url=url,
             json=payload
         )
-        return json.loads(res.text)
+        return res.json()
@@ -0,0 +1,539 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from keycloak.exceptions import KeycloakGetError
+from sqlalchemy import BigInteger
+from sqlalchemy import Boolean
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from module_keycloak.ops_admin import OperationsAdmin
+from resources.pagination import Cursor
+from resources.pagination import InvalidCursor
+from resources.pagination import decode_cursor
+from services.user_directory.events import changed_users
+
+_logger = SrvLoggerFactory('user_directory').get_logger()
+
+# see migration 9d2f6b3a8c41 for the indexes
+user_directory_table = Table(
+    'user_directory',
+    MetaData(),
+    Column('id', String(), primary_key=True),
+    Column('username', String(), nullable=False, unique=True),
+    Column('first_name', String()),
+    Column('last_name', String()),
+    Column('email', String()),
+    Column('time_created', DateTime()),
+    Column('last_login', String()),
+    Column('status', String(), nullable=False),
+    Column('is_admin', Boolean(), nullable=False),
+    Column('synced_at', DateTime(), nullable=False),
+    schema='pilot_user_directory',
+)
+
+# single row shared by the workers, see migration 5b8e2c7d1a93
+user_directory_state_table = Table(
+    'user_directory_state',
+    MetaData(),
+    Column('id', Integer(), primary_key=True, autoincrement=False),
+    # time of the latest keycloak event applied, in milliseconds
+    Column('event_time', BigInteger()),
+    Column('poll_claimed_at', DateTime()),
+    Column('polled_at', DateTime()),
+    Column('reconcile_claimed_at', DateTime()),
+    Column('reconciled_at', DateTime()),
+    schema='pilot_user_directory',
+)
+
+_table = user_directory_table
+_state = user_directory_state_table
+
+# columns compared by the reconciliation
+_COLUMNS = ['username', 'first_name', 'last_name', 'email', 'time_created', 'last_login', 'status', 'is_admin']
+
+# order_by of /v1/users, the names of the keycloak representation are still accepted
+SORT_COLUMNS = {
+    'username': 'username',
+    'email': 'email',
+    'first_name': 'first_name',
+    'firstName': 'first_name',
+    'last_name': 'last_name',
+    'lastName': 'last_name',
+    'time_created': 'time_created',
+    'createdTimestamp': 'time_created',
+    'last_login': 'last_login',
+    'status': 'status',
+}
+
+# keep the inserts of a statement to a reasonable size
+_CHUNK_SIZE = 500
+
+# users fetched from keycloak at the same time when applying events
+_CONCURRENCY = 10
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return None if value is None else (value - _EPOCH).total_seconds()
+
+
+def _checksum(row) -> str:
+    return hashlib.sha1(json.dumps([row[column] for column in _COLUMNS], default=str).encode()).hexdigest()
+
+
+def _attribute(user: dict, name: str, default: Optional[str] = None) -> Optional[str]:
+    """First value of a keycloak user attribute, keycloak holds every attribute as a list of strings."""
+
+    value = (user.get('attributes') or {}).get(name)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return default if value is None else value
+
+
+def to_row(user: dict, platform_admins: Set[str]) -> dict:
+    """Directory row of a keycloak user representation."""
+
+    return {
+        'id': user.get('id'),
+        'username': user['username'],
+        'first_name': user.get('firstName'),
+        'last_name': user.get('lastName'),
+        'email': user.get('email'),
+        'time_created': datetime.fromtimestamp(user['createdTimestamp'] // 1000),
+        'last_login': _attribute(user, 'last_login'),
+        'status': _attribute(user, 'status', 'active'),
+        'is_admin': user['username'] in platform_admins or user['username'] == 'admin',
+    }
+
+
+def _chunks(items: list) -> Iterable[list]:
+    for start in range(0, len(items), _CHUNK_SIZE):
+        yield items[start:start + _CHUNK_SIZE]
+
+
+def read_cursor(cursor: str) -> Cursor:
+    """Cursor of a /v1/users page, sorted by one of the directory columns."""
+
+    after = decode_cursor(cursor)
+    if after.order_by not in SORT_COLUMNS.values():
+        raise InvalidCursor(f'Invalid cursor {cursor}')
+    if after.order_by == 'time_created' and after.value is not None:
+        try:
+            return after._replace(value=datetime.fromisoformat(after.value))
+        except (ValueError, TypeError) as e:
+            raise InvalidCursor(f'Invalid cursor {cursor}') from e
+    return after
+
+
+def _conditions(username: Optional[str], email: Optional[str], status: Optional[str], exact: bool) -> list:
+    """Like keycloak, username and email match case-insensitively on any part of the value unless ``exact`` is set."""
+
+    conditions = []
+    for column, value in (('username', username), ('email', email)):
+        if value:
+            column = func.lower(_table.c[column])
+            conditions.append(column == value.lower() if exact else column.contains(value.lower(), autoescape=True))
+    if status:
+        conditions.append(_table.c.status == status)
+    return conditions
+
+
+def _order(column, descending: bool) -> list:
+    """The order of keyset_page, None values last and the id breaking ties, all reversed when descending.
+
+    It is the order of the indexes on (column, id), usernames are unique.
+    """
+
+    order = [column.desc().nullsfirst() if descending else column.asc().nullslast()]
+    if column is not _table.c.username:
+        order.append(_table.c.id.desc() if descending else _table.c.id.asc())
+    return order
+
+
+def _after(column, after: Cursor):
+    """The rows following the cursor in the order of _order."""
+
+    value, tie = after.value, after.tie
+    if column is _table.c.username:
+        return column < value if after.descending else column > value
+    if after.descending:
+        if value is None:
+            return or_(column.isnot(None), _table.c.id < tie)
+        return and_(column.isnot(None), or_(column < value, and_(column == value, _table.c.id < tie)))
+    if value is None:
+        return and_(column.is_(None), _table.c.id > tie)
+    return or_(column.is_(None), column > value, and_(column == value, _table.c.id > tie))
+
+
+def to_user(row) -> dict:
+    """User as returned by /v1/users."""
+
+    return {
+        'username': row['username'],
+        'first_name': row['first_name'],
+        'last_name': row['last_name'],
+        'email': row['email'],
+        'time_created': row['time_created'].strftime('%Y-%m-%dT%H:%M:%S'),
+        'last_login': row['last_login'],
+        'status': row['status'],
+        'role': 'admin' if row['is_admin'] else 'member',
+    }
+
+
+class UserDirectory:
+    """Copy of the keycloak users of a realm in postgres, answering the listing, search and sort of /v1/users.
+
+    The admin and user events of the realm are polled every ``poll_interval`` seconds and the users they name are
+    fetched again, created, updated or deleted. Every ``reconcile_interval`` seconds the whole realm is listed and
+    compared with the copy by checksum, which also makes the first copy and catches the events keycloak did not save.
+    Workers share the copy, the polling and the reconciliation are claimed by one worker at a time. Listings are left
+    to keycloak while the copy is older than ``max_staleness`` seconds.
+    """
+
+    def __init__(
+        self,
+        engine_factory: Callable,
+        realm_name: str,
+        poll_interval: float = 5,
+        reconcile_interval: float = 900,
+        max_staleness: float = 3600,
+        enabled: bool = True,
+    ):
+        self._engine_factory = engine_factory
+        self._realm_name = realm_name
+        self._poll_interval = poll_interval
+        self._reconcile_interval = reconcile_interval
+        self._max_staleness = max_staleness
+        self._enabled = enabled
+        self._syncer = None
+        # shared by the workers, as last read from the state row
+        self.synced_at: Optional[float] = None
+        self.event_time: Optional[float] = None
+        self.polls = 0
+        self.events = 0
+        self.users_applied = 0
+        self.reconciliations = 0
+        self.drift = 0
+        self.failures = 0
+        self.last_reconcile_duration: Optional[float] = None
+        self.served = 0
+        self.fallbacks = 0
+
+    def ready(self) -> bool:
+        return self._enabled and self.synced_at is not None and time.time() - self.synced_at < self._max_staleness
+
+    def _read_state(self):
+        with self._engine_factory().connect() as conn:
+            return conn.execute(select([_state]).where(_state.c.id == 1)).fetchone()
+
+    def _claim(self, column: str, interval: float) -> bool:
+        """Take the polling or the reconciliation unless a worker did within the interval."""
+
+        now = datetime.utcnow()
+        claimed = or_(_state.c[column].is_(None), _state.c[column] <= now - timedelta(seconds=interval))
+        with self._engine_factory().begin() as conn:
+            result = conn.execute(_state.update().where(and_(_state.c.id == 1, claimed)).values({column: now}))
+        return result.rowcount == 1
+
+    def _release(self, column: str) -> None:
+        """Let the next worker retry at once, after a failure."""
+
+        with self._engine_factory().begin() as conn:
+            conn.execute(_state.update().where(_state.c.id == 1).values({column: None}))
+
+    def _checksums(self) -> Dict[str, str]:
+        with self._engine_factory().connect() as conn:
+            return {row['id']: _checksum(row) for row in conn.execute(select([_table]))}
+
+    def apply(self, rows: List[dict], deleted: Iterable[str], state: dict) -> None:
+        """Write the users and delete the others in a single transaction, together with the state."""
+
+        synced_at = datetime.utcnow()
+        rows = [dict(row, synced_at=synced_at) for row in rows]
+        # the new row of a user replaces the old one, a username can move to another id
+        ids = list(deleted) + [row['id'] for row in rows]
+        with self._engine_factory().begin() as conn:
+            for chunk in _chunks(ids):
+                conn.execute(_table.delete().where(_table.c.id.in_(chunk)))
+            for chunk in _chunks(rows):
+                conn.execute(_table.insert(), chunk)
+            if state:
+                conn.execute(_state.update().where(_state.c.id == 1).values(state))
+
+    def _track(self, state) -> None:
+        if state is not None:
+            fresh = [value for value in (state['polled_at'], state['reconciled_at']) if value is not None]
+            self.synced_at = _timestamp(max(fresh)) if fresh else None
+            self.event_time = None if state['event_time'] is None else state['event_time'] / 1000
+
+    async def _fetch_user(self, admin_client, user_id: str, semaphore) -> Optional[dict]:
+        async with semaphore:
+            try:
+                user = await admin_client.get_user_info(user_id)
+            except KeycloakGetError as e:
+                if e.response_code == 404:
+                    return None
+                raise
+            roles = await admin_client.request('GET', f'users/{user_id}/role-mappings/realm')
+        platform_admins = {user['username']} if any(role['name'] == 'platform-admin' for role in roles) else set()
+        return to_row(user, platform_admins)
+
+    async def poll(self, since: int) -> None:
+        """Apply the events after ``since``, in milliseconds, by fetching again the users they name."""
+
+        admin_client = OperationsAdmin(self._realm_name)
+        polled_at = datetime.utcnow()
+        user_ids, latest, events = await changed_users(admin_client, since)
+        semaphore = asyncio.Semaphore(_CONCURRENCY)
+        user_ids = sorted(user_ids)
+        rows = await asyncio.gather(*[self._fetch_user(admin_client, user_id, semaphore) for user_id in user_ids])
+        deleted = [user_id for user_id, row in zip(user_ids, rows) if row is None]
+        rows = [row for row in rows if row is not None]
+        await run_in_threadpool(self.apply, rows, deleted, {'event_time': latest, 'polled_at': polled_at})
+        self.polls += 1
+        self.events += events
+        self.users_applied += len(user_ids)
+
+    async def reconcile(self, event_time: Optional[int]) -> None:
+        """List every user of the realm and write the ones that differ from the copy."""
+
+        started = time.time()
+        admin_client = OperationsAdmin(self._realm_name)
+        users = await admin_client.get_users()
+        platform_admins = {user['username'] for user in await admin_client.fetch_all('roles/platform-admin/users')}
+        rows = {user['id']: to_row(user, platform_admins) for user in users}
+        checksums = await run_in_threadpool(self._checksums)
+        changed = [row for user_id, row in rows.items() if checksums.get(user_id) != _checksum(row)]
+        deleted = [user_id for user_id in checksums if user_id not in rows]
+
+        state = {'reconciled_at': datetime.utcfromtimestamp(started)}
+        if event_time is None:
+            # the events are applied from the first listing on
+            state['event_time'] = int(started * 1000)
+        await run_in_threadpool(self.apply, changed, deleted, state)
+        self.reconciliations += 1
+        self.drift += len(changed) + len(deleted)
+        self.last_reconcile_duration = time.time() - started
+        _logger.info(
+            f'{len(rows)} users reconciled with keycloak in {self.last_reconcile_duration:.1f}s, '
+            f'{len(changed)} written and {len(deleted)} deleted'
+        )
+
+    async def refresh(self) -> None:
+        """Reconcile or poll the events, when no other worker did within the interval."""
+
+        state = await run_in_threadpool(self._read_state)
+        self._track(state)
+        if await run_in_threadpool(self._claim, 'reconcile_claimed_at', self._reconcile_interval):
+            claimed, sync = 'reconcile_claimed_at', self.reconcile
+        elif state['event_time'] is None:
+            # the first reconciliation is still running on another worker
+            return
+        elif await run_in_threadpool(self._claim, 'poll_claimed_at', self._poll_interval):
+            claimed, sync = 'poll_claimed_at', self.poll
+        else:
+            return
+        try:
+            await sync(state['event_time'])
+        except Exception:
+            await run_in_threadpool(self._release, claimed)
+            raise
+        self._track(await run_in_threadpool(self._read_state))
+
+    def list_users(
+        self,
+        username: Optional[str],
+        email: Optional[str],
+        status: Optional[str],
+        exact: bool,
+        order_by: Optional[str],
+        order_type: str,
+        page: int,
+        page_size: int,
+    ) -> Tuple[int, List[dict]]:
+        """Return the total number of matching users and one page of them."""
+
+        conditions = _conditions(username, email, status, exact)
+        column = _table.c[SORT_COLUMNS.get(order_by, 'username')]
+
+        with self._engine_factory().connect() as conn:
+            total = conn.execute(select([func.count()]).select_from(_table).where(and_(*conditions))).scalar()
+            query = select([_table]).where(and_(*conditions)).order_by(*_order(column, order_type == 'desc'))
+            rows = conn.execute(query.offset(page * page_size).limit(page_size)).fetchall()
+        return total, [to_user(row) for row in rows]
+
+    def list_users_after(
+        self,
+        username: Optional[str],
+        email: Optional[str],
+        status: Optional[str],
+        exact: bool,
+        order_by: Optional[str],
+        order_type: str,
+        after: Optional[Cursor],
+        limit: int,
+    ) -> Tuple[Optional[int], List[dict], Optional[Cursor]]:
+        """Return the matching users following ``after`` and the cursor of the next page, if any.
+
+        A page costs the same whatever its depth. The order is the one of the cursor, the total number of matching
+        users is only counted for the first page.
+        """
+
+        if after is None:
+            after_order_by, descending = SORT_COLUMNS.get(order_by, 'username'), order_type == 'desc'
+        else:
+            after_order_by, descending = after.order_by, after.descending
+        column = _table.c[after_order_by]
+        conditions = _conditions(username, email, status, exact)
+
+        with self._engine_factory().connect() as conn:
+            total = None
+            if after is None:
+                total = conn.execute(select([func.count()]).select_from(_table).where(and_(*conditions))).scalar()
+            else:
+                conditions.append(_after(column, after))
+            query = select([_table]).where(and_(*conditions)).order_by(*_order(column, descending))
+            rows = conn.execute(query.limit(limit + 1)).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = Cursor(after_order_by, descending, rows[-1][after_order_by], rows[-1]['id'])
+        return total, [to_user(row) for row in rows], next_cursor
+
+    async def _answer(self, listing: Callable, *args) -> Optional[tuple]:
+        """Result of a listing of the directory, None when keycloak has to answer instead."""
+
+        if not self.ready():
+            self.fallbacks += 1
+            return None
+        try:
+            result = await run_in_threadpool(listing, *args)
+        except Exception as e:
+            _logger.error(f'Error listing users from the directory - {e}')
+            self.fallbacks += 1
+            return None
+        self.served += 1
+        return result
+
+    async def search(
+        self,
+        username: Optional[str] = None,
+        email: Optional[str] = None,
+        status: Optional[str] = None,
+        exact: bool = False,
+        order_by: Optional[str] = None,
+        order_type: str = 'asc',
+        page: int = 0,
+        page_size: int = 10,
+    ) -> Optional[Tuple[int, List[dict]]]:
+        """Total and one page of the matching users, None when keycloak has to answer instead."""
+
+        return await self._answer(
+            self.list_users, username, email, status, exact, order_by, order_type, page, page_size
+        )
+
+    async def search_after(
+        self,
+        username: Optional[str] = None,
+        email: Optional[str] = None,
+        status: Optional[str] = None,
+        exact: bool = False,
+        order_by: Optional[str] = None,
+        order_type: str = 'asc',
+        after: Optional[Cursor] = None,
+        limit: int = 10,
+    ) -> Optional[Tuple[Optional[int], List[dict], Optional[Cursor]]]:
+        """Keyset paginated search, None when keycloak has to answer instead."""
+
+        return await self._answer(
+            self.list_users_after, username, email, status, exact, order_by, order_type, after, limit
+        )
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            'enabled': self._enabled,
+            'ready': self.ready(),
+            'synced_at': self.synced_at,
+            # alert on this one, the time since the copy was last known to be up to date
+            'lag': None if self.synced_at is None else now - self.synced_at,
+            'last_event_time': self.event_time,
+            'polls': self.polls,
+            'events': self.events,
+            'users_applied': self.users_applied,
+            'reconciliations': self.reconciliations,
+            'drift': self.drift,
+            'last_reconcile_duration': self.last_reconcile_duration,
+            'failures': self.failures,
+            'served': self.served,
+            'fallbacks': self.fallbacks,
+        }
+
+    async def start(self) -> None:
+        """Keep the directory up to date, the first copy is made in the background."""
+
+        if self._enabled and self._syncer is None:
+            self._syncer = asyncio.ensure_future(self._sync_forever())
+
+    async def stop(self) -> None:
+        if self._syncer is not None:
+            self._syncer.cancel()
+            try:
+                await self._syncer
+            except asyncio.CancelledError:
+                pass
+            self._syncer = None
+
+    async def _sync_forever(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.failures += 1
+                _logger.error(f'Error syncing the users from keycloak - {e}')
+            await asyncio.sleep(self._poll_interval)
@@ -0,0 +1,71 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+from datetime import datetime
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+# admin events changing a user or its realm roles, saved when the realm has admin events enabled
+ADMIN_RESOURCE_TYPES = ['USER', 'REALM_ROLE_MAPPING']
+# user events changing the user itself, saved when the realm has user events enabled for these types
+USER_EVENT_TYPES = ['REGISTER', 'UPDATE_PROFILE', 'UPDATE_EMAIL', 'VERIFY_EMAIL']
+
+_PAGE_SIZE = 100
+
+# dateFrom only has a day resolution in the server time zone, start the search a day earlier
+_DAY = 86400000
+
+
+async def events_since(admin_client, path: str, since: int, query: dict) -> List[dict]:
+    """Events of the realm newer than ``since``, in milliseconds, keycloak returns the newest first."""
+
+    query = dict(query, dateFrom=datetime.utcfromtimestamp((since - _DAY) / 1000).strftime('%Y-%m-%d'), max=_PAGE_SIZE)
+    events = []
+    first = 0
+    while True:
+        page = await admin_client.request('GET', path, params=dict(query, first=first))
+        events.extend(event for event in page if event['time'] > since)
+        if len(page) < _PAGE_SIZE or page[-1]['time'] <= since:
+            return events
+        first += _PAGE_SIZE
+
+
+def admin_event_user(event: dict) -> Optional[str]:
+    """Id of the user changed by an admin event, e.g. users/<id> or users/<id>/role-mappings/realm."""
+
+    path = (event.get('resourcePath') or '').split('/')
+    if len(path) >= 2 and path[0] == 'users':
+        return path[1]
+    return None
+
+
+async def changed_users(admin_client, since: int) -> Tuple[Set[str], int, int]:
+    """Users changed after ``since``, with the time of the latest event and the number of events."""
+
+    admin_events = await events_since(admin_client, 'admin-events', since, {'resourceTypes': ADMIN_RESOURCE_TYPES})
+    user_events = await events_since(admin_client, 'events', since, {'type': USER_EVENT_TYPES})
+
+    user_ids = {admin_event_user(event) for event in admin_events} | {event.get('userId') for event in user_events}
+    user_ids.discard(None)
+    latest = max((event['time'] for event in admin_events + user_events), default=since)
+    return user_ids, latest, len(admin_events) + len(user_events)
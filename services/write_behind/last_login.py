@@ -0,0 +1,89 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+from datetime import datetime
+
+import httpx
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+
+from config import ConfigSettings
+from resources.http_clients import http_clients
+from services.write_behind.queue import Batch
+from services.write_behind.queue import WriteBehindQueue
+from services.write_behind.spool import WriteSpool
+
+_logger = SrvLoggerFactory('last_login').get_logger()
+
+
+def now() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+async def write_last_logins(batch: Batch) -> Batch:
+    """Stamp ``last_login`` on the neo4j user of each (username, time) pair, return the pairs that failed.
+
+    A transport error or timeout ends the batch: the rest of it is returned as failed rather than waiting on neo4j
+    once per user.
+    """
+
+    client = http_clients.get('neo4j')
+    failed = []
+    for index, (username, last_login) in enumerate(batch):
+        try:
+            response = await client.post(ConfigSettings.NEO4J_SERVICE + "nodes/User/query", json={"name": username})
+            response.raise_for_status()
+            users = response.json()
+            if not users:
+                _logger.warning(f'last_login not saved, user {username} does not exist')
+                continue
+            response = await client.put(
+                ConfigSettings.NEO4J_SERVICE + f"nodes/User/node/{users[0]['id']}",
+                json={"last_login": last_login},
+            )
+            response.raise_for_status()
+        except httpx.TransportError as e:
+            _logger.error(f'Error updating last_login of {username}, {len(batch) - index} writes left - {e!r}')
+            failed.extend(batch[index:])
+            break
+        except Exception as e:
+            _logger.error(f'Error updating last_login of {username} - {e}')
+            failed.append((username, last_login))
+    return failed
+
+
+write_spool = WriteSpool(
+    ConfigSettings.WRITE_SPOOL_PATH,
+    interval=ConfigSettings.WRITE_SPOOL_REPLAY_INTERVAL,
+    batch_size=ConfigSettings.WRITE_SPOOL_BATCH_SIZE,
+    max_rows=ConfigSettings.WRITE_SPOOL_MAX_ROWS,
+    backoff=ConfigSettings.WRITE_SPOOL_BACKOFF,
+    max_backoff=ConfigSettings.WRITE_SPOOL_MAX_BACKOFF,
+)
+
+last_login_queue = WriteBehindQueue(
+    'last_login',
+    write_last_logins,
+    window=ConfigSettings.LAST_LOGIN_COALESCE_WINDOW,
+    interval=ConfigSettings.LAST_LOGIN_FLUSH_INTERVAL,
+    batch_size=ConfigSettings.LAST_LOGIN_BATCH_SIZE,
+    max_size=ConfigSettings.LAST_LOGIN_QUEUE_SIZE,
+    spool=write_spool,
+)
@@ -0,0 +1,237 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Hashable
+from typing import List
+from typing import Tuple
+
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from starlette.concurrency import run_in_threadpool
+
+_logger = SrvLoggerFactory('write_behind').get_logger()
+
+Batch = List[Tuple[Hashable, Any]]
+
+
+class WriteBehindQueue:
+    """Writes taken off the request path and flushed in batches by a background task.
+
+    Writes to the same key within ``window`` seconds are coalesced, the last value wins. Every ``interval`` seconds
+    the writes older than the window are handed to the coroutine ``flush`` in batches of up to ``batch_size``.
+    ``flush`` returns the writes it could not apply.
+    At most ``max_size`` keys wait in the queue, further writes are dropped and counted. ``stop`` drains the queue.
+    With a ``spool`` the writes that failed or did not fit in the queue are appended to it instead, and replayed
+    from there with ``flush``. Writes that did not fit wait in memory, up to another ``max_size``, until the
+    background task spools them: ``put`` never touches the disk.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        flush: Callable[[Batch], Awaitable[Batch]],
+        window: float = 5,
+        interval: float = 1,
+        batch_size: int = 100,
+        max_size: int = 10000,
+        spool=None,
+    ):
+        self.name = name
+        self._flush = flush
+        self._window = window
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_size = max_size
+        self._spool = spool
+        if spool is not None:
+            spool.register(name, flush)
+        # key -> (value, time of the first write since the last flush)
+        self._pending = OrderedDict()
+        # writes that did not fit in the queue, waiting to be spooled
+        self._overflow: Batch = []
+        self._lock = threading.Lock()
+        self._flusher = None
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.flushed = 0
+        self.failed = 0
+        self.batches = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, key: Hashable, value: Any) -> bool:
+        """Queue a write, returns False when the queue is full and the write was dropped."""
+
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = (value, self._pending[key][1])
+                self.coalesced += 1
+                return True
+            if len(self._pending) >= self._max_size:
+                if self._spool is not None and len(self._overflow) < self._max_size:
+                    self._overflow.append((key, value))
+                    return True
+                self.dropped += 1
+                return False
+            self._pending[key] = (value, time.time())
+            self.enqueued += 1
+            return True
+
+    def _take(self, due_before: float) -> Batch:
+        batch = []
+        with self._lock:
+            # keys keep their insertion order, the oldest writes come first
+            while self._pending and len(batch) < self._batch_size:
+                key, (value, queued_at) = next(iter(self._pending.items()))
+                if queued_at > due_before:
+                    break
+                del self._pending[key]
+                batch.append((key, value))
+        return batch
+
+    def spill(self) -> int:
+        """Append the writes that did not fit in the queue to the spool, return how many were spooled."""
+
+        with self._lock:
+            overflow, self._overflow = self._overflow, []
+        failed = self._to_spool(overflow)
+        with self._lock:
+            self.dropped += len(failed)
+        return len(overflow) - len(failed)
+
+    def _to_spool(self, batch: Batch) -> Batch:
+        if not batch:
+            return []
+        try:
+            self._spool.append(self.name, batch)
+        except Exception as e:
+            _logger.error(f'Error spooling {len(batch)} {self.name} writes - {e}')
+            return batch
+        self.spooled += len(batch)
+        return []
+
+    async def flush_batch(self, batch: Batch) -> Batch:
+        """Apply one batch and return the writes that failed and could not be spooled.
+
+        The spool file is only read and written in the threadpool.
+        """
+
+        if self._spool is not None and await run_in_threadpool(self._spool.pending, self.name):
+            # older writes wait in the spool, these go behind them to be applied in order
+            return await run_in_threadpool(self._to_spool, batch)
+        try:
+            failed = await self._flush(batch)
+        except Exception as e:
+            _logger.error(f'Error flushing {len(batch)} {self.name} writes - {e}')
+            failed = batch
+        self.failed += len(failed)
+        self.flushed += len(batch) - len(failed)
+        self.batches += 1
+        if failed and self._spool is not None:
+            return await run_in_threadpool(self._to_spool, failed)
+        return failed
+
+    async def flush(self, force: bool = False) -> int:
+        """Flush the due writes, or every write when ``force`` is set, and return how many were flushed."""
+
+        due_before = float('inf') if force else time.time() - self._window
+        count = 0
+        while True:
+            # spool the writes that overflowed while the last batch was being applied
+            if self._overflow:
+                await run_in_threadpool(self.spill)
+            batch = self._take(due_before)
+            if not batch:
+                return count
+            await self.flush_batch(batch)
+            count += len(batch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            oldest = next(iter(self._pending.values()), None)
+            depth = len(self._pending)
+            overflow = len(self._overflow)
+        return {
+            'depth': depth,
+            'max_size': self._max_size,
+            'overflow': overflow,
+            'oldest_age': time.time() - oldest[1] if oldest else 0,
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'spooled': self.spooled,
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+    async def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_forever())
+
+    async def stop(self) -> None:
+        """Stop the background task and flush whatever is still queued.
+
+        With a spool the queued writes are appended to it instead, a slow upstream cannot hold the shutdown.
+        """
+
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+
+        if self._spool is not None:
+            spooled = await run_in_threadpool(self._drain_to_spool)
+            _logger.info(f'{self.name} queue drained, {spooled} writes spooled')
+            return
+
+        drained = await self.flush(force=True)
+        _logger.info(f'{self.name} queue drained, {drained} writes flushed')
+
+    def _drain_to_spool(self) -> int:
+        with self._lock:
+            batch = [(key, value) for key, (value, _) in self._pending.items()] + self._overflow
+            self._pending.clear()
+            self._overflow = []
+        failed = self._to_spool(batch)
+        with self._lock:
+            self.dropped += len(failed)
+        return len(batch) - len(failed)
+
+    async def _flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                _logger.error(f'Error flushing {self.name} queue - {e}')
@@ -0,0 +1,274 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from starlette.concurrency import run_in_threadpool
+
+from services.write_behind.queue import Batch
+
+_logger = SrvLoggerFactory('write_spool').get_logger()
+
+# seconds a worker owns the rows it is replaying, rows of a worker that died are replayed by another one after that
+_LEASE = 60
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_until REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS spool_kind_id ON spool (kind, id);
+'''
+
+
+class WriteSpool:
+    """Append-only SQLite file keeping the deferred writes that could not be applied yet.
+
+    Writes are appended per ``kind`` and replayed in order, ``batch_size`` at a time, by the coroutine function
+    registered for the kind. A background task replays every ``interval`` seconds, after a batch with failures it waits
+    ``backoff`` seconds, doubled on every further failure up to ``max_backoff``.
+    The workers of a pod may share the file, a worker claims the rows it replays for a while.
+    At most ``max_rows`` writes are kept, the oldest are evicted first and counted.
+    ``append``, ``pending`` and ``measure`` read or write the file, call them from the threadpool; ``replay`` runs its
+    own file accesses there.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = 5,
+        batch_size: int = 100,
+        max_rows: int = 100000,
+        backoff: float = 1,
+        max_backoff: float = 300,
+    ):
+        self.path = path
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_rows = max_rows
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._handlers: Dict[str, Callable[[Batch], Awaitable[Batch]]] = {}
+        self._conn = None
+        self._lock = threading.Lock()
+        self._replayer = None
+        self._retry_at = 0
+        # depth and oldest write as last measured by the background task, reported without touching the file
+        self._depth = 0
+        self._oldest = None
+        self.consecutive_failures = 0
+        self.appended = 0
+        self.replayed = 0
+        self.failed = 0
+        self.evicted = 0
+
+    def register(self, kind: str, apply: Callable[[Batch], Awaitable[Batch]]) -> None:
+        """Replay the writes of ``kind`` with ``apply``, which returns the writes it could not apply."""
+
+        self._handlers[kind] = apply
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def append(self, kind: str, batch: Batch) -> int:
+        """Append writes to the spool, return how many older writes were evicted to make room."""
+
+        if not batch:
+            return 0
+        created = time.time()
+        rows = [(kind, json.dumps(key), json.dumps(value), created) for key, value in batch]
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT INTO spool (kind, key, value, created) VALUES (?, ?, ?, ?)', rows)
+                (depth,) = conn.execute('SELECT COUNT(*) FROM spool').fetchone()
+                evicted = max(depth - self._max_rows, 0)
+                if evicted:
+                    conn.execute(
+                        'DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)', (evicted,)
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            self.appended += len(rows)
+            self.evicted += evicted
+        if evicted:
+            _logger.warning(f'Write spool {self.path} is full, {evicted} oldest writes evicted')
+        return evicted
+
+    def pending(self, kind: str) -> bool:
+        with self._lock:
+            row = self._connection().execute('SELECT 1 FROM spool WHERE kind = ? LIMIT 1', (kind,)).fetchone()
+        return row is not None
+
+    def _claim(self, kind: str) -> list:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT id, key, value FROM spool WHERE kind = ? AND claimed_until < ? ORDER BY id LIMIT ?',
+                    (kind, now, self._batch_size),
+                ).fetchall()
+                conn.executemany(
+                    'UPDATE spool SET claimed_until = ?, attempts = attempts + 1 WHERE id = ?',
+                    [(now + _LEASE, row[0]) for row in rows],
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return rows
+
+    def _settle(self, done: list, failed: list) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('DELETE FROM spool WHERE id = ?', [(row_id,) for row_id in done])
+                conn.executemany('UPDATE spool SET claimed_until = 0 WHERE id = ?', [(row_id,) for row_id in failed])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    async def replay_batch(self, kind: str) -> Tuple[int, int]:
+        """Replay the oldest batch of ``kind``, return how many writes were replayed and how many failed."""
+
+        rows = await run_in_threadpool(self._claim, kind)
+        if not rows:
+            return 0, 0
+        batch = [(json.loads(key), json.loads(value)) for _, key, value in rows]
+        try:
+            failures = await self._handlers[kind](batch)
+        except Exception as e:
+            _logger.error(f'Error replaying {len(batch)} spooled {kind} writes - {e}')
+            failures = batch
+        done, failed = [], []
+        for (row_id, _, _), write in zip(rows, batch):
+            (failed if write in failures else done).append(row_id)
+        await run_in_threadpool(self._settle, done, failed)
+        self.replayed += len(done)
+        self.failed += len(failed)
+        return len(done), len(failed)
+
+    async def replay(self, force: bool = False) -> int:
+        """Replay the spooled writes until the spool is empty or a batch fails, return how many were replayed.
+
+        Does nothing while backing off from a failure, unless ``force`` is set.
+        """
+
+        if not force and time.time() < self._retry_at:
+            return 0
+        count = 0
+        for kind in list(self._handlers):
+            while True:
+                replayed, failed = await self.replay_batch(kind)
+                count += replayed
+                if failed:
+                    self.consecutive_failures += 1
+                    delay = min(self._backoff * 2 ** (self.consecutive_failures - 1), self._max_backoff)
+                    self._retry_at = time.time() + delay
+                    _logger.warning(f'Replaying spooled {kind} writes failed, retrying in {delay:.0f}s')
+                    return count
+                if not replayed:
+                    break
+        self.consecutive_failures = 0
+        self._retry_at = 0
+        return count
+
+    def measure(self) -> int:
+        """Count the spooled writes of every worker sharing the file, return the count."""
+
+        with self._lock:
+            self._depth, self._oldest = self._connection().execute(
+                'SELECT COUNT(*), MIN(created) FROM spool'
+            ).fetchone()
+        return self._depth
+
+    def stats(self) -> dict:
+        return {
+            'path': self.path,
+            'depth': self._depth,
+            'max_rows': self._max_rows,
+            'oldest_age': time.time() - self._oldest if self._oldest else 0,
+            'appended': self.appended,
+            'replayed': self.replayed,
+            'failed': self.failed,
+            'evicted': self.evicted,
+            'consecutive_failures': self.consecutive_failures,
+            'retry_in': max(self._retry_at - time.time(), 0),
+        }
+
+    async def start(self) -> None:
+        if self._replayer is None:
+            self._replayer = asyncio.ensure_future(self._replay_forever())
+
+    async def stop(self) -> None:
+        if self._replayer is not None:
+            self._replayer.cancel()
+            try:
+                await self._replayer
+            except asyncio.CancelledError:
+                pass
+            self._replayer = None
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+
+    async def _replay_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                replayed = await self.replay()
+                if replayed:
+                    _logger.info(f'{replayed} spooled writes replayed')
+                await run_in_threadpool(self.measure)
+            except Exception as e:
+                _logger.error(f'Error replaying write spool {self.path} - {e}')
@@ -18,9 +18,17 @@
 # permissions and limitations under the Licence.
 # 
 
+import asyncio
+from unittest import mock
+
+import httpx
 from fastapi.testclient import TestClient
 from run import app
 
+from config import ConfigSettings
+from module_keycloak.ops_admin import OperationsAdmin
+from resources.http_clients import http_clients
+
 
 class SetupTest:
 
@@ -32,3 +40,19 @@ class SetupTest:
     def create_test_client(self):
         client = TestClient(app)
         return client
+
+
+def run_admin(operation, *args, **kwargs):
+    """Call an OperationsAdmin operation on the test realm from the synchronous test fixtures."""
+
+    async def call():
+        return await getattr(OperationsAdmin(ConfigSettings.KEYCLOAK_REALM), operation)(*args, **kwargs)
+
+    return asyncio.run(call())
+
+
+def mock_upstream(handler):
+    """Answer the requests of every shared HTTP client with ``handler``."""
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return mock.patch.object(http_clients, 'get', return_value=client)
@@ -18,22 +18,28 @@
 # permissions and limitations under the Licence.
 # 
 
+import asyncio
+import collections
 import json
 import unittest
 import warnings
-from datetime import datetime
-from datetime import timedelta
 from unittest import mock
 
 from tests.prepare_test import SetupTest
+from tests.prepare_test import mock_upstream
+from tests.prepare_test import run_admin
 from tests.logger import Logger
 
+import httpx
 import keycloak
 from keycloak import exceptions
 
-from app import create_app
 from config import ConfigSettings
+from module_keycloak.admin_tokens import AdminTokenManager
 from module_keycloak.ops_admin import OperationsAdmin
+from module_keycloak.realm_roles import RealmRoleIndex
+from module_keycloak.role_members import RoleMembersCache
+from resources.pagination import MAX_LIMIT
 
 EXCEPTION_DATA = {
     "response_body": '{ "error": "error" }',
@@ -56,14 +62,14 @@ class AdminTests(unittest.TestCase):
         # app.config['DEBUG'] = True
         self.app = self.test.app
 
-        operations_admin = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
         try:
             # Delete the test user if it already exists
-            operations_admin.delete_user("unittestuser")
+            run_admin('delete_user', "unittestuser")
         except keycloak.exceptions.KeycloakGetError:
             pass
 
-        self.user = operations_admin.create_user(
+        self.user = run_admin(
+            'create_user',
             "unittestuser",
             "Testing123!",
             "unittesting@test.com",
@@ -72,7 +78,6 @@ class AdminTests(unittest.TestCase):
             cred_type="password",
             enabled=True
         )
-        
 
     # def test_create_user(self):
     #     data = {
@@ -107,7 +112,9 @@ class AdminTests(unittest.TestCase):
     #     response = self.app.post('/v1/admin/users', json=data)
     #     self.assertEqual(response.status_code, 500)
     #     response_json = response.json()
-    #     self.assertEqual(response_json.get("error_msg"), "query user by its email failed: 500: { \"error\": \"error\" }")
+    #     self.assertEqual(
+    #         response_json.get("error_msg"), "query user by its email failed: 500: { \"error\": \"error\" }"
+    #     )
 
     # @mock.patch.object(OperationsAdmin, '__init__', side_effect=Exception())
     # def test_create_user_keycoak_except(self, mock_connect):
@@ -267,7 +274,6 @@ class AdminTests(unittest.TestCase):
         }
         response = self.app.get('/v1/admin/users/email', params=data)
         response_json = response.json()
-        print(response_json)
         self.assertEqual(response_json.get("error_msg"), 'query user by its email failed: 500: { "error": "error" }')
 
     @mock.patch.object(OperationsAdmin, '__init__', side_effect=Exception())
@@ -280,3 +286,326 @@ class AdminTests(unittest.TestCase):
         response = self.app.get('/v1/admin/users/email', params=data)
         response_json = response.json()
         self.assertEqual(response_json.get("error_msg"), 'query user by its email failed: ')
+
+
+class RoleUsersTests(unittest.TestCase):
+
+    ADMIN_TOKEN = {"access_token": "admin-token"}
+
+    def setUp(self):
+        self.sent = []
+        for target, value in (('admin_tokens', AdminTokenManager()), ('role_members', RoleMembersCache())):
+            patcher = mock.patch(f'module_keycloak.ops_admin.{target}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_role_users_keyset_pages(self):
+        members = {
+            "project-admin": [{"username": "c", "email": "c@test.com"}, {"username": "a", "email": "a@test.com"}],
+            "project-contributor": [{"username": "b", "email": "b@test.com"}, {"username": "a", "email": "a@test.com"}],
+        }
+
+        def keycloak(request):
+            if request.url.path.endswith('/protocol/openid-connect/token'):
+                return httpx.Response(200, json=self.ADMIN_TOKEN)
+            return httpx.Response(200, json=members[request.url.path.split('/')[-2]])
+
+        app = SetupTest(Logger(name='test_admin_apis.log')).app
+        query = {"role_names": list(members), "status": "", "limit": 2, "order_by": "username"}
+        pages = []
+        with mock_upstream(keycloak):
+            while True:
+                response = app.post('/v1/admin/roles/users', json=query).json()
+                pages.append([(user["username"], user["permission"]) for user in response["result"]])
+                if response["next_cursor"] is None:
+                    break
+                query = dict(query, cursor=response["next_cursor"])
+        self.assertEqual(pages, [[("a", "admin"), ("b", "contributor")], [("c", "admin")]])
+        self.assertEqual(response["total"], 3)
+
+    def test_role_users_invalid_limit(self):
+        app = SetupTest(Logger(name='test_admin_apis.log')).app
+        for limit in [0, -1, MAX_LIMIT + 1]:
+            response = app.post('/v1/admin/roles/users', json={"role_names": ["project-admin"], "limit": limit})
+            self.assertEqual(response.status_code, 422)
+
+    def test_role_users_fetched_concurrently(self):
+        in_flight = collections.Counter()
+
+        async def keycloak(request):
+            if request.url.path.endswith('/protocol/openid-connect/token'):
+                return httpx.Response(200, json=self.ADMIN_TOKEN)
+            self.sent.append(request)
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            await asyncio.sleep(0.02)
+            in_flight["now"] -= 1
+            project = request.url.path.split('/')[-2].split('-')[0]
+            return httpx.Response(200, json=[{"id": "1", "username": "shared"}, {"id": project, "username": project}])
+
+        app = SetupTest(Logger(name='test_admin_apis.log')).app
+        role_names = [f"project{i}-admin" for i in range(6)] + ["project0-admin"]
+        query = {"role_names": role_names, "status": "", "page_size": 20, "order_by": "username"}
+        with mock_upstream(keycloak), mock.patch.object(ConfigSettings, 'KEYCLOAK_ROLE_USERS_CONCURRENCY', 3):
+            response = app.post('/v1/admin/roles/users', json=query).json()
+        self.assertEqual(len(self.sent), 6)
+        self.assertEqual(in_flight["max"], 3)
+        usernames = [user["username"] for user in response["result"]]
+        self.assertEqual(usernames, [f"project{i}" for i in range(6)] + ["shared"])
+        self.assertEqual(response["total"], 7)
+
+
+class AdminTokenTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tokens = AdminTokenManager(refresh_margin=30)
+        patcher = mock.patch('module_keycloak.ops_admin.admin_tokens', self.tokens)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.grants = 0
+        self.expires_in = 300
+        self.refused = set()
+
+    async def keycloak(self, request):
+        if request.url.path.endswith('/protocol/openid-connect/token'):
+            self.grants += 1
+            # let the concurrent requests pile up on the grant in flight
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={"access_token": f"token{self.grants}", "expires_in": self.expires_in})
+        token = request.headers["Authorization"].split()[-1]
+        if token in self.refused:
+            return httpx.Response(401, json={"error": "HTTP 401 Unauthorized"})
+        return httpx.Response(200, json={"id": "1", "token": token})
+
+    def get_user(self, count=1):
+        async def get_users():
+            admin_clients = [OperationsAdmin('testrealm', server_url='http://keycloak/auth/') for _ in range(count)]
+            return await asyncio.gather(*[admin_client.get_user_info("1") for admin_client in admin_clients])
+
+        with mock_upstream(self.keycloak):
+            return asyncio.run(get_users())
+
+    def test_shared_single_flight(self):
+        users = self.get_user(count=10)
+        self.assertEqual({user["token"] for user in users}, {"token1"})
+        self.get_user()
+        self.assertEqual(self.grants, 1)
+        self.assertEqual(self.tokens.stats()["hits"], 1)
+
+    def test_refreshed_before_expiry(self):
+        self.expires_in = 20
+
+        async def get_users():
+            admin_client = OperationsAdmin('testrealm', server_url='http://keycloak/auth/')
+            # within the margin the token is still used while a new one is fetched
+            first = await admin_client.get_user_info("1")
+            second = await admin_client.get_user_info("1")
+            self.expires_in = 300
+            await asyncio.sleep(0.05)
+            return first, second, await admin_client.get_user_info("1")
+
+        with mock_upstream(self.keycloak):
+            users = asyncio.run(get_users())
+        self.assertEqual([user["token"] for user in users], ["token1", "token1", "token2"])
+        self.assertEqual(self.grants, 2)
+
+    def test_retry_once_on_401(self):
+        self.get_user()
+        self.refused.add("token1")
+        self.assertEqual(self.get_user()[0]["token"], "token2")
+        self.assertEqual(self.tokens.stats()["invalidated"], 1)
+
+        self.refused.update({"token2", "token3"})
+        with self.assertRaises(exceptions.KeycloakAuthenticationError):
+            self.get_user()
+        self.assertEqual(self.grants, 3)
+
+
+class RealmRoleIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = RealmRoleIndex(ttl=300)
+        tokens = AdminTokenManager(refresh_margin=30)
+        for target, value in (('realm_roles', self.index), ('admin_tokens', tokens)):
+            patcher = mock.patch(f'module_keycloak.ops_admin.{target}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.roles = {"admin": "1", "member": "2"}
+        self.requests = collections.Counter()
+        self.mapped = []
+        self.failing = set()
+        self.creating = 0
+        self.max_creating = 0
+
+    async def keycloak(self, request):
+        path = request.url.path
+        if path.endswith('/protocol/openid-connect/token'):
+            return httpx.Response(200, json={"access_token": "token", "expires_in": 300})
+        if path.endswith('/roles') and request.method == 'GET':
+            self.requests['list'] += 1
+            return httpx.Response(200, json=[{"id": role_id, "name": name} for name, role_id in self.roles.items()])
+        if path.endswith('/roles'):
+            name = json.loads(request.content)["name"]
+            if name in self.failing:
+                return httpx.Response(500, text="unknown_error")
+            if name in self.roles:
+                return httpx.Response(409, json={"errorMessage": f"Role with name {name} already exists"})
+            self.creating += 1
+            self.max_creating = max(self.max_creating, self.creating)
+            await asyncio.sleep(0.01)
+            self.creating -= 1
+            self.roles[name] = str(len(self.roles) + 1)
+            return httpx.Response(201)
+        if '/roles/' in path:
+            self.requests['lookup'] += 1
+            name = path.rsplit('/', 1)[-1]
+            if name not in self.roles:
+                return httpx.Response(404, json={"error": "Could not find role"})
+            return httpx.Response(200, json={"id": self.roles[name], "name": name})
+        role = json.loads(request.content)[0]
+        if self.roles.get(role["name"]) != role["id"]:
+            return httpx.Response(404, json={"error": "Role not found"})
+        self.mapped.append((request.method, role["name"]))
+        return httpx.Response(204)
+
+    def run_admin(self, *operations):
+        async def run():
+            admin_client = OperationsAdmin('testrealm', server_url='http://keycloak/auth/')
+            return [await getattr(admin_client, name)(*args) for name, *args in operations]
+
+        with mock_upstream(self.keycloak):
+            return asyncio.run(run())
+
+    def test_roles_listed_once(self):
+        self.run_admin(
+            ('assign_user_role', 'user', 'admin'),
+            ('assign_user_role', 'user', 'member'),
+            ('delete_role_of_user', 'user', 'admin'),
+        )
+        self.assertEqual(self.mapped, [('POST', 'admin'), ('POST', 'member'), ('DELETE', 'admin')])
+        self.assertEqual(self.requests, {'list': 1})
+        self.assertEqual(self.index.stats()["hits"], 3)
+
+    def test_created_roles_indexed(self):
+        self.run_admin(('assign_user_role', 'user', 'admin'), ('create_project_realm_roles', ['admin'], 'project'))
+        self.run_admin(('assign_user_role', 'user', 'project-admin'))
+        self.assertEqual(self.requests, {'list': 1, 'lookup': 1})
+        self.assertEqual(self.index.stats()["misses"], 0)
+
+    def test_lookup_on_miss(self):
+        self.run_admin(('assign_user_role', 'user', 'admin'))
+        self.roles["other"] = "3"
+        self.run_admin(('assign_user_role', 'user', 'other'), ('assign_user_role', 'user', 'other'))
+        self.assertEqual(self.requests, {'list': 1, 'lookup': 1})
+        self.assertEqual(self.index.stats()["misses"], 1)
+        with self.assertRaises(exceptions.KeycloakGetError):
+            self.run_admin(('assign_user_role', 'user', 'missing'))
+
+    def test_recreated_role_looked_up_again(self):
+        self.run_admin(('assign_user_role', 'user', 'admin'))
+        self.roles["admin"] = "3"
+        self.run_admin(('assign_user_role', 'user', 'admin'), ('delete_role_of_user', 'user', 'admin'))
+        self.assertEqual(self.mapped, [('POST', 'admin'), ('POST', 'admin'), ('DELETE', 'admin')])
+        self.assertEqual(self.requests, {'list': 1, 'lookup': 1})
+        self.assertEqual(self.index.stats()["invalidated"], 1)
+
+    def test_project_roles_created_concurrently(self):
+        with mock.patch.object(ConfigSettings, 'KEYCLOAK_ROLE_CREATE_CONCURRENCY', 2):
+            results, = self.run_admin(('create_project_realm_roles', ['admin', 'collaborator', 'contributor'], 'p'))
+        self.assertEqual(results, {"p-admin": "created", "p-collaborator": "created", "p-contributor": "created"})
+        self.assertEqual(self.max_creating, 2)
+
+    def test_project_roles_retried(self):
+        self.failing.add("p-contributor")
+        results, = self.run_admin(('create_project_realm_roles', ['admin', 'contributor', 'admin'], 'p'))
+        self.assertEqual(results, {"p-admin": "created", "p-contributor": "unknown_error"})
+        self.failing.clear()
+        results, = self.run_admin(('create_project_realm_roles', ['admin', 'contributor'], 'p'))
+        self.assertEqual(results, {"p-admin": "exists", "p-contributor": "created"})
+
+    def test_expired_index_listed_again(self):
+        self.index = RealmRoleIndex(ttl=0)
+        with mock.patch('module_keycloak.ops_admin.realm_roles', self.index):
+            self.run_admin(('assign_user_role', 'user', 'admin'), ('assign_user_role', 'user', 'admin'))
+        self.assertEqual(self.requests, {'list': 2})
+
+
+class RoleMembersCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RoleMembersCache(ttl=30, max_stale=300)
+        for target, value in (('role_members', self.cache), ('admin_tokens', AdminTokenManager())):
+            patcher = mock.patch(f'module_keycloak.ops_admin.{target}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.members = {"admin": ["a"]}
+        self.fetches = 0
+
+    async def keycloak(self, request):
+        path = request.url.path
+        if path.endswith('/protocol/openid-connect/token'):
+            return httpx.Response(200, json={"access_token": "admin-token"})
+        if path.endswith('/roles'):
+            return httpx.Response(200, json=[{"id": "1", "name": "admin"}])
+        if path.endswith('/role-mappings/realm'):
+            self.members["admin"].append(path.split('/')[-3])
+            return httpx.Response(204)
+        self.fetches += 1
+        members = [{"username": username} for username in self.members["admin"]]
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=members)
+
+    def run_admin(self, operations):
+        async def run():
+            admin_client = OperationsAdmin('testrealm', server_url='http://keycloak/auth/')
+            return [await getattr(admin_client, name)(*args) for name, *args in operations]
+
+        with mock_upstream(self.keycloak):
+            return asyncio.run(run())
+
+    def test_members_served_within_ttl(self):
+        results = self.run_admin([('get_role_users', 'admin')] * 3)
+        self.assertEqual(results, [[{"username": "a"}]] * 3)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.cache.stats()["hits"], 2)
+
+    def test_stale_members_refreshed_in_background(self):
+        self.run_admin([('get_role_users', 'admin')])
+        self.members["admin"].append("b")
+        self.cache._ttl = 0
+
+        async def run():
+            admin_client = OperationsAdmin('testrealm', server_url='http://keycloak/auth/')
+            stale = await admin_client.get_role_users('admin')
+            await asyncio.sleep(0.05)
+            self.cache._ttl = 30
+            return stale, await admin_client.get_role_users('admin')
+
+        with mock_upstream(self.keycloak):
+            stale, fresh = asyncio.run(run())
+        self.assertEqual([user["username"] for user in stale], ["a"])
+        self.assertEqual([user["username"] for user in fresh], ["a", "b"])
+        self.assertEqual((self.cache.stats()["stale_hits"], self.fetches), (1, 2))
+
+    def test_invalidated_by_role_assignment(self):
+        results = self.run_admin([
+            ('get_role_users', 'admin'),
+            ('assign_user_role', 'c', 'admin'),
+            ('get_role_users', 'admin'),
+        ])
+        self.assertEqual([user["username"] for user in results[2]], ["a", "c"])
+        self.assertEqual(self.cache.stats()["invalidated"], 1)
+
+    def test_fetch_started_before_invalidation_not_kept(self):
+        async def run():
+            admin_client = OperationsAdmin('testrealm', server_url='http://keycloak/auth/')
+            fetch = asyncio.ensure_future(admin_client.get_role_users('admin'))
+            await asyncio.sleep(0)
+            await admin_client.assign_user_role('c', 'admin')
+            await fetch
+            return await admin_client.get_role_users('admin')
+
+        with mock_upstream(self.keycloak):
+            members = asyncio.run(run())
+        self.assertEqual([user["username"] for user in members], ["a", "c"])
+        self.assertEqual(self.fetches, 2)
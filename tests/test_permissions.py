@@ -0,0 +1,491 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+
+import casbin
+from casbin_sqlalchemy_adapter.adapter import Base
+from casbin_sqlalchemy_adapter.adapter import CasbinRule
+from sqlalchemy import create_engine
+from sqlalchemy import false
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import StaticPool
+
+from tests.prepare_test import SetupTest
+from tests.logger import Logger
+
+from users.permissions.compiler import compile_enforcer
+from users.permissions.permissions import policy_store
+from users.permissions.policy_store import PolicyNotLoaded
+from users.permissions.policy_store import PolicyStore
+from users.permissions.shared_snapshot import MappedPermissionMatrix
+from users.permissions.shared_snapshot import write_snapshot
+
+MODEL_PATH = 'users/permissions/model.conf'
+
+POLICY = [
+    {'ptype': 'p', 'v0': 'admin', 'v1': '*', 'v2': 'file', 'v3': '*'},
+    {'ptype': 'p', 'v0': 'contributor', 'v1': 'greenroom', 'v2': 'file', 'v3': 'view'},
+    {'ptype': 'p', 'v0': 'collaborator', 'v1': 'core', 'v2': 'file', 'v3': 'download'},
+]
+
+
+def create_policy_engine(rules):
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        # same unique index as migration d5a1e7c3b982
+        conn.execute("CREATE UNIQUE INDEX ix_casbin_rule_unique ON casbin_rule (ptype, v0, v1, v2, coalesce(v3, ''))")
+        conn.execute(CasbinRule.__table__.insert(), rules)
+    return engine
+
+
+class PolicyStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_policy_engine(POLICY)
+        self.store = PolicyStore(lambda: self.engine, MODEL_PATH, refresh_interval=0)
+
+    def test_snapshot_is_reused(self):
+        self.assertTrue(self.store.refresh())
+        snapshot = self.store.snapshot
+        self.assertIs(self.store.snapshot, snapshot)
+        self.assertTrue(snapshot.enforce('contributor', 'greenroom', 'file', 'view'))
+        self.assertFalse(snapshot.enforce('contributor', 'core', 'file', 'view'))
+
+    def test_snapshot_is_not_loaded_on_the_event_loop(self):
+        store = PolicyStore(lambda: self.engine, MODEL_PATH, poll_interval=0)
+        with self.assertRaises(PolicyNotLoaded):
+            store.snapshot
+        with mock.patch.object(PolicyStore, 'refresh', side_effect=SQLAlchemyError('database down')) as refresh:
+            asyncio.run(store.start())
+            with self.assertRaisesRegex(PolicyNotLoaded, 'database down'):
+                store.snapshot
+        refresh.assert_called_once()
+
+    def test_reload_publishes_new_snapshot(self):
+        old = self.store.load()
+        with self.engine.begin() as conn:
+            conn.execute(CasbinRule.__table__.insert(), [
+                {'ptype': 'p', 'v0': 'contributor', 'v1': 'core', 'v2': 'file', 'v3': 'view'},
+            ])
+        self.assertFalse(old.enforce('contributor', 'core', 'file', 'view'))
+
+        new = self.store.load()
+        self.assertIsNot(new, old)
+        self.assertIs(self.store.snapshot, new)
+        self.assertTrue(new.enforce('contributor', 'core', 'file', 'view'))
+
+    def test_decision_cache(self):
+        snapshot = self.store.load()
+        with mock.patch.object(snapshot.matrix, 'enforce', wraps=snapshot.matrix.enforce) as enforce:
+            for _ in range(3):
+                self.assertTrue(snapshot.enforce('admin', 'core', 'file', 'delete'))
+                self.assertFalse(snapshot.enforce('admin', 'core', 'folder', 'delete'))
+        self.assertEqual(enforce.call_count, 2)
+
+        cache = self.store.stats()["decision_cache"]
+        self.assertEqual(cache["hits"], 4)
+        self.assertEqual(cache["misses"], 2)
+        self.assertEqual(cache["size"], 2)
+
+        # a new policy version starts with an empty cache
+        self.store.load()
+        self.assertEqual(self.store.stats()["decision_cache"]["size"], 0)
+
+    def test_decision_cache_is_bounded(self):
+        store = PolicyStore(lambda: self.engine, MODEL_PATH, refresh_interval=0, cache_size=2)
+        snapshot = store.load()
+        for operation in ['view', 'upload', 'download']:
+            snapshot.enforce('admin', 'core', 'file', operation)
+        self.assertEqual(len(snapshot.cache), 2)
+        self.assertEqual(store.stats()["decision_cache"]["evictions"], 1)
+
+    def test_refresh_follows_policy_version(self):
+        with self.engine.begin() as conn:
+            conn.execute('CREATE TABLE casbin_policy_version (id INTEGER PRIMARY KEY, version INTEGER)')
+            conn.execute('INSERT INTO casbin_policy_version VALUES (1, 1)')
+        self.assertTrue(self.store.refresh())
+        snapshot = self.store.snapshot
+        self.assertEqual(snapshot.version, 1)
+        self.assertFalse(self.store.refresh())
+
+        with self.engine.begin() as conn:
+            conn.execute('UPDATE casbin_policy_version SET version = 2')
+        self.assertTrue(self.store.refresh())
+        self.assertEqual(self.store.snapshot.version, 2)
+        self.assertEqual(self.store.stats()["reloads"], 2)
+
+    def test_refresh_without_policy_version(self):
+        self.store = PolicyStore(lambda: self.engine, MODEL_PATH, refresh_interval=30)
+        snapshot = self.store.load()
+        self.assertIsNone(snapshot.version)
+        self.assertFalse(self.store.refresh())
+        self.assertFalse(self.store.stats()["versioned"])
+
+        snapshot.loaded_at -= 30
+        self.assertTrue(self.store.refresh())
+
+    def test_zone_filtered_load(self):
+        self.engine = create_policy_engine(POLICY + [
+            {'ptype': 'g', 'v0': 'jdoe', 'v1': 'contributor', 'v2': 'greenroom', 'v3': None},
+            {'ptype': 'g', 'v0': 'jdoe', 'v1': 'collaborator', 'v2': 'core', 'v3': None},
+        ])
+        store = PolicyStore(lambda: self.engine, MODEL_PATH, refresh_interval=0, zones=['greenroom'])
+        snapshot = store.load()
+        self.assertEqual(store.stats()["zones"], ['*', 'greenroom'])
+        self.assertEqual(store.stats()["rules"], 2)
+        self.assertEqual(store.stats()["groupings"], 1)
+        self.assertTrue(snapshot.enforce('jdoe', 'greenroom', 'file', 'view'))
+        self.assertTrue(snapshot.enforce('admin', 'greenroom', 'file', 'delete'))
+        self.assertFalse(snapshot.enforce('jdoe', 'core', 'file', 'download'))
+
+
+class PermissionMatrixTests(unittest.TestCase):
+    """The compiled matrix must agree with casbin on every request built from the policy values."""
+
+    roles = ['admin', 'contributor', 'collaborator', 'member', 'project1-admin', 'project2-collaborator']
+    zones = ['greenroom', 'core', '*']
+    resources = ['file', 'folder', 'project', 'dataset']
+    operations = ['view', 'upload', 'download', 'delete', '*']
+
+    def build_enforcer(self, seed):
+        rng = random.Random(seed)
+        enforcer = casbin.Enforcer(MODEL_PATH)
+        for rule in itertools.product(self.roles, self.zones, self.resources, self.operations):
+            if rng.random() < 0.3:
+                enforcer.add_policy(*rule)
+        users = [f'user{i}' for i in range(8)]
+        for _ in range(20):
+            user = rng.choice(users + self.roles)
+            enforcer.add_grouping_policy(user, rng.choice(users + self.roles), rng.choice(self.zones))
+        return enforcer
+
+    def assert_same_decisions(self, enforcer):
+        matrix = compile_enforcer(enforcer)
+        self.assertIsNotNone(matrix)
+        subjects = self.roles + [f'user{i}' for i in range(8)] + ['platform_admin', 'unknown']
+        for request in itertools.product(subjects, self.zones + ['unknown'], self.resources, self.operations):
+            self.assertEqual(matrix.enforce(*request), enforcer.enforce(*request), request)
+
+    def test_matches_casbin(self):
+        for seed in range(3):
+            self.assert_same_decisions(self.build_enforcer(seed))
+
+    def test_matches_casbin_role_hierarchy(self):
+        enforcer = casbin.Enforcer(MODEL_PATH)
+        enforcer.add_policy('role15', 'core', 'file', 'view')
+        enforcer.add_policy('admin', '*', 'file', '*')
+        for i in range(15):
+            enforcer.add_grouping_policy(f'role{i}', f'role{i + 1}', 'core')
+        enforcer.add_grouping_policy('role15', 'role0', 'core')
+        enforcer.add_grouping_policy('user0', 'admin', '*')
+        for subject in [f'role{i}' for i in range(16)] + ['user0']:
+            for zone in self.zones:
+                request = (subject, zone, 'file', 'view')
+                self.assertEqual(compile_enforcer(enforcer).enforce(*request), enforcer.enforce(*request), request)
+
+    def test_permissions_match_casbin(self):
+        enforcer = self.build_enforcer(seed=7)
+        matrix = compile_enforcer(enforcer)
+        for role, zone in itertools.product(self.roles + ['user0', 'platform_admin'], self.zones):
+            allowed = {
+                (resource, operation)
+                for resource, operation in itertools.product(self.resources, self.operations)
+                if enforcer.enforce(role, zone, resource, operation)
+            }
+            permissions = matrix.permissions(role, zone)
+            listed = {(resource, operation) for resource in permissions for operation in permissions[resource]}
+            self.assertTrue(listed <= allowed, (role, zone))
+            self.assertEqual({r for r in allowed if r[1] == '*'}, {r for r in listed if r[1] == '*'}, (role, zone))
+
+    def test_mapped_matrix_matches_compiled(self):
+        enforcer = self.build_enforcer(seed=11)
+        matrix = compile_enforcer(enforcer)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'policy.snap')
+            write_snapshot(path, matrix, 42, 0.0, len(enforcer.get_policy()), 20)
+            mapped = MappedPermissionMatrix(path)
+        self.assertEqual(mapped.version, 42)
+        subjects = self.roles + [f'user{i}' for i in range(8)] + ['platform_admin', 'unknown']
+        for role, zone in itertools.product(subjects, self.zones + ['unknown']):
+            self.assertEqual(mapped.permissions(role, zone), matrix.permissions(role, zone), (role, zone))
+            for resource, operation in itertools.product(self.resources + ['unknown'], self.operations):
+                request = (role, zone, resource, operation)
+                self.assertEqual(mapped.enforce(*request), matrix.enforce(*request), request)
+
+    def test_unsupported_model_is_not_compiled(self):
+        model = casbin.Enforcer.new_model(text=open(MODEL_PATH).read().replace("r.sub == 'platform_admin'", 'false'))
+        enforcer = casbin.Enforcer(model)
+        enforcer.add_policy('admin', 'core', 'file', 'view')
+        self.assertIsNone(compile_enforcer(enforcer))
+
+    def test_store_uses_matrix(self):
+        store = PolicyStore(lambda: create_policy_engine(POLICY), MODEL_PATH, refresh_interval=0, cache_size=0)
+        snapshot = store.load()
+        self.assertTrue(store.stats()["compiled"])
+        with mock.patch.object(snapshot.enforcer, 'enforce') as enforce:
+            self.assertTrue(snapshot.enforce('contributor', 'greenroom', 'file', 'view'))
+        enforce.assert_not_called()
+
+        store = PolicyStore(lambda: create_policy_engine(POLICY), MODEL_PATH, refresh_interval=0, compile_policy=False)
+        self.assertFalse(store.stats()["loaded"])
+        store.load()
+        self.assertTrue(store.snapshot.enforce('contributor', 'greenroom', 'file', 'view'))
+        self.assertFalse(store.stats()["compiled"])
+
+
+class SharedSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_policy_engine(POLICY)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+
+    def create_store(self, **kwargs):
+        return PolicyStore(lambda: self.engine, MODEL_PATH, refresh_interval=0, snapshot_dir=self.path, **kwargs)
+
+    def test_follower_maps_leader_snapshot(self):
+        leader, follower = self.create_store(), self.create_store()
+        self.assertTrue(leader.refresh())
+        with mock.patch.object(PolicyStore, 'read_version') as read_version:
+            self.assertTrue(follower.refresh())
+            self.assertTrue(follower.snapshot.enforce('contributor', 'greenroom', 'file', 'view'))
+            self.assertFalse(follower.refresh())
+        read_version.assert_not_called()
+        self.assertTrue(leader.stats()["shared"]["leader"])
+        self.assertFalse(follower.stats()["shared"]["leader"])
+        self.assertEqual(follower.stats()["rules"], len(POLICY))
+
+        with self.engine.begin() as conn:
+            conn.execute(CasbinRule.__table__.insert(), [
+                {'ptype': 'p', 'v0': 'contributor', 'v1': 'core', 'v2': 'file', 'v3': 'view'},
+            ])
+        self.assertTrue(leader.refresh())
+        self.assertTrue(follower.refresh())
+        self.assertTrue(follower.snapshot.enforce('contributor', 'core', 'file', 'view'))
+
+    def test_follower_takes_over(self):
+        leader, follower = self.create_store(), self.create_store()
+        leader.refresh()
+        follower.refresh()
+        self.assertFalse(follower.stats()["shared"]["leader"])
+
+        asyncio.run(leader.stop())
+        follower.refresh()
+        self.assertTrue(follower.stats()["shared"]["leader"])
+
+    def test_uncompiled_policy_is_not_shared(self):
+        leader, follower = self.create_store(compile_policy=False), self.create_store()
+        leader.refresh()
+        follower.refresh()
+        self.assertTrue(follower.snapshot.enforce('contributor', 'greenroom', 'file', 'view'))
+        self.assertIsNone(follower.stats()["shared"]["current"])
+        self.assertIsNotNone(follower.snapshot.enforcer)
+
+
+class AuthorizeTests(unittest.TestCase):
+
+    log = Logger(name='test_permissions_apis.log')
+    test = SetupTest(log)
+
+    @classmethod
+    def setUpClass(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+        self.app = self.test.app
+        engine = create_policy_engine(POLICY)
+        self.store = PolicyStore(lambda: engine, MODEL_PATH, refresh_interval=0)
+        self.store.load()
+
+    def test_authorize(self):
+        params = {'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'download'}
+        with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+            response = self.app.get('/v1/authorize', params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"], {"has_permission": True})
+
+    def test_authorize_denied(self):
+        params = {'role': 'collaborator', 'zone': 'greenroom', 'resource': 'file', 'operation': 'download'}
+        with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+            response = self.app.get('/v1/authorize', params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"], {"has_permission": False})
+
+    def test_authorize_batch(self):
+        checks = [
+            {'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'download'},
+            {'role': 'collaborator', 'zone': 'greenroom', 'resource': 'file', 'operation': 'download'},
+            {'role': 'admin', 'zone': 'greenroom', 'resource': 'file', 'operation': 'delete'},
+        ]
+        with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+            response = self.app.post('/v1/authorize/batch', json={'checks': checks})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()["result"]
+        self.assertEqual([decision["has_permission"] for decision in result], [True, False, True])
+        self.assertEqual(result[1]["zone"], 'greenroom')
+
+    def test_authorize_batch_exception(self):
+        checks = [{'role': 'admin', 'zone': 'core', 'resource': 'file', 'operation': 'view'}]
+        # the startup load failed, requests do not retry it on the event loop
+        with mock.patch.object(PolicyStore, 'load') as load, mock.patch.object(policy_store, '_snapshot', None), \
+                mock.patch.object(policy_store, '_load_error', Exception('db down')):
+            response = self.app.post('/v1/authorize/batch', json={'checks': checks})
+        load.assert_not_called()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["error_msg"], 'Error checking permissions - Policy not loaded - db down')
+        self.assertFalse(response.json()["result"][0]["has_permission"])
+
+    def test_authorize_batch_missing(self):
+        response = self.app.post('/v1/authorize/batch', json={})
+        self.assertEqual(response.status_code, 422)
+
+    def test_permissions(self):
+        params = {'role': 'admin', 'zone': 'core'}
+        with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+            response = self.app.get('/v1/authorize/permissions', params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"]["permissions"], [{"resource": "file", "operation": "*"}])
+        etag = response.headers["ETag"]
+
+        with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+            response = self.app.get('/v1/authorize/permissions', params=params, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
+        # a proxy may send the tag weakened, among others, or ask for any version
+        for if_none_match in [f'"other", W/{etag}', '*']:
+            with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+                response = self.app.get(
+                    '/v1/authorize/permissions', params=params, headers={'If-None-Match': if_none_match}
+                )
+            self.assertEqual(response.status_code, 304)
+
+        with mock.patch.object(policy_store, '_snapshot', self.store.load()):
+            response = self.app.get('/v1/authorize/permissions', params=params, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_diagnostics(self):
+        with mock.patch.object(policy_store, '_snapshot', self.store.snapshot):
+            response = self.app.get('/v1/diagnostics')
+        self.assertEqual(response.status_code, 200)
+        policy = response.json()["result"]["policy"]
+        self.assertTrue(policy["loaded"])
+        self.assertEqual(policy["rules"], len(POLICY))
+
+    def test_authorize_missing(self):
+        response = self.app.get('/v1/authorize', params={'role': 'admin'})
+        self.assertEqual(response.status_code, 422)
+
+
+class PoliciesTests(unittest.TestCase):
+
+    log = Logger(name='test_permissions_apis.log')
+    test = SetupTest(log)
+
+    @classmethod
+    def setUpClass(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+        self.app = self.test.app
+
+    def setUp(self):
+        self.engine = create_policy_engine(POLICY)
+        self.store = PolicyStore(lambda: self.engine, MODEL_PATH, refresh_interval=0)
+        self.store.load()
+        patchers = [
+            mock.patch('users.permissions.policies._get_sqlalchemy_engine', return_value=self.engine),
+            mock.patch('users.permissions.policies.policy_store', self.store),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_list_policies(self):
+        response = self.app.get('/v1/admin/policies', params={'zone': 'core'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["total"], 1)
+        self.assertEqual(response.json()["result"], [
+            {'ptype': 'p', 'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'download'},
+        ])
+
+    def test_upsert_policies(self):
+        self.assertFalse(self.store.snapshot.enforce('jdoe', 'core', 'file', 'download'))
+        payload = {
+            'policies': [
+                {'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'download'},
+                {'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'view'},
+                {'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'view'},
+            ],
+            'groupings': [{'user': 'jdoe', 'role': 'collaborator', 'zone': 'core'}],
+        }
+        response = self.app.post('/v1/admin/policies', json=payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"]["inserted"], 2)
+        self.assertTrue(self.store.snapshot.enforce('jdoe', 'core', 'file', 'download'))
+
+        response = self.app.post('/v1/admin/policies', json=payload)
+        self.assertEqual(response.json()["result"]["inserted"], 0)
+
+    def test_upsert_policies_inserted_concurrently(self):
+        payload = {
+            'policies': [{'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'download'}],
+            'groupings': [{'user': 'jdoe', 'role': 'collaborator', 'zone': 'core'}],
+        }
+        self.app.post('/v1/admin/policies', json={'groupings': payload['groupings']})
+        # the rules are inserted by another batch between the lookup and the insert
+        with mock.patch('users.permissions.policies._matches', return_value=false()):
+            response = self.app.post('/v1/admin/policies', json=payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"]["inserted"], 0)
+        with self.engine.connect() as conn:
+            total = conn.execute(select([func.count()]).select_from(CasbinRule.__table__)).scalar()
+        self.assertEqual(total, len(POLICY) + 1)
+
+    def test_list_policies_invalid_page_size(self):
+        response = self.app.get('/v1/admin/policies', params={'page_size': 0})
+        self.assertEqual(response.status_code, 422)
+
+    def test_delete_policies(self):
+        payload = {'policies': [
+            {'role': 'collaborator', 'zone': 'core', 'resource': 'file', 'operation': 'download'},
+            {'role': 'contributor', 'zone': 'core', 'resource': 'file', 'operation': 'download'},
+        ]}
+        response = self.app.request('DELETE', '/v1/admin/policies', json=payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"]["deleted"], 1)
+        self.assertFalse(self.store.snapshot.enforce('collaborator', 'core', 'file', 'download'))
+
+    def test_upsert_policies_exception(self):
+        payload = {'groupings': [{'user': 'jdoe', 'role': 'collaborator', 'zone': 'core'}]}
+        with mock.patch('users.permissions.policies.upsert_rules', side_effect=Exception('db down')):
+            response = self.app.post('/v1/admin/policies', json=payload)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["error_msg"], 'Error updating policies - db down')
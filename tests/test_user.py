@@ -18,21 +18,56 @@
 # permissions and limitations under the Licence.
 # 
 
+import asyncio
+import collections
 import json
+import os
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 from unittest import mock
 
+import httpx
 import keycloak
+import rsa
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+from jose import jwk
+from jose import jwt
 from keycloak import exceptions
 
 from tests.prepare_test import SetupTest
+from tests.prepare_test import mock_upstream
+from tests.prepare_test import run_admin
 from tests.logger import Logger
 
-from app import create_app
 from config import ConfigSettings
+from module_keycloak.admin_tokens import AdminTokenManager
 from module_keycloak.ops_admin import OperationsAdmin
+from module_keycloak.openid_clients import OpenIDClients
 from module_keycloak.ops_user import OperationsUser
+from module_keycloak.role_members import RoleMembersCache
+from module_keycloak.tokens import InvalidToken
+from resources.http_clients import HTTPClients
+from resources.pagination import MAX_LIMIT
+from resources.pagination import encode_cursor
+from resources.pagination import keyset_page
+from services.data_providers.ldap_client import AsyncLdapClient
+from services.data_providers.ldap_client import LdapClient
+from services.data_providers.neo4j_client import Neo4jClient
+from services.user_directory.directory import UserDirectory
+from services.user_directory.directory import read_cursor
+from services.user_directory.directory import to_row
+from services.user_directory.directory import user_directory_state_table
+from services.user_directory.directory import user_directory_table
+from services.write_behind.last_login import last_login_queue
+from services.write_behind.last_login import write_last_logins
+from services.write_behind.queue import WriteBehindQueue
+from services.write_behind.spool import WriteSpool
+from users.ops_user import UserList
 
 EXCEPTION_DATA = {
     "response_body": '{ "error": "error" }',
@@ -60,14 +95,14 @@ class UserTests(unittest.TestCase):
         # app.config['DEBUG'] = True
         self.app = self.test.app
 
-        operations_admin = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
         try:
             # Delete the test user if it already exists
-            operations_admin.delete_user("unittestuser")
+            run_admin('delete_user', "unittestuser")
         except keycloak.exceptions.KeycloakGetError:
             pass
 
-        self.user = operations_admin.create_user(
+        self.user = run_admin(
+            'create_user',
             "unittestuser",
             "Testing123!",
             "unittesting@test.com",
@@ -77,14 +112,11 @@ class UserTests(unittest.TestCase):
             enabled=True
         )
 
-        print(self.user)
-
         # return super().setUp()
 
     @classmethod
     def tearDownClass(self):
-        operations_admin = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
-        operations_admin.delete_user(self.user)
+        run_admin('delete_user', self.user)
         # return super().tearDown()
 
     def test_docs(self):
@@ -93,7 +125,6 @@ class UserTests(unittest.TestCase):
 
     def test_user_auth(self):
         response = self.app.post('/v1/users/auth', json=self.AUTH_DATA)
-        print(response.json())
         self.assertEqual(response.status_code, 200)
         response_json = response.json()
         self.assertEqual(response_json["error_msg"], "")
@@ -103,20 +134,16 @@ class UserTests(unittest.TestCase):
         data = self.AUTH_DATA.copy()
         del data["password"]
         response = self.app.post('/v1/users/auth', json=data)
-        print(response.json())
         self.assertEqual(response.status_code, 422)
 
-
     @mock.patch.object(OperationsUser, '__init__',
                        side_effect=keycloak.exceptions.KeycloakAuthenticationError(**EXCEPTION_DATA))
     def test_auth_keycloakauth_exception(self, mock_data):
         response = self.app.post('/v1/users/auth', json=self.AUTH_DATA)
-        print(response.json())
         self.assertEqual(response.status_code, 401)
         response_json = response.json()
         self.assertEqual(response_json.get("error_msg"), '500: { "error": "error" }')
 
-
     @mock.patch.object(OperationsUser, '__init__', side_effect=keycloak.exceptions.KeycloakGetError(**EXCEPTION_DATA))
     def test_auth_keycloakget_exception(self, mock_data):
         response = self.app.post('/v1/users/auth', json=self.AUTH_DATA)
@@ -129,7 +156,6 @@ class UserTests(unittest.TestCase):
         response = self.app.post('/v1/users/auth', json=self.AUTH_DATA)
         self.assertEqual(response.status_code, 500)
         response_json = response.json()
-        print(response_json)
         self.assertEqual(response_json.get("error_msg"), "User authentication failed : ")
 
     def test_user_refresh(self):
@@ -150,7 +176,6 @@ class UserTests(unittest.TestCase):
         response = self.app.post('/v1/users/refresh')
         self.assertEqual(response.status_code, 422)
 
-
     @mock.patch.object(OperationsUser, '__init__', side_effect=keycloak.exceptions.KeycloakGetError(**EXCEPTION_DATA))
     def test_refresh_keycloakget_exception(self, mock_data):
         refresh_data = {
@@ -282,5 +307,784 @@ class UserTests(unittest.TestCase):
         self.assertEqual(response.json().get("error_msg"), "User not exists")
 
 
+class OpenIDClientTests(unittest.TestCase):
+
+    WELL_KNOWN = {"issuer": "http://keycloak/auth/realms/testrealm"}
+
+    def setUp(self):
+        patcher = mock.patch('module_keycloak.ops_user.openid_clients', OpenIDClients('http://keycloak/auth/'))
+        self.clients = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(keycloak.KeycloakOpenID, 'well_know', return_value=WELL_KNOWN)
+    def test_client_is_shared(self, well_know):
+        first = OperationsUser('client', 'testrealm', 'secret')
+        second = OperationsUser('client', 'testrealm', 'secret')
+        self.assertIs(first.keycloak_openid, second.keycloak_openid)
+        self.assertEqual(second.config_well_know, self.WELL_KNOWN)
+        well_know.assert_called_once()
+
+        other = OperationsUser('client', 'otherrealm', 'secret')
+        self.assertIsNot(other.keycloak_openid, first.keycloak_openid)
+
+    @mock.patch.object(keycloak.KeycloakOpenID, 'certs', return_value={"keys": []})
+    @mock.patch.object(keycloak.KeycloakOpenID, 'well_know', return_value=WELL_KNOWN)
+    def test_well_known_loaded_at_startup(self, well_know, certs):
+        OperationsUser('client', 'testrealm', 'secret')
+        well_know.assert_not_called()
+
+        asyncio.run(self.clients.start([('client', 'testrealm', 'secret')]))
+        well_know.assert_called_once()
+        certs.assert_called_once()
+        self.assertEqual(OperationsUser('client', 'testrealm', 'secret').config_well_know, self.WELL_KNOWN)
+        well_know.assert_called_once()
+
+    @mock.patch.object(keycloak.KeycloakOpenID, 'well_know', side_effect=Exception('keycloak down'))
+    def test_startup_not_blocked_by_keycloak(self, well_know):
+        asyncio.run(self.clients.start([('client', 'testrealm', 'secret')]))
+        well_know.assert_called_once()
+
+    @mock.patch.object(keycloak.KeycloakOpenID, 'well_know', return_value=WELL_KNOWN)
+    def test_well_known_refresh(self, well_know):
+        client = self.clients.get('client', 'testrealm', 'secret')
+        client.well_known
+        self.assertFalse(client.stale)
+        client.refresh_well_known()
+        well_know.assert_called_once()
+
+        client._fetched_at -= 3600
+        self.assertTrue(client.stale)
+        client.refresh_well_known()
+        self.assertEqual(well_know.call_count, 2)
+
+    @mock.patch.object(keycloak.KeycloakOpenID, 'well_know', side_effect=exceptions.KeycloakGetError('keycloak down'))
+    def test_well_known_kept_on_error(self, well_know):
+        client = self.clients.get('client', 'testrealm', 'secret')
+        client._well_known = self.WELL_KNOWN
+        with self.assertRaises(exceptions.KeycloakGetError):
+            client.refresh_well_known()
+        self.assertEqual(client.well_known, self.WELL_KNOWN)
+
+
+def create_signing_key(kid):
+    """Private key in PEM and the matching public JWK."""
+
+    # python-rsa is slow to generate keys, a short one is enough to sign test tokens
+    _, private_key = rsa.newkeys(1024)
+    pem = private_key.save_pkcs1()
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk['kid'] = kid
+    return pem, public_jwk
+
+
+class TokenVerificationTests(unittest.TestCase):
+
+    WELL_KNOWN = {"issuer": "http://keycloak/auth/realms/testrealm"}
+
+    @classmethod
+    def setUpClass(self):
+        self.pem, self.public_jwk = create_signing_key('key1')
+
+    def setUp(self):
+        patcher = mock.patch('module_keycloak.ops_user.openid_clients', OpenIDClients('http://keycloak/auth/'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name, value in [('well_know', self.WELL_KNOWN), ('certs', {"keys": [self.public_jwk]})]:
+            patcher = mock.patch.object(keycloak.KeycloakOpenID, name, return_value=value)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def issue_token(self, kid='key1', **claims):
+        now = int(time.time())
+        payload = {
+            "iss": self.WELL_KNOWN["issuer"], "iat": now, "exp": now + 300, "preferred_username": "unittestuser",
+        }
+        payload.update(claims)
+        # a claim set to None is left out of the token
+        payload = {name: value for name, value in payload.items() if value is not None}
+        return {"access_token": jwt.encode(payload, self.pem, algorithm='RS256', headers={'kid': kid})}
+
+    def get_token_claims(self, user_client):
+        return asyncio.run(user_client.get_token_claims())
+
+    def test_claims_verified_locally(self):
+        sent = []
+        with mock_upstream(lambda request: sent.append(request)):
+            user_client = OperationsUser('client', 'testrealm', 'secret')
+            user_client.token = self.issue_token()
+            claims = self.get_token_claims(user_client)
+        self.assertEqual(claims["preferred_username"], "unittestuser")
+        self.assertEqual(sent, [])
+        self.certs.assert_called_once()
+
+    def test_invalid_claims(self):
+        user_client = OperationsUser('client', 'testrealm', 'secret')
+        for claims in [{"exp": int(time.time()) - 60}, {"exp": None}, {"iss": "http://attacker/realms/testrealm"}]:
+            user_client.token = self.issue_token(**claims)
+            with self.assertRaises(InvalidToken):
+                self.get_token_claims(user_client)
+
+        user_client.token = {"access_token": "not-a-token"}
+        with self.assertRaises(InvalidToken):
+            self.get_token_claims(user_client)
+
+    def test_unknown_key_falls_back_to_userinfo(self):
+        sent = []
+
+        def userinfo(request):
+            sent.append(request)
+            return httpx.Response(200, json={"preferred_username": "u"})
+
+        with mock_upstream(userinfo):
+            user_client = OperationsUser('client', 'testrealm', 'secret')
+            user_client.token = self.issue_token(kid='rotated')
+            self.assertEqual(self.get_token_claims(user_client), {"preferred_username": "u"})
+        self.assertEqual(str(sent[0].url), "http://keycloak/auth/realms/testrealm/protocol/openid-connect/userinfo")
+        self.assertEqual(sent[0].headers["Authorization"], "Bearer " + user_client.token["access_token"])
+        # the keys were just fetched, an unknown key does not fetch them again right away
+        self.certs.assert_called_once()
+
+    def test_rotated_key_is_fetched_once(self):
+        user_client = OperationsUser('client', 'testrealm', 'secret')
+        user_client.verify_token(self.issue_token()["access_token"])
+        pem, public_jwk = create_signing_key('key2')
+        self.certs.return_value = {"keys": [self.public_jwk, public_jwk]}
+        self.certs.side_effect = lambda: time.sleep(0.05) or self.certs.return_value
+        user_client.token_verifier.jwks._fetched_at -= 60
+
+        now = int(time.time())
+        claims = {"iss": self.WELL_KNOWN["issuer"], "iat": now, "exp": now + 300, "preferred_username": "rotated"}
+        token = jwt.encode(claims, pem, algorithm='RS256', headers={'kid': 'key2'})
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: user_client.verify_token(token), range(8)))
+        self.assertEqual({result["preferred_username"] for result in results}, {"rotated"})
+        self.assertEqual(self.certs.call_count, 2)
+
+    def test_audience(self):
+        user_client = OperationsUser('client', 'testrealm', 'secret')
+        token = self.issue_token(aud="service_auth")["access_token"]
+        self.assertEqual(user_client.verify_token(token, "service_auth")["aud"], "service_auth")
+        with self.assertRaises(InvalidToken):
+            user_client.verify_token(token, "another_service")
+
+    def test_token_verify(self):
+        token = self.issue_token(
+            aud=ConfigSettings.KEYCLOAK_CLIENT_ID, realm_access={"roles": ["admin"]}, email="unittestuser@example.com"
+        )
+        app = SetupTest(Logger(name='test_user_apis.log')).app
+        response = app.post('/v1/users/token/verify', json={"token": token["access_token"]})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()["result"]
+        self.assertEqual(result["username"], "unittestuser")
+        self.assertEqual(result["email"], "unittestuser@example.com")
+        self.assertEqual(result["realm_roles"], ["admin"])
+
+        response = app.post('/v1/users/token/verify', json={"token": token["access_token"][:-4] + "AAAA"})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response.json()["error_msg"].startswith("Invalid token : "))
+
+        # tokens issued to another client, or to no client at all, are refused
+        for aud in ["another_service", None]:
+            response = app.post('/v1/users/token/verify', json={"token": self.issue_token(aud=aud)["access_token"]})
+            self.assertEqual(response.status_code, 401)
+
+    def test_token_verify_authorized_party(self):
+        # without an audience mapper Keycloak names the client in azp only
+        app = SetupTest(Logger(name='test_user_apis.log')).app
+        token = self.issue_token(aud="account", azp=ConfigSettings.KEYCLOAK_CLIENT_ID)
+        response = app.post('/v1/users/token/verify', json={"token": token["access_token"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["result"]["username"], "unittestuser")
+
+        token = self.issue_token(aud=None, azp=ConfigSettings.KEYCLOAK_CLIENT_ID)
+        response = app.post('/v1/users/token/verify', json={"token": token["access_token"]})
+        self.assertEqual(response.status_code, 200)
+
+        for azp in ["another_service", None]:
+            token = self.issue_token(aud="account", azp=azp)
+            response = app.post('/v1/users/token/verify', json={"token": token["access_token"]})
+            self.assertEqual(response.status_code, 401)
+
+    def test_token_verify_missing(self):
+        response = SetupTest(Logger(name='test_user_apis.log')).app.post('/v1/users/token/verify', json={})
+        self.assertEqual(response.status_code, 422)
+
+    @mock.patch.object(OperationsUser, 'get_token', return_value={})
+    @mock.patch.object(OperationsUser, 'get_token_claims', side_effect=InvalidToken('Signature verification failed.'))
+    def test_auth_invalid_token(self, get_token_claims, get_token):
+        response = SetupTest(Logger(name='test_user_apis.log')).app.post('/v1/users/auth', json=UserTests.AUTH_DATA)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()["error_msg"], "User authentication failed : Signature verification failed.")
+
+
+class AsyncUpstreamTests(unittest.TestCase):
+
+    ADMIN_TOKEN = {"access_token": "admin-token"}
+
+    def keycloak(self, request):
+        self.sent.append(request)
+        if request.url.path.endswith('/protocol/openid-connect/token'):
+            return httpx.Response(200, json=self.ADMIN_TOKEN)
+        if request.url.path.endswith('/users'):
+            first = int(request.url.params["first"])
+            users = [{"id": "1", "email": "a@test.com"}, {"id": "2", "email": "ab@test.com"}]
+            return httpx.Response(200, json=users[first:first + int(request.url.params["max"])])
+        return httpx.Response(500, json={"message": "keycloak error"})
+
+    def setUp(self):
+        self.sent = []
+        for target, value in (('admin_tokens', AdminTokenManager()), ('role_members', RoleMembersCache())):
+            patcher = mock.patch(f'module_keycloak.ops_admin.{target}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_admin_requests(self):
+        with mock_upstream(self.keycloak), mock.patch('module_keycloak.ops_admin._PAGE_SIZE', 1):
+            admin_client = OperationsAdmin('testrealm', server_url='http://keycloak/auth/')
+            user = asyncio.run(admin_client.get_user_by_email("ab@test.com"))
+            self.assertEqual(user["id"], "2")
+            with self.assertRaises(exceptions.KeycloakGetError) as error:
+                asyncio.run(admin_client.get_user_info("3"))
+        self.assertEqual(error.exception.response_code, 500)
+        self.assertEqual(error.exception.error_message, "keycloak error")
+
+        # one token, then the users page by page until an empty page
+        paths = [request.url.path for request in self.sent]
+        self.assertEqual(paths.count('/auth/realms/testrealm/protocol/openid-connect/token'), 1)
+        self.assertEqual([request.url.params.get("first") for request in self.sent[1:4]], ["0", "1", "2"])
+        self.assertEqual(self.sent[1].headers["Authorization"], "Bearer admin-token")
+
+    def test_user_token(self):
+        def token(request):
+            self.sent.append(request)
+            if b"password=wrong" in request.content:
+                return httpx.Response(401, json={"error": "invalid_grant"})
+            return httpx.Response(200, json={"access_token": "user-token"})
+
+        with mock.patch('module_keycloak.ops_user.openid_clients', OpenIDClients('http://keycloak/auth/')), \
+                mock.patch.object(keycloak.KeycloakOpenID, 'well_know', return_value={}), mock_upstream(token):
+            user_client = OperationsUser('client', 'testrealm', 'secret')
+            self.assertEqual(asyncio.run(user_client.get_token('u', 'p')), {"access_token": "user-token"})
+            with self.assertRaises(exceptions.KeycloakAuthenticationError):
+                asyncio.run(user_client.get_token('u', 'wrong'))
+        form = dict(httpx.QueryParams(self.sent[0].content.decode()))
+        self.assertEqual(form, {
+            "username": "u", "password": "p", "grant_type": "password",
+            "client_id": "client", "client_secret": "secret",
+        })
+
+    def test_user_list(self):
+        users = [
+            {"username": "b", "email": "b@test.com", "createdTimestamp": 1600000000000},
+            {"username": "a", "email": "a@test.com", "createdTimestamp": 1600000000000},
+        ]
+
+        def keycloak(request):
+            if request.url.path.endswith('/protocol/openid-connect/token'):
+                return httpx.Response(200, json=self.ADMIN_TOKEN)
+            if request.url.path.endswith('/roles/platform-admin/users'):
+                return httpx.Response(200, json=users[:1])
+            if request.url.path.endswith('/users/count'):
+                return httpx.Response(200, json=len(users))
+            return httpx.Response(200, json=users)
+
+        with mock_upstream(keycloak):
+            app = SetupTest(Logger(name='test_user_apis.log')).app
+            response = app.get('/v1/users', params={"order_by": "username"})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()["result"]
+        self.assertEqual([(user["username"], user["role"]) for user in result], [("a", "member"), ("b", "admin")])
+        self.assertEqual(response.json()["total"], 2)
+
+    def test_slow_upstreams_do_not_serialize(self):
+        async def slow_neo4j(request):
+            await asyncio.sleep(0.2)
+            return httpx.Response(200, json=[{"id": 1}])
+
+        async def requests():
+            neo4j_client, ldap_client = Neo4jClient(), AsyncLdapClient()
+            return await asyncio.gather(
+                neo4j_client.node_query("User", {"email": "a@test.com"}),
+                neo4j_client.node_query("User", {"email": "b@test.com"}),
+                ldap_client.get_user_by_email("a@test.com"),
+                ldap_client.get_user_by_email("b@test.com"),
+            )
+
+        def slow_ldap(email):
+            time.sleep(0.2)
+            return f'cn={email}', {}
+
+        with mock_upstream(slow_neo4j), mock.patch.object(LdapClient, 'get_user_by_email', side_effect=slow_ldap):
+            started = time.perf_counter()
+            results = asyncio.run(requests())
+            elapsed = time.perf_counter() - started
+        self.assertEqual(results[0]["result"], [{"id": 1}])
+        self.assertEqual(results[3], ('cn=b@test.com', {}))
+        self.assertLess(elapsed, 0.35)
+
+
+def create_directory_engine():
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    engine = engine.execution_options(schema_translate_map={'pilot_user_directory': None})
+    user_directory_table.metadata.create_all(engine)
+    user_directory_state_table.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(user_directory_state_table.insert().values(id=1))
+    return engine
+
+
+class UserDirectoryTests(unittest.TestCase):
+
+    def setUp(self):
+        for target, value in (('admin_tokens', AdminTokenManager()), ('role_members', RoleMembersCache())):
+            patcher = mock.patch(f'module_keycloak.ops_admin.{target}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.engine = create_directory_engine()
+        self.directory = self.create_directory()
+        self.users = {
+            str(i): {
+                "id": str(i), "username": f"user{i}", "firstName": name, "lastName": "Test",
+                "email": f"user{i}@test.com", "createdTimestamp": 1600000000000 + i * 1000,
+                "attributes": {"last_login": [f"2022-01-0{i}T00:00:00"]} if i % 2 else {"status": ["disabled"]},
+            }
+            for i, name in enumerate(["Zoe", "Yan", "Xia", "Wim", "Val"], 1)
+        }
+        self.platform_admins = {"2"}
+        self.admin_events = []
+        self.user_events = []
+        self.requests = collections.Counter()
+
+    def create_directory(self, **kwargs):
+        return UserDirectory(lambda: self.engine, 'testrealm', **dict({'max_staleness': 3600}, **kwargs))
+
+    def keycloak(self, request):
+        path = request.url.path.split('/admin/realms/testrealm/')[-1]
+        if path.endswith('/protocol/openid-connect/token'):
+            return httpx.Response(200, json={"access_token": "admin-token"})
+        first = int(request.url.params.get("first", 0))
+        if path == 'users':
+            self.requests['list'] += first == 0
+            return httpx.Response(200, json=list(self.users.values())[first:first + int(request.url.params["max"])])
+        if path == 'roles/platform-admin/users':
+            return httpx.Response(200, json=[self.users[i] for i in sorted(self.platform_admins)][first:])
+        if path in ('admin-events', 'events'):
+            self.requests[path] += 1
+            events = self.admin_events if path == 'admin-events' else self.user_events
+            return httpx.Response(200, json=events[first:first + int(request.url.params["max"])])
+        user_id = path.split('/')[1]
+        self.requests['user'] += 1
+        if user_id not in self.users:
+            return httpx.Response(404, json={"error": "User not found"})
+        if path.endswith('/role-mappings/realm'):
+            return httpx.Response(200, json=[{"name": "platform-admin"}] if user_id in self.platform_admins else [])
+        return httpx.Response(200, json=self.users[user_id])
+
+    def sync(self, directory=None):
+        with mock_upstream(self.keycloak), \
+                mock.patch.object(ConfigSettings, 'KEYCLOAK_SERVER_URL', 'http://keycloak/auth/'):
+            asyncio.run((directory or self.directory).refresh())
+
+    def search(self, **query):
+        total, users = asyncio.run(self.directory.search(**query))
+        return total, [user["username"] for user in users]
+
+    def add_event(self, events, **event):
+        # keycloak returns the newest event first
+        events.insert(0, dict(event, time=int(time.time() * 1000) + 1000 + len(events)))
+
+    def test_search_and_sort(self):
+        self.assertIsNone(asyncio.run(self.directory.search()))
+        self.sync()
+        self.assertTrue(self.directory.ready())
+        self.assertEqual(self.search(page_size=2, page=1), (5, ["user3", "user4"]))
+        self.assertEqual(self.search(order_by="firstName", page_size=2), (5, ["user5", "user4"]))
+        self.assertEqual(self.search(order_by="time_created", order_type="desc", page_size=1), (5, ["user5"]))
+        self.assertEqual(self.search(username="USER2"), (1, ["user2"]))
+        self.assertEqual(self.search(email="user", status="disabled"), (2, ["user2", "user4"]))
+        self.assertEqual(self.search(username="user", exact=True), (0, []))
+
+        total, users = asyncio.run(self.directory.search(username="user2", exact=True))
+        self.assertEqual(users, [{
+            "username": "user2", "first_name": "Yan", "last_name": "Test", "email": "user2@test.com",
+            "time_created": users[0]["time_created"], "last_login": None, "status": "disabled", "role": "admin",
+        }])
+        self.assertEqual(self.directory.stats()["served"], 7)
+        self.assertEqual(self.directory.stats()["fallbacks"], 1)
+
+    def test_events_applied(self):
+        self.sync()
+        self.users["3"]["firstName"] = "Xavier"
+        self.add_event(self.admin_events, operationType="UPDATE", resourceType="USER", resourcePath="users/3")
+        del self.users["1"]
+        self.add_event(self.admin_events, operationType="DELETE", resourceType="USER", resourcePath="users/1")
+        self.platform_admins.add("4")
+        self.add_event(
+            self.admin_events, operationType="CREATE", resourceType="REALM_ROLE_MAPPING",
+            resourcePath="users/4/role-mappings/realm",
+        )
+        self.users["6"] = dict(self.users["5"], id="6", username="user6", email="user6@test.com")
+        self.add_event(self.user_events, type="REGISTER", userId="6")
+
+        directory = self.create_directory(poll_interval=0)
+        self.sync(directory)
+        self.assertEqual(self.search(), (5, ["user2", "user3", "user4", "user5", "user6"]))
+        total, users = asyncio.run(self.directory.search(page_size=3))
+        self.assertEqual([(user["first_name"], user["role"]) for user in users], [
+            ("Yan", "admin"), ("Xavier", "member"), ("Wim", "admin"),
+        ])
+
+        # no full listing, and the events already applied are not fetched again
+        self.sync(directory)
+        self.assertEqual(self.requests["list"], 1)
+        self.assertEqual(self.requests["user"], 7)
+        stats = directory.stats()
+        self.assertEqual((stats["polls"], stats["events"], stats["users_applied"]), (2, 4, 4))
+        self.assertEqual(stats["last_event_time"], max(event["time"] for event in self.admin_events) / 1000)
+        self.assertLess(stats["lag"], 5)
+
+    def test_reconciled_by_checksum(self):
+        self.sync()
+        # changed without an event keycloak saved
+        self.users["3"]["email"] = "xia@test.com"
+        del self.users["4"]
+        directory = self.create_directory(reconcile_interval=0)
+        self.sync(directory)
+        self.assertEqual(self.requests["list"], 2)
+        self.assertEqual(directory.stats()["drift"], 2)
+        self.assertEqual(self.search(email="test.com"), (4, ["user1", "user2", "user3", "user5"]))
+        self.assertEqual(self.search(email="xia"), (1, ["user3"]))
+
+    def test_claimed_by_one_worker(self):
+        self.sync()
+        # the other workers find the copy made by the first one, one of them polls the events
+        for _ in range(3):
+            other = self.create_directory()
+            self.sync(other)
+            self.assertTrue(other.ready())
+        self.assertEqual(self.requests, {"list": 1, "admin-events": 1, "events": 1})
+
+    def test_failed_reconciliation_retried(self):
+        self.users["1"]["username"] = None
+        with self.assertRaises(IntegrityError):
+            self.sync()
+        self.users["1"]["username"] = "user1"
+        self.sync()
+        self.assertEqual(self.search()[0], 5)
+
+    def test_stale_copy_left_to_keycloak(self):
+        self.directory = self.create_directory(max_staleness=0)
+        self.sync()
+        self.assertIsNone(asyncio.run(self.directory.search()))
+
+    def test_database_errors_left_to_keycloak(self):
+        self.sync()
+        with self.engine.begin() as conn:
+            conn.execute('DROP TABLE user_directory')
+        self.assertIsNone(asyncio.run(self.directory.search()))
+        self.assertEqual(self.directory.stats()["fallbacks"], 1)
+
+    def walk(self, page, **query):
+        """Usernames of every page of a keyset paginated listing."""
+
+        usernames, cursor = [], None
+        while True:
+            total, users, cursor = page(cursor, **query)
+            usernames.append([user["username"] for user in users])
+            if cursor is None:
+                return usernames
+
+    def directory_page(self, cursor, **query):
+        after = None if cursor is None else read_cursor(encode_cursor(cursor))
+        return asyncio.run(self.directory.search_after(after=after, limit=2, **query))
+
+    def test_keyset_walk(self):
+        self.sync()
+        # user2 and user4 have no last_login, which come last
+        for order_type in ("asc", "desc"):
+            usernames = self.walk(self.directory_page, order_by="last_login", order_type=order_type)
+            total, users = self.search(order_by="last_login", order_type=order_type, page_size=10)
+            self.assertEqual(sum(usernames, []), users)
+            self.assertEqual(len(usernames), 3)
+        self.assertEqual(users, ["user4", "user2", "user5", "user3", "user1"])
+
+        total, users, cursor = self.directory_page(None, order_by="firstName")
+        self.assertEqual((total, [user["username"] for user in users]), (5, ["user5", "user4"]))
+        # a user created before the cursor does not move the next pages
+        row = to_row(dict(self.users["1"], id="0", username="user0", firstName="Abe"), set())
+        self.directory.apply([row], [], {})
+        total, users, cursor = self.directory_page(cursor)
+        self.assertEqual((total, [user["username"] for user in users]), (None, ["user3", "user2"]))
+
+    def test_keyset_walk_from_keycloak(self):
+        self.sync()
+        directory_usernames = self.walk(self.directory_page, order_by="last_login", order_type="desc")
+
+        def keycloak_page(cursor, **query):
+            after = None if cursor is None else read_cursor(encode_cursor(cursor))
+            with mock_upstream(self.keycloak), mock.patch.object(ConfigSettings, 'KEYCLOAK_REALM', 'testrealm'), \
+                    mock.patch.object(ConfigSettings, 'KEYCLOAK_SERVER_URL', 'http://keycloak/auth/'):
+                return asyncio.run(UserList.list_after_from_keycloak(None, None, after=after, limit=2, **query))
+
+        self.assertEqual(self.walk(keycloak_page, order_by="last_login", order_type="desc"), directory_usernames)
+
+    def test_keyset_pages_served(self):
+        app = SetupTest(Logger(name='test_user_apis.log')).app
+        self.sync()
+        with mock.patch('users.ops_user.user_directory', self.directory):
+            response = app.get('/v1/users', params={"limit": 3, "order_by": "email"})
+            self.assertEqual(response.json()["total"], 5)
+            response = app.get('/v1/users', params={"cursor": response.json()["next_cursor"]})
+            self.assertEqual([user["username"] for user in response.json()["result"]], ["user4", "user5"])
+            self.assertEqual(response.json()["next_cursor"], None)
+            response = app.get('/v1/users', params={"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+        for limit in [0, -1, MAX_LIMIT + 1]:
+            response = app.get('/v1/users', params={"limit": limit})
+            self.assertEqual(response.status_code, 422)
+        with self.assertRaises(ValueError):
+            keyset_page([{"id": "1"}], 'id', False, lambda row: row['id'], lambda row: row['id'], None, 0)
+
+
+class HTTPClientsTests(unittest.TestCase):
+
+    def test_pooled_for_the_app_lifetime(self):
+        clients = HTTPClients(max_connections=4, max_keepalive_connections=2, keepalive_expiry=30)
+
+        async def lifetime():
+            await clients.start()
+            keycloak_client = clients.get('keycloak')
+            self.assertIs(clients.get('keycloak'), keycloak_client)
+            self.assertIsNot(clients.get('neo4j'), keycloak_client)
+            self.assertEqual(clients.stats()["upstreams"], ['email', 'keycloak', 'neo4j', 'utility'])
+            await clients.stop()
+            return keycloak_client
+
+        keycloak_client = asyncio.run(lifetime())
+        self.assertTrue(keycloak_client.is_closed)
+        self.assertEqual(clients.stats()["upstreams"], [])
+        self.assertEqual(clients.stats()["max_keepalive_connections"], 2)
+
+    def test_new_client_in_another_loop(self):
+        clients = HTTPClients()
+
+        async def get():
+            return clients.get('keycloak')
+
+        self.assertIsNot(asyncio.run(get()), asyncio.run(get()))
+
+
+class LastLoginQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.written = []
+
+    async def write(self, batch):
+        self.written.append(list(batch))
+        return [(key, value) for key, value in batch if key == 'broken']
+
+    def test_coalesce_and_batch(self):
+        queue = WriteBehindQueue('test', self.write, window=60, batch_size=2)
+        for username, last_login in [('a', '1'), ('b', '2'), ('a', '3'), ('c', '4')]:
+            queue.put(username, last_login)
+        self.assertEqual(queue.stats()["depth"], 3)
+        self.assertEqual(queue.stats()["coalesced"], 1)
+
+        # nothing is due before the window ends
+        self.assertEqual(self.loop.run_until_complete(queue.flush()), 0)
+        self.assertEqual(self.loop.run_until_complete(queue.flush(force=True)), 3)
+        self.assertEqual(self.written, [[('a', '3'), ('b', '2')], [('c', '4')]])
+        self.assertEqual(queue.stats()["flushed"], 3)
+
+    def test_full_queue_drops(self):
+        queue = WriteBehindQueue('test', self.write, max_size=1)
+        self.assertTrue(queue.put('a', '1'))
+        self.assertFalse(queue.put('b', '2'))
+        self.assertTrue(queue.put('a', '3'))
+        self.assertEqual(queue.stats()["dropped"], 1)
+
+    def test_stop_drains(self):
+        queue = WriteBehindQueue('test', self.write, window=60, interval=60)
+        self.loop.run_until_complete(queue.start())
+        queue.put('a', '1')
+        queue.put('broken', '2')
+        self.loop.run_until_complete(queue.stop())
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.stats()["flushed"], 1)
+        self.assertEqual(queue.stats()["failed"], 1)
+
+    def test_write_last_logins(self):
+        sent = []
+
+        def neo4j(request):
+            sent.append(request)
+            if request.method == 'PUT':
+                return httpx.Response(200, json={})
+            name = json.loads(request.content)["name"]
+            if name == 'c':
+                return httpx.Response(500, json={"error_msg": "neo4j down"})
+            return httpx.Response(200, json=[{"id": 7}] if name == 'a' else [])
+
+        with mock_upstream(neo4j):
+            failed = self.loop.run_until_complete(write_last_logins([('a', '1'), ('b', '2'), ('c', '3')]))
+        self.assertEqual(failed, [('c', '3')])
+        updates = [request for request in sent if request.method == 'PUT']
+        url = ConfigSettings.NEO4J_SERVICE + "nodes/User/node/7"
+        self.assertEqual([str(request.url) for request in updates], [url])
+        self.assertEqual(json.loads(updates[0].content), {"last_login": '1'})
+
+    def test_lastlogin_is_queued(self):
+        sent = []
+        app = SetupTest(Logger(name='test_user_apis.log')).app
+        with mock.patch.object(last_login_queue, '_pending', collections.OrderedDict()), \
+                mock_upstream(lambda request: sent.append(request)):
+            response = app.post('/v1/users/lastlogin', json={"username": "unittestuser"})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("unittestuser", last_login_queue._pending)
+        self.assertEqual(sent, [])
+
+
+class WriteSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'spool', 'write_behind.db')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.written = []
+        self.down = False
+
+    async def write(self, batch):
+        if self.down:
+            raise Exception('neo4j down')
+        self.written.extend(batch)
+        return [(key, value) for key, value in batch if key == 'broken']
+
+    def spool(self, **kwargs):
+        spool = WriteSpool(self.path, **kwargs)
+        self.addCleanup(self.loop.run_until_complete, spool.stop())
+        return spool
+
+    def replay(self, spool, force=False):
+        return self.loop.run_until_complete(spool.replay(force))
+
+    def test_failed_writes_are_spooled_and_replayed(self):
+        spool = self.spool(batch_size=2)
+        queue = WriteBehindQueue('test', self.write, window=60, spool=spool)
+        self.down = True
+        queue.put('a', '1')
+        queue.put('b', '2')
+        self.loop.run_until_complete(queue.flush(force=True))
+        self.assertEqual(queue.stats()["spooled"], 2)
+
+        # later writes queue up behind the spooled ones to keep their order
+        self.down = False
+        queue.put('a', '3')
+        self.loop.run_until_complete(queue.flush(force=True))
+        self.assertEqual(self.written, [])
+        self.assertEqual(spool.measure(), 3)
+
+        self.assertEqual(self.replay(spool), 3)
+        self.assertEqual(self.written, [('a', '1'), ('b', '2'), ('a', '3')])
+        self.assertEqual(spool.measure(), 0)
+        self.assertEqual(spool.stats()["depth"], 0)
+        self.assertFalse(spool.pending('test'))
+
+    def test_replay_backs_off(self):
+        spool = self.spool(backoff=10, max_backoff=15)
+        spool.register('test', self.write)
+        spool.append('test', [('a', '1'), ('broken', '2')])
+        self.assertEqual(self.replay(spool), 1)
+        self.assertEqual(spool.stats()["consecutive_failures"], 1)
+        self.assertGreater(spool.stats()["retry_in"], 9)
+
+        # nothing is replayed while backing off
+        self.assertEqual(self.replay(spool), 0)
+        self.assertEqual(len(self.written), 2)
+
+        self.replay(spool, force=True)
+        self.assertEqual(spool.stats()["consecutive_failures"], 2)
+        self.assertLessEqual(spool.stats()["retry_in"], 15)
+        self.assertEqual(spool.measure(), 1)
+
+    def test_spool_survives_restart(self):
+        spool = self.spool()
+        spool.append('test', [('a', '1')])
+        self.loop.run_until_complete(spool.stop())
+
+        spool = self.spool()
+        spool.register('test', self.write)
+        self.assertEqual(self.replay(spool), 1)
+        self.assertEqual(self.written, [('a', '1')])
+
+    def test_size_limit_evicts_oldest(self):
+        spool = self.spool(max_rows=2)
+        spool.register('test', self.write)
+        spool.append('test', [('a', '1'), ('b', '2')])
+        self.assertEqual(spool.append('test', [('c', '3')]), 1)
+        self.assertEqual(spool.stats()["evicted"], 1)
+        self.replay(spool)
+        self.assertEqual(self.written, [('b', '2'), ('c', '3')])
+
+    def test_full_queue_spills_to_spool(self):
+        spool = self.spool()
+        queue = WriteBehindQueue('test', self.write, window=60, max_size=1, spool=spool)
+        with mock.patch.object(spool, 'append') as append:
+            self.assertTrue(queue.put('a', '1'))
+            self.assertTrue(queue.put('b', '2'))
+            # the overflow is bounded too
+            self.assertFalse(queue.put('c', '3'))
+        # the caller never waits on the spool file, the background task spools the overflow
+        append.assert_not_called()
+        self.assertEqual(queue.stats()["overflow"], 1)
+        self.assertEqual(queue.stats()["dropped"], 1)
+
+        self.loop.run_until_complete(queue.flush())
+        self.assertEqual(queue.stats()["overflow"], 0)
+        self.assertEqual(queue.stats()["spooled"], 1)
+        self.assertTrue(spool.pending('test'))
+        self.assertEqual(len(queue), 1)
+
+    def test_hanging_neo4j_is_spooled(self):
+        spool = self.spool()
+        queue = WriteBehindQueue('test', write_last_logins, window=60, max_size=3, spool=spool)
+        sent = []
+
+        async def neo4j(request):
+            sent.append(request)
+            # the client timeout ends a request neo4j never answers
+            await asyncio.sleep(0.01)
+            raise httpx.ReadTimeout('neo4j hangs', request=request)
+
+        for username in ['a', 'b', 'c']:
+            queue.put(username, '1')
+        with mock_upstream(neo4j):
+            self.loop.run_until_complete(queue.flush(force=True))
+            # the batch ends at the first timeout instead of waiting on every user
+            self.assertEqual(len(sent), 1)
+            for username in ['d', 'e', 'f', 'g']:
+                queue.put(username, '2')
+            self.assertEqual(queue.stats()["overflow"], 1)
+            self.loop.run_until_complete(queue.stop())
+        # shutting down does not wait on neo4j either
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.stats()["dropped"], 0)
+        self.assertEqual(queue.stats()["spooled"], 7)
+        self.assertEqual(spool.measure(), 7)
+
+    def test_stats_do_not_read_the_spool(self):
+        spool = self.spool()
+        spool.append('test', [('a', '1')])
+        with mock.patch.object(spool, '_connection', side_effect=AssertionError('spool file read')):
+            self.assertEqual(spool.stats()["depth"], 0)
+        self.assertEqual(spool.measure(), 1)
+        self.assertEqual(spool.stats()["depth"], 1)
+
+
 if __name__ == "__main__":
     unittest.main(warnings='ignore')
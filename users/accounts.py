@@ -18,7 +18,6 @@
 # permissions and limitations under the Licence.
 # 
 
-import requests
 from common.services.logger_services.logger_factory_service import SrvLoggerFactory
 # from flask import request
 # from flask_restx import Resource
@@ -35,8 +34,9 @@ from resources.error_handler import APIException
 from resources.utils import fetch_geid
 from resources.utils import get_formatted_datetime
 from resources.error_handler import catch_internal
+from resources.http_clients import http_clients
 
-from services.data_providers.ldap_client import LdapClient
+from services.data_providers.ldap_client import AsyncLdapClient
 from services.data_providers.neo4j_client import Neo4jClient
 from services.notifier_services.email_service import SrvEmail
 
@@ -53,31 +53,31 @@ logger = SrvLoggerFactory(_API_NAMESPACE).get_logger()
 @cbv.cbv(router)
 class AccountRequest:
 
-    def add_user_to_ad_group(self, user_dn, group):
+    async def add_user_to_ad_group(self, user_dn, group):
         try:
-            ldap_client = LdapClient()
-            ldap_client.connect(group)
-            ldap_client.add_user_to_group(user_dn)
-            ldap_client.disconnect()
+            ldap_client = AsyncLdapClient()
+            await ldap_client.connect(group)
+            await ldap_client.add_user_to_group(user_dn)
+            await ldap_client.disconnect()
         except Exception as e:
             error_msg = f"Error adding user to AD group: {str(e)}"
             logger.error(error_msg)
             raise APIException(status_code=EAPIResponseCode.internal_error.value, error_msg=error_msg)
 
-    def get_project_by_code(self, code):
+    async def get_project_by_code(self, code):
         neo4j_client = Neo4jClient()
-        response = neo4j_client.get_container_by_code(code)
+        response = await neo4j_client.get_container_by_code(code)
         if response.get("code") != 200:
             error_msg = 'Error getting container in neo4j' + str(response.get("result"))
             logger.error(error_msg)
             raise APIException(status_code=EAPIResponseCode.internal_error.value, error_msg=str(error_msg))
         return response["result"]
 
-    def is_duplicate_user(self, username, email):
+    async def is_duplicate_user(self, username, email):
         neo4j_client = Neo4jClient()
-        response = neo4j_client.node_query("User", {"username": username})
+        response = await neo4j_client.node_query("User", {"username": username})
         if not response.get("result"):
-            response = neo4j_client.node_query("User", {"email": email})
+            response = await neo4j_client.node_query("User", {"email": email})
 
         if response.get("result"):
             user_node = response.get("result")[0]
@@ -91,7 +91,9 @@ class AccountRequest:
                     "code": ConfigSettings.TEST_PROJECT_CODE,
                 }
             }
-            response = requests.post(ConfigSettings.NEO4J_SERVICE + "relations/query", json=payload)
+            response = await http_clients.get('neo4j').post(
+                ConfigSettings.NEO4J_SERVICE + "relations/query", json=payload
+            )
             if response.json():
                 error_msg = f"User already exists in Neo4j in test project: {username}"
                 logger.error(error_msg)
@@ -106,7 +108,7 @@ class AccountRequest:
                 Please contact the user to determine further action.
                 """
                 email_service = SrvEmail()
-                email_service.send(
+                await email_service.send(
                     subject="Action Required: Existing user requested a Test Account",
                     receiver=ConfigSettings.EMAIL_SUPPORT,
                     sender=ConfigSettings.EMAIL_SUPPORT,
@@ -127,14 +129,14 @@ class AccountRequest:
                 return True
             return False
 
-    def create_user(self, email):
+    async def create_user(self, email):
         neo4j_client = Neo4jClient()
         # Add neo4j user
-        response = neo4j_client.create_user({
+        response = await neo4j_client.create_user({
             "email": email,
             "role": "member",
             "status": "pending",
-            "global_entity_id": fetch_geid(),
+            "global_entity_id": await fetch_geid(),
         })
         if response.get("code") != 200:
             error_msg = 'Error creating user in neo4j' + str(response.get("result"))
@@ -143,10 +145,10 @@ class AccountRequest:
         user_node = response["result"]
 
         # Get project node
-        project_node = self.get_project_by_code(ConfigSettings.TEST_PROJECT_CODE)
+        project_node = await self.get_project_by_code(ConfigSettings.TEST_PROJECT_CODE)
 
         # Add neo4j relation
-        response = neo4j_client.create_relation(
+        response = await neo4j_client.create_relation(
             user_node["id"],
             project_node["id"],
             ConfigSettings.TEST_PROJECT_ROLE,
@@ -170,18 +172,18 @@ class AccountRequest:
 
         email_service = SrvEmail()
         neo4j_client = Neo4jClient()
-        if self.is_duplicate_user(username, email):
+        if await self.is_duplicate_user(username, email):
             res.error_msg = f'duplicate user'
             res.code = EAPIResponseCode.bad_request
             return res.json_response()
 
-        ldap_client = LdapClient()
-        ldap_client.connect(ConfigSettings.TEST_PROJECT_CODE)
-        user_dn, user_data = ldap_client.get_user_by_username(username)
+        ldap_client = AsyncLdapClient()
+        await ldap_client.connect(ConfigSettings.TEST_PROJECT_CODE)
+        user_dn, user_data = await ldap_client.get_user_by_username(username)
         if not user_dn:
             # User not found, send alert to support
             logger.info(f"User not found in AD: {username}")
-            email_service.send(
+            await email_service.send(
                 subject="Request for a Test Account Denied - Invalid Username",
                 receiver=ConfigSettings.EMAIL_SUPPORT,
                 sender=ConfigSettings.EMAIL_SUPPORT,
@@ -198,7 +200,7 @@ class AccountRequest:
                     'url': f'{ConfigSettings.DOMAIN_NAME}/{ConfigSettings.START_PATH}',
                 },
             )
-            email_service.send(
+            await email_service.send(
                 subject="Your request for a test account is under review",
                 receiver=email,
                 sender=ConfigSettings.EMAIL_SUPPORT,
@@ -221,12 +223,12 @@ class AccountRequest:
         if ldap_email.lower() == email.lower():
             # User found in AD, create user and send email to user and support
             logger.info(f"User found in AD, email matches: {username}")
-            self.add_user_to_ad_group(user_dn, ConfigSettings.LDAP_USER_GROUP)
-            self.add_user_to_ad_group(user_dn, ConfigSettings.TEST_PROJECT_CODE)
-            self.create_user(email)
+            await self.add_user_to_ad_group(user_dn, ConfigSettings.LDAP_USER_GROUP)
+            await self.add_user_to_ad_group(user_dn, ConfigSettings.TEST_PROJECT_CODE)
+            await self.create_user(email)
 
-            project_node = self.get_project_by_code(ConfigSettings.TEST_PROJECT_CODE)
-            email_service.send(
+            project_node = await self.get_project_by_code(ConfigSettings.TEST_PROJECT_CODE)
+            await email_service.send(
                 subject="Auto-Notification: Request for a Test Account Approved",
                 receiver=ConfigSettings.EMAIL_SUPPORT,
                 sender=ConfigSettings.EMAIL_SUPPORT,
@@ -244,7 +246,7 @@ class AccountRequest:
                     'url': f'{ConfigSettings.DOMAIN_NAME}/{ConfigSettings.START_PATH}',
                 },
             )
-            email_service.send(
+            await email_service.send(
                 subject="Your request for a test account has been approved",
                 receiver=email,
                 sender=ConfigSettings.EMAIL_SUPPORT,
@@ -263,7 +265,7 @@ class AccountRequest:
         else:
             # User found in AD but email doesn't match, send email to support and notify user
             logger.info(f"User found in AD, email doesn't match: {username}")
-            email_service.send(
+            await email_service.send(
                 subject="Action Required: Request for a Test Account submitted, review required",
                 receiver=ConfigSettings.EMAIL_SUPPORT,
                 sender=ConfigSettings.EMAIL_SUPPORT,
@@ -281,7 +283,7 @@ class AccountRequest:
                     'url': f'{ConfigSettings.DOMAIN_NAME}/{ConfigSettings.START_PATH}',
                 },
             )
-            email_service.send(
+            await email_service.send(
                 subject="Your request for a test account is under review",
                 receiver=email,
                 sender=ConfigSettings.EMAIL_SUPPORT,
@@ -293,7 +295,7 @@ class AccountRequest:
                     "support_email": ConfigSettings.EMAIL_SUPPORT,
                 },
             )
-        ldap_client.disconnect()
+        await ldap_client.disconnect()
         return res.json_response()
 
 @cbv.cbv(router)
@@ -312,7 +314,7 @@ class ContractRequest:
         logger.info(f"ContractRequest called: {email}")
 
         email_service = SrvEmail()
-        email_service.send(
+        await email_service.send(
             subject="Action Required: Pending Request for a Test Account",
             receiver=ConfigSettings.EMAIL_SUPPORT,
             sender=ConfigSettings.EMAIL_SUPPORT,
@@ -330,7 +332,7 @@ class ContractRequest:
                 'url': f'{ConfigSettings.DOMAIN_NAME}/{ConfigSettings.START_PATH}',
             },
         )
-        email_service.send(
+        await email_service.send(
             subject="Your request for a test account is under review",
             receiver=email,
             sender=ConfigSettings.EMAIL_SUPPORT,
@@ -25,8 +25,9 @@ from fastapi import FastAPI
 # from app.routers.v2 import api_data_download as api_data_download_v2
 # from app.routers.v2 import api_object_get as api_object_get
 
-from users import ops_user, user_account_management, accounts, ops_admin
+from users import ops_user, user_account_management, accounts, ops_admin, diagnostics
 from users.permissions import permissions
+from users.permissions import policies
 
 
 def api_registry(app: FastAPI):
@@ -34,5 +35,7 @@ def api_registry(app: FastAPI):
     app.include_router(ops_user.router, prefix="/v1")
     app.include_router(user_account_management.router, prefix="/v1")
     app.include_router(permissions.router, prefix="/v1")
+    app.include_router(policies.router, prefix="/v1")
     app.include_router(accounts.router, prefix="/v1")
     app.include_router(ops_admin.router, prefix="/v1")
+    app.include_router(diagnostics.router, prefix="/v1")
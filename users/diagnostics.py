@@ -0,0 +1,64 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+from fastapi import APIRouter
+from fastapi_utils import cbv
+
+from models.api_response import APIResponse
+from models.api_response import EAPIResponseCode
+from module_keycloak.ops_admin import admin_tokens
+from module_keycloak.ops_admin import realm_roles
+from module_keycloak.ops_admin import role_members
+from module_keycloak.ops_user import openid_clients
+from resources.error_handler import catch_internal
+from resources.http_clients import http_clients
+from services.write_behind.last_login import last_login_queue
+from services.write_behind.last_login import write_spool
+from users.ops_user import user_directory
+from users.permissions.permissions import policy_store
+
+router = APIRouter()
+
+_API_TAG = 'v1/diagnostics'
+_API_NAMESPACE = "api_diagnostics"
+
+
+@cbv.cbv(router)
+class Diagnostics:
+
+    @router.get("/diagnostics", tags=[_API_TAG],
+                summary='report the in-memory state of the worker serving the request')
+    @catch_internal(_API_NAMESPACE)
+    async def get(self):
+        res = APIResponse()
+        res.result = {
+            "policy": policy_store.stats(),
+            "openid": openid_clients.stats(),
+            "admin_tokens": admin_tokens.stats(),
+            "realm_roles": realm_roles.stats(),
+            "role_members": role_members.stats(),
+            "last_login_queue": last_login_queue.stats(),
+            "write_spool": write_spool.stats(),
+            "user_directory": user_directory.stats(),
+            "http_clients": http_clients.stats(),
+        }
+        res.code = EAPIResponseCode.success
+        return res.json_response()
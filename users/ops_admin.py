@@ -20,7 +20,6 @@
 
 import json
 import math
-import httpx
 from fastapi import APIRouter
 from fastapi_utils import cbv
 # from flask import request
@@ -29,9 +28,14 @@ from fastapi_utils import cbv
 from keycloak import exceptions
 
 from resources.error_handler import catch_internal
+from resources.pagination import InvalidCursor
+from resources.pagination import decode_cursor
+from resources.pagination import encode_cursor
+from resources.pagination import keyset_page
 
 from config import ConfigSettings
 from models.api_response import APIResponse
+from models.api_response import CursorAPIResponse
 from models.api_response import EAPIResponseCode
 from models.ops_admin import UserGroupPOST, RealmRolesPOST, \
     UserInRolePOST
@@ -84,14 +88,14 @@ class GetUserByEmail:
             realm = ConfigSettings.KEYCLOAK_REALM
 
             operations_admin = OperationsAdmin(realm)
-            user = operations_admin.get_user_by_email(email)
+            user = await operations_admin.get_user_by_email(email)
             if not user:
                 res.error_msg = "Cannot find user"
                 res.code = EAPIResponseCode.not_found
                 # api.logger.info(f'GetUserByEmail not found for {email}')
                 return res.json_response()
 
-            user_info = operations_admin.get_user_info(user.get("id"))
+            user_info = await operations_admin.get_user_info(user.get("id"))
             res.result = user_info
             res.code = EAPIResponseCode.success
             # api.logger.info(f'GetUserByEmail Successful for {email}')
@@ -125,14 +129,14 @@ class UserGroup:
             groupname = data.groupname
 
             operations_admin = OperationsAdmin(realm)
-            user_id = operations_admin.get_user_id(username)
-            group = operations_admin.keycloak_admin.get_group_by_path(f"/{groupname}")
+            user_id = await operations_admin.get_user_id(username)
+            group = await operations_admin.get_group_by_path(f"/{groupname}")
             if not group:
                 group_dict = {"name": groupname}
-                operations_admin.keycloak_admin.create_group(group_dict)
-                group = operations_admin.keycloak_admin.get_group_by_path(f"/{groupname}")
+                await operations_admin.create_group(group_dict)
+                group = await operations_admin.get_group_by_path(f"/{groupname}")
 
-            operations_admin.keycloak_admin.group_user_add(user_id, group["id"])
+            await operations_admin.group_user_add(user_id, group["id"])
             res.result = 'success'
             res.code = EAPIResponseCode.success
         except Exception as e:
@@ -153,9 +157,9 @@ class UserGroup:
             realm = ConfigSettings.KEYCLOAK_REALM
 
             operations_admin = OperationsAdmin(realm)
-            user_id = operations_admin.get_user_id(username)
-            group = operations_admin.keycloak_admin.get_group_by_path(f"/{groupname}")
-            operations_admin.keycloak_admin.group_user_remove(user_id, group["id"])
+            user_id = await operations_admin.get_user_id(username)
+            group = await operations_admin.get_group_by_path(f"/{groupname}")
+            await operations_admin.group_user_remove(user_id, group["id"])
             
             res.result = 'success'
             res.code = EAPIResponseCode.success
@@ -171,6 +175,10 @@ class UserGroup:
         return res.json_response()
 
 
+# sort columns of the keyset paginated /v1/admin/roles/users
+_ROLE_USER_COLUMNS = ('username', 'first_name', 'last_name', 'email', 'permission')
+
+
 # this api is used in project creation to create three new role in keycloak
 @cbv.cbv(router)
 class RealmRoles:
@@ -188,14 +196,15 @@ class RealmRoles:
             project_code = data.project_code
 
             operations_admin = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
-            keycloak_res = operations_admin.create_project_realm_roles(project_roles, project_code)
+            keycloak_res = await operations_admin.create_project_realm_roles(project_roles, project_code)
 
-            if keycloak_res != 'created':
-                res.error_msg = keycloak_res
+            res.result = keycloak_res
+            failed = {name: result for name, result in keycloak_res.items() if result not in ('created', 'exists')}
+            if failed:
+                res.error_msg = f'create realm roles in keycloak failed: {failed}'
                 res.code = EAPIResponseCode.internal_error
                 return res.json_response()
 
-            res.result = keycloak_res
             res.code = EAPIResponseCode.success
             # return res.response, res.code
         except Exception as e:
@@ -234,25 +243,21 @@ class UserInRole:
 
         # intialize the keycloak admin to get token
         admin_client = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
-        hearder = {
-            "Authorization": "Bearer "+admin_client.token.get("access_token"),
-            "Content-Type": "application/json"
-        }
-
-        user_list = []
-        with httpx.Client() as client:
-            for role in data.role_names:
-                api = ConfigSettings.KEYCLOAK_SERVER_URL+"admin/realms/"+ConfigSettings.KEYCLOAK_REALM+"/roles/"+role+"/users"
-                api_res = client.get(api, headers=hearder)
-
-                # then return only certain of attributes to frontend
-                user_list += [{
-                    "username":user.get("username"),
-                    "first_name":user.get("firstName"),
-                    "last_name":user.get("lastName"),
-                    "email":user.get("email"),
-                    "permission": role.split("-")[-1]
-                } for user in api_res.json()]
+
+        # a user in several of the roles is listed once, with the first of them in role_names
+        users = {}
+        for role, role_users in (await admin_client.get_roles_users(data.role_names)).items():
+            for user in role_users:
+                users.setdefault(user.get("id") or user.get("username"), (role, user))
+
+        # then return only certain of attributes to frontend
+        user_list = [{
+            "username":user.get("username"),
+            "first_name":user.get("firstName"),
+            "last_name":user.get("lastName"),
+            "email":user.get("email"),
+            "permission": role.split("-")[-1]
+        } for role, user in users.values()]
 
         # the keycloak native api doesnot support the searching
         # manually to do the searching since the users is about 10
@@ -264,6 +269,9 @@ class UserInRole:
             user_list = [user for user in user_list if status == user.get("attributes",{}).get("status")]
         
 
+        if data.cursor is not None or data.limit is not None:
+            return self.page_after(user_list, order_by, order_type, data.cursor, data.limit or page_size)
+
         # here since the keycloak is NOT supporting sorting
         # manually sort the user by order_by and order_type
         if order_by:
@@ -278,4 +286,32 @@ class UserInRole:
         res.num_of_pages = math.ceil(total_users / page_size)
         res.page = page
 
+        return res.json_response()
+
+    @staticmethod
+    def page_after(user_list, order_by, order_type, cursor, limit):
+        """Keyset pagination, the usernames breaking ties."""
+
+        res = CursorAPIResponse()
+        try:
+            after = None if cursor is None else decode_cursor(cursor)
+            if after is not None and after.order_by not in _ROLE_USER_COLUMNS:
+                raise InvalidCursor(f'Invalid cursor {cursor}')
+        except InvalidCursor as e:
+            res.error_msg = str(e)
+            res.code = EAPIResponseCode.bad_request
+            return res.json_response()
+
+        if after is None:
+            column = order_by if order_by in _ROLE_USER_COLUMNS else 'username'
+            descending = order_type == 'desc'
+        else:
+            column, descending = after.order_by, after.descending
+        users, next_cursor = keyset_page(
+            user_list, column, descending, lambda user: user.get(column), lambda user: user['username'], after, limit
+        )
+
+        res.result = users
+        res.total = len(user_list)
+        res.next_cursor = None if next_cursor is None else encode_cursor(next_cursor)
         return res.json_response()
\ No newline at end of file
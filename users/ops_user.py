@@ -18,26 +18,39 @@
 # permissions and limitations under the Licence.
 # 
 
-import json
 import math
-from datetime import datetime
 from platform import platform
-import requests
-import httpx
 
 from fastapi import APIRouter
+from fastapi import Query
 from fastapi_utils import cbv
 from keycloak import exceptions
+from starlette.concurrency import run_in_threadpool
 
 from config import ConfigSettings
 from models.api_response import APIResponse
+from models.api_response import CursorAPIResponse
 from models.api_response import EAPIResponseCode
 from module_keycloak.ops_admin import OperationsAdmin
 from module_keycloak.ops_user import OperationsUser
+from module_keycloak.tokens import InvalidToken
 
 from resources.error_handler import catch_internal
-
-from models.ops_user import UserAuthPOST, UserTokenRefreshPOST, \
+from resources.http_clients import http_clients
+from resources.pagination import MAX_LIMIT
+from resources.pagination import InvalidCursor
+from resources.pagination import encode_cursor
+from resources.pagination import keyset_page
+from services.user_directory.directory import SORT_COLUMNS
+from services.user_directory.directory import UserDirectory
+from services.user_directory.directory import read_cursor
+from services.user_directory.directory import to_row
+from services.user_directory.directory import to_user
+from services.write_behind.last_login import last_login_queue
+from services.write_behind.last_login import now as last_login_now
+from users.permissions.permissions import _get_sqlalchemy_engine
+
+from models.ops_user import UserAuthPOST, UserTokenRefreshPOST, UserTokenVerifyPOST, \
     UserLastLoginPOST, UserProjectRolePOST, UserProjectRoleDELETE
 
 
@@ -48,6 +61,15 @@ router = APIRouter()
 _API_TAG = 'v1/auth'
 _API_NAMESPACE = "api_auth"
 
+user_directory = UserDirectory(
+    _get_sqlalchemy_engine,
+    ConfigSettings.KEYCLOAK_REALM,
+    poll_interval=ConfigSettings.USER_DIRECTORY_EVENT_POLL_INTERVAL,
+    reconcile_interval=ConfigSettings.USER_DIRECTORY_RECONCILE_INTERVAL,
+    max_staleness=ConfigSettings.USER_DIRECTORY_MAX_STALENESS,
+    enabled=ConfigSettings.USER_DIRECTORY_ENABLED,
+)
+
 
 # might be used by skd
 @cbv.cbv(router)
@@ -93,8 +115,8 @@ class UserAuth:
 
             # log in
             user_client = OperationsUser(client_id, realm, client_secret)
-            token = user_client.get_token(username, password)
-            user_info = user_client.get_userinfo()
+            token = await user_client.get_token(username, password)
+            user_info = await user_client.get_token_claims()
 
             if user_info['preferred_username'] != username:
                 # error_msg = 'User authentication failed '
@@ -103,21 +125,8 @@ class UserAuth:
                 # api.logger.error(error_msg)
                 return res.json_response()
 
-            # Get neo4j user id by username
-            try:
-                response = requests.post(
-                    ConfigSettings.NEO4J_SERVICE + "nodes/User/query",
-                    json={"name": username}
-                )
-                neo4j_user_id = json.loads(response.content)[0]["id"]
-                last_login = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
-                response = requests.put(
-                    ConfigSettings.NEO4J_SERVICE + f"nodes/User/node/{neo4j_user_id}",
-                    json={"last_login": str(last_login)}
-                )
-            except Exception as e:
-                # api.logger.error("Error updating last_login " + str(e))
-                pass
+            # saved in neo4j by the write-behind queue, off the login path
+            last_login_queue.put(username, last_login_now())
 
             res.result = token
             res.code = EAPIResponseCode.success
@@ -129,6 +138,9 @@ class UserAuth:
         except exceptions.KeycloakGetError as err:
             res.error_msg = str(err)
             res.code = EAPIResponseCode.unauthorized
+        except InvalidToken as err:
+            res.error_msg = f'User authentication failed : {err}'
+            res.code = EAPIResponseCode.unauthorized
         except Exception as e:
             res.error_msg = f'User authentication failed : {e}'
             res.code = EAPIResponseCode.internal_error
@@ -179,7 +191,7 @@ class UserRefresh:
             client_id = ConfigSettings.KEYCLOAK_CLIENT_ID
             client_secret = ConfigSettings.KEYCLOAK_SECRET
             user_client = OperationsUser(client_id, realm, client_secret)
-            token = user_client.get_refresh_token(token)
+            token = await user_client.get_refresh_token(token)
 
             res.result = token
             res.code = EAPIResponseCode.success
@@ -197,6 +209,43 @@ class UserRefresh:
         return res.json_response()
 
 
+# used by the other services instead of calling keycloak introspection or userinfo
+@cbv.cbv(router)
+class UserTokenVerify:
+
+    @router.post("/users/token/verify", tags=[_API_TAG],
+                 summary='verify a token of the realm and return the identity it carries')
+    @catch_internal(_API_NAMESPACE)
+    async def post(self, data: UserTokenVerifyPOST):
+        res = APIResponse()
+        try:
+            realm = ConfigSettings.KEYCLOAK_REALM
+            client_id = ConfigSettings.KEYCLOAK_CLIENT_ID
+            client_secret = ConfigSettings.KEYCLOAK_SECRET
+            user_client = OperationsUser(client_id, realm, client_secret)
+            audience = ConfigSettings.KEYCLOAK_TOKEN_AUDIENCE
+            claims = await run_in_threadpool(user_client.verify_token, data.token, audience)
+
+            res.result = {
+                "sub": claims.get("sub"),
+                "username": claims.get("preferred_username"),
+                "email": claims.get("email"),
+                "first_name": claims.get("given_name"),
+                "last_name": claims.get("family_name"),
+                "realm_roles": claims.get("realm_access", {}).get("roles", []),
+                "exp": claims.get("exp"),
+            }
+            res.code = EAPIResponseCode.success
+        except InvalidToken as err:
+            res.error_msg = f'Invalid token : {err}'
+            res.code = EAPIResponseCode.unauthorized
+        except Exception as e:
+            res.error_msg = f'Unable to verify token : {e}'
+            res.code = EAPIResponseCode.internal_error
+
+        return res.json_response()
+
+
 # This api is used by portal to update user last login
 @cbv.cbv(router)
 class UserLastLogin:
@@ -221,27 +270,13 @@ class UserLastLogin:
         # if not username:
         #     return {"result": "Missing username"}, 400
         try:
-            # get user by username to fetch the id
-            response = requests.post(
-                ConfigSettings.NEO4J_SERVICE + "nodes/User/query",
-                json={"name": username}
-            )
-            users = response.json()
-            if len(users) == 0:
-                res.error_msg = "User not exists"
-                res.code = EAPIResponseCode.bad_request
+            # add last login time, saved in neo4j by the write-behind queue
+            if not last_login_queue.put(username, last_login_now()):
+                res.error_msg = "Too many pending last login updates"
+                res.code = EAPIResponseCode.internal_error
                 return res.json_response()
 
-            neo4j_user_id = users[0]["id"]
-
-            # add last login time
-            last_login = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
-            response = requests.put(
-                ConfigSettings.NEO4J_SERVICE + f"nodes/User/node/{neo4j_user_id}",
-                json={"last_login": str(last_login)}
-            )
-
-            res.result = response.json()
+            res.result = "success"
             res.code = EAPIResponseCode.success
 
         except Exception as e:
@@ -267,7 +302,7 @@ class UserStatus:
         
         try:
             # query the user from neo4j
-            response = requests.post(
+            response = await http_clients.get('neo4j').post(
                 ConfigSettings.NEO4J_SERVICE + "nodes/User/query",
                 json={"email": email}
             )
@@ -311,8 +346,8 @@ class UserProjectRole:
         # create admin client
         try:
             admin_client = OperationsAdmin(realm)
-            user = admin_client.get_user_by_email(email)
-            admin_client.assign_user_role(user['id'], project_role)
+            user = await admin_client.get_user_by_email(email)
+            await admin_client.assign_user_role(user['id'], project_role)
 
             res.result = "success"
             res.code = EAPIResponseCode.success
@@ -337,8 +372,8 @@ class UserProjectRole:
         # create admin client
         try:
             admin_client = OperationsAdmin(realm)
-            user = admin_client.get_user_by_email(email)
-            admin_client.delete_role_of_user(user['id'], project_role)
+            user = await admin_client.get_user_by_email(email)
+            await admin_client.delete_role_of_user(user['id'], project_role)
 
             res.result = "success"
             res.code = EAPIResponseCode.success
@@ -361,32 +396,55 @@ class UserList:
                 summary='list users from keycloak')
     @catch_internal(_API_NAMESPACE)
     async def get(self, username:str=None, email:str=None, page:int=0, page_size:int=10,
-        exact:str="False", status:str=None, order_by:str=None, order_type:str="asc"):
+        exact:str="False", status:str=None, order_by:str=None, order_type:str="asc", cursor:str=None,
+        limit:int=Query(None, ge=1, le=MAX_LIMIT)):
+        # keyset pagination, the cursor of the next page is returned as next_cursor
+        if cursor is not None or limit is not None:
+            return await self.get_after(
+                username, email, exact, status, order_by, order_type, cursor, limit or page_size
+            )
+
         res = APIResponse()
 
-        # for now the api does not support the exact search and status check
-        # This will need to be wait until keycloak is upto v16
-        # The native api does not support join/sorting, so I temporary do them manually
-        # ALL the in memory sorting, searching, mapping are the temporary solution
-        # at the end, they will be sync to some primary db
+        # served from the copy of the keycloak users in postgres, which can filter, sort and paginate
+        found = await user_directory.search(
+            username=username,
+            email=email,
+            status=status,
+            exact=exact.lower() == 'true',
+            order_by=order_by,
+            order_type=order_type,
+            page=page,
+            page_size=page_size,
+        )
+        if found is not None:
+            total_users, users = found
+        else:
+            total_users, users = await self.list_from_keycloak(username, email, page, page_size, order_by, order_type)
+
+        res.result = users
+        res.total = total_users
+        res.num_of_pages = math.ceil(total_users / page_size)
+        res.page = page
+
+        return res.json_response()
+
+    @staticmethod
+    async def list_from_keycloak(username, email, page, page_size, order_by, order_type):
+        """Until the user directory is ready, the exact search and status check are not supported."""
 
         # create admin client
         admin_client = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
-        hearder = {
-            "Authorization": "Bearer "+admin_client.token.get("access_token"),
-            "Content-Type": "application/json"
-        }
         query = {
             "username":username,
             "email": email, 
-            "first": page,
+            "first": page * page_size,
             "max": page_size,
             # "exact": 'true'
         }
         
         # NOTE HERE: the keycloak api does not support sorting
-        # consider the amount of the user ~100. so I decide to use
-        # python to do the sorting
+        # the users are fetched at once and sorted in python
         if order_by:
             query.update({
                 "first": 0,
@@ -394,64 +452,69 @@ class UserList:
             })
 
         # get the total user count
-        api = ConfigSettings.KEYCLOAK_SERVER_URL+"admin/realms/"+ConfigSettings.KEYCLOAK_REALM+"/users/count"
-        with httpx.Client() as client:
-            api_res = client.get(api, headers=hearder, params=query)
-        total_users = api_res.json()
+        total_users = await admin_client.count_users(query)
 
         # get user detail
-        api = ConfigSettings.KEYCLOAK_SERVER_URL+"admin/realms/"+ConfigSettings.KEYCLOAK_REALM+"/users"
-        with httpx.Client() as client:
-            api_res = client.get(api, headers=hearder, params=query)
-        users = api_res.json()
-        
+        users = await admin_client.list_users(query)
+
+        # the same representation as the user directory
+        platform_admins = {x.get("username") for x in await admin_client.get_role_users("platform-admin")}
+        users = [to_row(user, platform_admins) for user in users]
 
         # here since the keycloak is NOT supporting sorting
         # manually sort the user by order_by and order_type
         if order_by:
-
-            # generate order lambda the special one is last_login_time
-            # this is attached to attribute so we have to get one more step
-            order_lambda = lambda user: user.get(order_by)
-            if order_by == "last_login":
-                order_lambda = lambda user: user.get("attributes").get("last_login")
-
-            users = sorted(users, key=order_lambda, reverse=True if order_type == 'desc' else False)
+            column = SORT_COLUMNS.get(order_by, 'username')
+            users = sorted(
+                users, key=lambda user: (user[column] is None, user[column] or ''), reverse=order_type == 'desc'
+            )
             # manually do the pagination
             users = users[page*page_size:(page+1)*page_size]
 
-        for x in users:
-            print(x)
-
-        # finally filter out only return certain attributes
-        users = [{
-            "username":user.get("username"),
-            "first_name":user.get("firstName"),
-            "last_name":user.get("lastName"),
-            "email":user.get("email"),
-            "time_created": datetime.fromtimestamp(user.get("createdTimestamp")//1000).strftime("%Y-%m-%dT%H:%M:%S"),
-            "last_login": user.get("attributes", {}).get("last_login"),
-            "status": user.get("attributes", {}).get("status", 'active'),
-        } for user in api_res.json()]
-
-
-        # also manually do the platform admin check
-        with httpx.Client() as client:
-            api = ConfigSettings.KEYCLOAK_SERVER_URL+"admin/realms/"+ConfigSettings.KEYCLOAK_REALM+"/roles/platform-admin/users"
-            api_res = client.get(api, headers=hearder)
-            platform_admins = [x.get("username") for x in api_res.json()]
-        # then do the looping over to match the return with platform admin
-        # since the page is 10 and platform admin is ~10
-        for user in users:
-            if user.get("username") in platform_admins or user.get("username") == "admin":
-                user.update({"role":"admin"})
-            else:
-                user.update({"role":"member"})
+        return total_users, [to_user(user) for user in users]
 
+    async def get_after(self, username, email, exact, status, order_by, order_type, cursor, limit):
+        res = CursorAPIResponse()
+        try:
+            after = None if cursor is None else read_cursor(cursor)
+        except InvalidCursor as e:
+            res.error_msg = str(e)
+            res.code = EAPIResponseCode.bad_request
+            return res.json_response()
+
+        found = await user_directory.search_after(
+            username=username,
+            email=email,
+            status=status,
+            exact=exact.lower() == 'true',
+            order_by=order_by,
+            order_type=order_type,
+            after=after,
+            limit=limit,
+        )
+        if found is None:
+            found = await self.list_after_from_keycloak(username, email, order_by, order_type, after, limit)
+        total_users, users, next_cursor = found
 
         res.result = users
         res.total = total_users
-        res.num_of_pages = math.ceil(total_users / page_size)
-        res.page = page
+        res.next_cursor = None if next_cursor is None else encode_cursor(next_cursor)
+        return res.json_response()
+
+    @staticmethod
+    async def list_after_from_keycloak(username, email, order_by, order_type, after, limit):
+        """Until the user directory is ready, every matching user is fetched for each page."""
 
-        return res.json_response()
\ No newline at end of file
+        admin_client = OperationsAdmin(ConfigSettings.KEYCLOAK_REALM)
+        users = await admin_client.get_users({"username": username, "email": email})
+        platform_admins = {x.get("username") for x in await admin_client.get_role_users("platform-admin")}
+        rows = [to_row(user, platform_admins) for user in users]
+
+        if after is None:
+            column, descending = SORT_COLUMNS.get(order_by, 'username'), order_type == 'desc'
+        else:
+            column, descending = after.order_by, after.descending
+        rows, next_cursor = keyset_page(
+            rows, column, descending, lambda row: row[column], lambda row: row['id'], after, limit
+        )
+        return len(users) if after is None else None, [to_user(row) for row in rows], next_cursor
\ No newline at end of file
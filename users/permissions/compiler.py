@@ -0,0 +1,264 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Compile the casbin policy into plain hash lookups.
+
+``model.conf`` always has the same shape: roles granted per domain through ``g``, a ``platform_admin`` bypass,
+wildcard domains, exact resources and wildcard operations. For that shape a decision does not need the generic
+casbin matcher, which evaluates an expression against every policy rule. The compiled matrix answers it with a
+handful of dictionary lookups.
+"""
+
+import re
+from abc import ABC
+from abc import abstractmethod
+from collections import defaultdict
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+import casbin
+
+PLATFORM_ADMIN = 'platform_admin'
+WILDCARD = '*'
+
+# casbin's default role manager follows links up to this depth
+MAX_HIERARCHY_LEVEL = 10
+
+_SUPPORTED_MODEL = {
+    ('r', 'r'): 'sub, dom, obj, act',
+    ('p', 'p'): 'sub, dom, obj, act',
+    ('g', 'g'): '_, _, _',
+    ('e', 'e'): 'some(where (p_eft == allow))',
+    ('m', 'm'): (
+        "(g(r_sub, p_sub, r_dom) || r_sub == 'platform_admin') && (r_dom == p_dom || p_dom == '*' || r_dom == '*') "
+        "&& r_obj == p_obj && (r_act == p_act || p_act == '*')"
+    ),
+}
+
+# role -> zone -> resource -> operations
+Grants = Dict[str, Dict[str, Dict[str, FrozenSet[str]]]]
+
+
+def _normalize(value: str) -> str:
+    return re.sub(r'\s+', '', value)
+
+
+def is_supported_model(model: casbin.model.Model) -> bool:
+    """Check that the casbin model has exactly the shape the matrix implements."""
+
+    sections = {(sec, key): ast.value for sec in model.model for key, ast in model.model[sec].items()}
+    if set(sections) != set(_SUPPORTED_MODEL):
+        return False
+    return all(_normalize(sections[key]) == _normalize(value) for key, value in _SUPPORTED_MODEL.items())
+
+
+def _freeze(grants: dict) -> dict:
+    if isinstance(grants, set):
+        return frozenset(grants)
+    return {key: _freeze(value) for key, value in grants.items()}
+
+
+class MatrixLookup(ABC):
+    """Decision logic of the supported model on top of five lookups implemented by the subclasses.
+
+    Grant tables map a resource to its operations and only need ``get`` and ``items``.
+    """
+
+    @abstractmethod
+    def _lookup_grants(self, subject: str, zone: str) -> Mapping[str, FrozenSet[str]]:
+        """Grants of ``subject`` in ``zone``."""
+
+    @abstractmethod
+    def _lookup_any_zone_grants(self, subject: str) -> Mapping[str, FrozenSet[str]]:
+        """Grants of ``subject`` merged across every zone."""
+
+    @abstractmethod
+    def _lookup_admin_grants(self, zone: str) -> Mapping[str, FrozenSet[str]]:
+        """Grants of the platform admin in ``zone``."""
+
+    @abstractmethod
+    def _lookup_admin_any_zone_grants(self) -> Mapping[str, FrozenSet[str]]:
+        """Grants of the platform admin merged across every zone."""
+
+    @abstractmethod
+    def _lookup_roles(self, zone: str, user: str) -> FrozenSet[str]:
+        """Roles reachable from ``user`` in ``zone``."""
+
+    def _grant_tables(self, role: str, zone: str) -> List[Mapping[str, FrozenSet[str]]]:
+        """Resource to operations tables that apply to ``role`` in ``zone``, following the matcher of ``model.conf``."""
+
+        if role == PLATFORM_ADMIN:
+            if zone == WILDCARD:
+                return [self._lookup_admin_any_zone_grants()]
+            return [self._lookup_admin_grants(zone), self._lookup_admin_grants(WILDCARD)]
+
+        tables = []
+        for subject in self._subjects(role, zone):
+            if zone == WILDCARD:
+                tables.append(self._lookup_any_zone_grants(subject))
+            else:
+                tables += [self._lookup_grants(subject, zone), self._lookup_grants(subject, WILDCARD)]
+        return tables
+
+    def _subjects(self, role: str, zone: str) -> Set[str]:
+        return {role} | self._lookup_roles(zone, role)
+
+    def enforce(self, role: str, zone: str, resource: str, operation: str) -> bool:
+        for table in self._grant_tables(role, zone):
+            operations = table.get(resource)
+            if operations and (operation in operations or WILDCARD in operations):
+                return True
+        return False
+
+    def permissions(self, role: str, zone: str) -> Dict[str, Set[str]]:
+        """Every resource ``role`` may access in ``zone`` with the allowed operations, ``*`` meaning any."""
+
+        permissions = defaultdict(set)
+        for table in self._grant_tables(role, zone):
+            for resource, operations in table.items():
+                permissions[resource] |= operations
+        return dict(permissions)
+
+
+class PermissionMatrix(MatrixLookup):
+    """Authorization decisions for the supported model, precomputed as nested dictionaries."""
+
+    def __init__(
+        self,
+        grants: Grants,
+        any_zone_grants: Dict[str, Dict[str, FrozenSet[str]]],
+        admin_grants: Dict[str, Dict[str, FrozenSet[str]]],
+        admin_any_zone_grants: Dict[str, FrozenSet[str]],
+        roles: Dict[str, Dict[str, FrozenSet[str]]],
+    ):
+        self._grants = grants
+        self._any_zone_grants = any_zone_grants
+        self._admin_grants = admin_grants
+        self._admin_any_zone_grants = admin_any_zone_grants
+        self._roles = roles
+
+    @classmethod
+    def compile(cls, policies: Iterable[Sequence[str]], groupings: Iterable[Sequence[str]]) -> 'PermissionMatrix':
+        """Build the matrix from ``p`` rules (sub, dom, obj, act) and ``g`` rules (user, role, dom)."""
+
+        grants = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
+        any_zone_grants = defaultdict(lambda: defaultdict(set))
+        admin_grants = defaultdict(lambda: defaultdict(set))
+        admin_any_zone_grants = defaultdict(set)
+        for sub, dom, obj, act in policies:
+            grants[sub][dom][obj].add(act)
+            any_zone_grants[sub][obj].add(act)
+            admin_grants[dom][obj].add(act)
+            admin_any_zone_grants[obj].add(act)
+
+        links = defaultdict(lambda: defaultdict(set))
+        for user, role, dom in (rule[:3] for rule in groupings):
+            links[dom][user].add(role)
+
+        roles = {}
+        for dom, dom_links in links.items():
+            roles[dom] = {user: frozenset(_reachable(user, dom_links)) for user in dom_links}
+
+        return cls(
+            _freeze(grants), _freeze(any_zone_grants), _freeze(admin_grants), _freeze(admin_any_zone_grants), roles
+        )
+
+    def entries(self) -> Iterator[Tuple[Tuple[str, ...], FrozenSet[str]]]:
+        """Flatten the matrix into ``(key, values)`` pairs, the first field of the key naming the table.
+
+        ``g``: (role, zone, resource), ``a``: (role, resource) in any zone, ``d``: (zone, resource) and ``z``:
+        (resource) for the platform admin, ``r``: (zone, user) to the reachable roles.
+        """
+
+        yield from self._grant_entries()
+        yield from _table_entries('a', self._any_zone_grants)
+        yield from _table_entries('d', self._admin_grants)
+        for resource, operations in self._admin_any_zone_grants.items():
+            yield ('z', resource), operations
+        yield from _table_entries('r', self._roles)
+
+    def _grant_entries(self) -> Iterator[Tuple[Tuple[str, ...], FrozenSet[str]]]:
+        for role, zones in self._grants.items():
+            for zone, table in zones.items():
+                for resource, operations in table.items():
+                    yield ('g', role, zone, resource), operations
+
+    def _lookup_grants(self, subject: str, zone: str) -> Mapping[str, FrozenSet[str]]:
+        return self._grants.get(subject, {}).get(zone, {})
+
+    def _lookup_any_zone_grants(self, subject: str) -> Mapping[str, FrozenSet[str]]:
+        return self._any_zone_grants.get(subject, {})
+
+    def _lookup_admin_grants(self, zone: str) -> Mapping[str, FrozenSet[str]]:
+        return self._admin_grants.get(zone, {})
+
+    def _lookup_admin_any_zone_grants(self) -> Mapping[str, FrozenSet[str]]:
+        return self._admin_any_zone_grants
+
+    def _lookup_roles(self, zone: str, user: str) -> FrozenSet[str]:
+        return self._roles.get(zone, {}).get(user, frozenset())
+
+
+def _table_entries(
+    name: str, tables: Mapping[str, Mapping[str, FrozenSet[str]]]
+) -> Iterator[Tuple[Tuple[str, ...], FrozenSet[str]]]:
+    """Flatten two levels of nested tables into ``((name, outer, inner), values)`` pairs."""
+
+    for outer, table in tables.items():
+        for inner, values in table.items():
+            yield (name, outer, inner), values
+
+
+def _reachable(user: str, links: Dict[str, Set[str]]) -> Set[str]:
+    """Roles reachable from ``user`` within the depth casbin's role manager follows."""
+
+    found = set()
+    frontier = {user}
+    for _ in range(MAX_HIERARCHY_LEVEL + 1):
+        frontier = {role for name in frontier for role in links.get(name, ())} - found
+        if not frontier:
+            break
+        found |= frontier
+    return found
+
+
+def compile_enforcer(enforcer: casbin.Enforcer) -> Optional[PermissionMatrix]:
+    """Compile the policy loaded in ``enforcer``, or return None when casbin has to evaluate it."""
+
+    model = enforcer.get_model()
+    if not is_supported_model(model):
+        return None
+
+    policies: List[Sequence[str]] = model.model['p']['p'].policy
+    groupings: List[Sequence[str]] = model.model['g']['g'].policy
+    # casbin evaluates an empty policy and malformed rules in its own way, leave those to casbin
+    if not policies or any(len(rule) != 4 for rule in policies) or any(len(rule) < 3 for rule in groupings):
+        return None
+
+    return PermissionMatrix.compile(policies, groupings)
@@ -0,0 +1,80 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import threading
+from collections import OrderedDict
+from typing import Hashable
+from typing import Optional
+
+
+class CacheStats:
+    """Hit and miss counters shared by the caches of successive policy snapshots."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DecisionCache:
+    """Bounded LRU cache of authorization decisions.
+
+    A cache belongs to a single policy snapshot, so it never has to be invalidated: loading a new policy version
+    creates a new snapshot with an empty cache.
+    """
+
+    def __init__(self, maxsize: int, stats: Optional[CacheStats] = None):
+        self.maxsize = maxsize
+        self.stats = stats if stats is not None else CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bool]:
+        with self._lock:
+            decision = self._entries.get(key)
+            if decision is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return decision
+
+    def put(self, key: Hashable, decision: bool) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = decision
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
@@ -18,11 +18,13 @@
 # permissions and limitations under the Licence.
 # 
 
+from typing import Optional
+
 from fastapi import APIRouter
+from fastapi import Header
+from fastapi import Response
 from fastapi_utils import cbv
 
-import casbin
-import casbin_sqlalchemy_adapter
 from common.services.logger_services.logger_factory_service import SrvLoggerFactory
 # from flask import request
 # from flask_restx import Resource
@@ -31,9 +33,11 @@ from sqlalchemy import create_engine
 from config import ConfigSettings
 from models.api_response import APIResponse
 from models.api_response import EAPIResponseCode
+from models.permissions import AuthorizeBatchPOST
 # from users import api
 
 from resources.error_handler import catch_internal
+from users.permissions.policy_store import PolicyStore
 
 
 _engine = None
@@ -56,6 +60,29 @@ def _get_sqlalchemy_engine():
     return _engine
 
 
+policy_store = PolicyStore(
+    _get_sqlalchemy_engine,
+    'users/permissions/model.conf',
+    refresh_interval=ConfigSettings.CASBIN_POLICY_REFRESH_INTERVAL,
+    poll_interval=ConfigSettings.CASBIN_POLICY_VERSION_POLL_INTERVAL,
+    cache_size=ConfigSettings.CASBIN_DECISION_CACHE_SIZE,
+    compile_policy=ConfigSettings.CASBIN_POLICY_COMPILE,
+    zones=[zone.strip() for zone in ConfigSettings.CASBIN_POLICY_ZONES.split(',') if zone.strip()],
+    snapshot_dir=ConfigSettings.CASBIN_SNAPSHOT_DIR or None,
+)
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of the If-None-Match entity tags with ``etag``, proxies may have weakened them."""
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any(tag == '*' or _opaque_tag(tag) == _opaque_tag(etag) for tag in tags)
+
+
 @cbv.cbv(router)
 class Authorize:
 
@@ -79,9 +106,7 @@ class Authorize:
 
         api_response.result = {"has_permission": False}
         try:
-            adapter = casbin_sqlalchemy_adapter.Adapter(_get_sqlalchemy_engine())
-            enforcer = casbin.Enforcer("users/permissions/model.conf", adapter)
-            if enforcer.enforce(project_role, project_zone, resource, operation):
+            if policy_store.snapshot.enforce(project_role, project_zone, resource, operation):
                 api_response.result = {"has_permission": True}
                 api_response.code = EAPIResponseCode.success
                 _logger.info(f'Access granted for {project_role}, {project_zone}, {resource}, {operation}')
@@ -93,3 +118,56 @@ class Authorize:
             api_response.code = EAPIResponseCode.internal_error
 
         return api_response.json_response()
+
+    @router.post("/authorize/batch", tags=[_API_TAG],
+                 summary='check a list of authorizations against the same policy version')
+    @catch_internal(_API_NAMESPACE)
+    async def batch(self, data: AuthorizeBatchPOST):
+        api_response = APIResponse()
+
+        api_response.result = [{**check.dict(), "has_permission": False} for check in data.checks]
+        try:
+            # every check of the batch is answered by the same policy version
+            snapshot = policy_store.snapshot
+            for decision in api_response.result:
+                decision["has_permission"] = snapshot.enforce(
+                    decision["role"], decision["zone"], decision["resource"], decision["operation"]
+                )
+            api_response.total = len(api_response.result)
+            api_response.code = EAPIResponseCode.success
+
+        except Exception as e:
+            error_msg = f"Error checking permissions - {str(e)}"
+            _logger.error(error_msg)
+            api_response.error_msg = error_msg
+            api_response.code = EAPIResponseCode.internal_error
+
+        return api_response.json_response()
+
+    @router.get("/authorize/permissions", tags=[_API_TAG],
+                summary='list every resource and operation allowed for the role in the zone')
+    @catch_internal(_API_NAMESPACE)
+    async def permissions(self, role: str, zone: str, if_none_match: Optional[str] = Header(None)):
+        api_response = APIResponse()
+
+        snapshot = policy_store.snapshot
+        headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+        if if_none_match and _etag_matches(if_none_match, snapshot.etag):
+            return Response(status_code=304, headers=headers)
+
+        permissions = snapshot.permissions(role, zone)
+        api_response.result = {
+            "role": role,
+            "zone": zone,
+            "version": snapshot.version,
+            "permissions": [
+                {"resource": resource, "operation": operation}
+                for resource in sorted(permissions) for operation in sorted(permissions[resource])
+            ],
+        }
+        api_response.total = len(api_response.result["permissions"])
+        api_response.code = EAPIResponseCode.success
+
+        response = api_response.json_response()
+        response.headers.update(headers)
+        return response
@@ -0,0 +1,224 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from casbin_sqlalchemy_adapter.adapter import CasbinRule
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from fastapi import APIRouter
+from fastapi import Query
+from fastapi_utils import cbv
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from starlette.concurrency import run_in_threadpool
+
+from models.api_response import APIResponse
+from models.api_response import EAPIResponseCode
+from models.permissions import PoliciesDELETE
+from models.permissions import PoliciesPOST
+from resources.error_handler import catch_internal
+from users.permissions.permissions import _get_sqlalchemy_engine
+from users.permissions.permissions import policy_store
+
+router = APIRouter()
+
+_API_TAG = '/v1/admin/policies'
+_API_NAMESPACE = "api_policies"
+_logger = SrvLoggerFactory(_API_NAMESPACE).get_logger()
+
+_table = CasbinRule.__table__
+
+# columns identifying a rule of each type
+_KEY_COLUMNS = {
+    'p': ['v0', 'v1', 'v2', 'v3'],
+    'g': ['v0', 'v1', 'v2'],
+}
+
+# keep the OR-ed lookups of a statement to a reasonable size
+_CHUNK_SIZE = 500
+
+
+def _batch_rows(data) -> List[Dict[str, Optional[str]]]:
+    """Convert a request body into casbin_rule rows, without duplicates."""
+
+    rows = [
+        {'ptype': 'p', 'v0': rule.role, 'v1': rule.zone, 'v2': rule.resource, 'v3': rule.operation}
+        for rule in data.policies
+    ]
+    rows += [{'ptype': 'g', 'v0': rule.user, 'v1': rule.role, 'v2': rule.zone, 'v3': None} for rule in data.groupings]
+    return list({_row_key(row): row for row in rows}.values())
+
+
+def _row_key(row) -> Tuple[str, ...]:
+    return (row['ptype'],) + tuple(row[column] for column in _KEY_COLUMNS[row['ptype']])
+
+
+def _matches(rows):
+    conditions = []
+    for row in rows:
+        columns = [_table.c[column] == row[column] for column in _KEY_COLUMNS[row['ptype']]]
+        conditions.append(and_(_table.c.ptype == row['ptype'], *columns))
+    return or_(*conditions)
+
+
+def _chunks(rows):
+    for start in range(0, len(rows), _CHUNK_SIZE):
+        yield rows[start:start + _CHUNK_SIZE]
+
+
+def _to_rule(row) -> dict:
+    if row['ptype'] == 'g':
+        return {'ptype': 'g', 'user': row['v0'], 'role': row['v1'], 'zone': row['v2']}
+    return {'ptype': row['ptype'], 'role': row['v0'], 'zone': row['v1'], 'resource': row['v2'], 'operation': row['v3']}
+
+
+def _p_rule(condition):
+    return and_(_table.c.ptype == 'p', condition)
+
+
+def _g_rule(condition):
+    return and_(_table.c.ptype == 'g', condition)
+
+
+def list_rules(ptype: Optional[str], role: Optional[str], zone: Optional[str], page: int, page_size: int):
+    """Return the total number of matching rules and one page of them."""
+
+    conditions = []
+    if ptype:
+        conditions.append(_table.c.ptype == ptype)
+    # p rules are (role, zone, resource, operation), g rules are (user, role, zone)
+    if role:
+        conditions.append(or_(_p_rule(_table.c.v0 == role), _g_rule(_table.c.v1 == role)))
+    if zone:
+        conditions.append(or_(_p_rule(_table.c.v1 == zone), _g_rule(_table.c.v2 == zone)))
+
+    with _get_sqlalchemy_engine().connect() as conn:
+        total = conn.execute(select([func.count()]).select_from(_table).where(and_(*conditions))).scalar()
+        query = select([_table]).where(and_(*conditions)).order_by(_table.c.id)
+        rows = conn.execute(query.offset(page * page_size).limit(page_size)).fetchall()
+    return total, [_to_rule(row) for row in rows]
+
+
+def _insert_missing(conn):
+    """Return an insert statement skipping the rules already in casbin_rule.
+
+    The unique index of migration d5a1e7c3b982 catches the rules a concurrent batch inserted in the meantime.
+    """
+
+    if conn.dialect.name == 'postgresql':
+        return postgresql.insert(_table).on_conflict_do_nothing()
+    return _table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+
+
+def upsert_rules(rows) -> int:
+    """Insert the rules that do not exist yet, in a single transaction.
+
+    The trigger on casbin_rule bumps the policy version once for the whole transaction.
+    """
+
+    inserted = 0
+    with _get_sqlalchemy_engine().begin() as conn:
+        existing = set()
+        for chunk in _chunks(rows):
+            existing.update(_row_key(row) for row in conn.execute(select([_table]).where(_matches(chunk))))
+        missing = [row for row in rows if _row_key(row) not in existing]
+        for chunk in _chunks(missing):
+            inserted += conn.execute(_insert_missing(conn).values(chunk)).rowcount
+    return inserted
+
+
+def delete_rules(rows) -> int:
+    """Delete the given rules in a single transaction."""
+
+    deleted = 0
+    with _get_sqlalchemy_engine().begin() as conn:
+        for chunk in _chunks(rows):
+            deleted += conn.execute(_table.delete().where(_matches(chunk))).rowcount
+    return deleted
+
+
+@cbv.cbv(router)
+class Policies:
+
+    @router.get("/admin/policies", tags=[_API_TAG],
+                summary='list the policy and grouping rules')
+    @catch_internal(_API_NAMESPACE)
+    async def get(
+        self,
+        ptype: str = None,
+        role: str = None,
+        zone: str = None,
+        page: int = Query(0, ge=0),
+        page_size: int = Query(100, ge=1),
+    ):
+        res = APIResponse()
+        total, rules = await run_in_threadpool(list_rules, ptype, role, zone, page, page_size)
+        res.result = rules
+        res.total = total
+        res.num_of_pages = -(-total // page_size)
+        res.page = page
+        res.code = EAPIResponseCode.success
+        return res.json_response()
+
+    @router.post("/admin/policies", tags=[_API_TAG],
+                 summary='add policy and grouping rules in one transaction')
+    @catch_internal(_API_NAMESPACE)
+    async def post(self, data: PoliciesPOST):
+        res = APIResponse()
+        try:
+            inserted = await run_in_threadpool(upsert_rules, _batch_rows(data))
+            # reload right away in this worker, the others follow the policy version
+            await run_in_threadpool(policy_store.refresh)
+            res.result = {"inserted": inserted, "version": policy_store.snapshot.version}
+            res.code = EAPIResponseCode.success
+            _logger.info(f'Policy batch applied, {inserted} rules inserted')
+        except Exception as e:
+            error_msg = f"Error updating policies - {str(e)}"
+            _logger.error(error_msg)
+            res.error_msg = error_msg
+            res.code = EAPIResponseCode.internal_error
+
+        return res.json_response()
+
+    @router.delete("/admin/policies", tags=[_API_TAG],
+                   summary='remove policy and grouping rules in one transaction')
+    @catch_internal(_API_NAMESPACE)
+    async def delete(self, data: PoliciesDELETE):
+        res = APIResponse()
+        try:
+            deleted = await run_in_threadpool(delete_rules, _batch_rows(data))
+            await run_in_threadpool(policy_store.refresh)
+            res.result = {"deleted": deleted, "version": policy_store.snapshot.version}
+            res.code = EAPIResponseCode.success
+            _logger.info(f'Policy batch applied, {deleted} rules deleted')
+        except Exception as e:
+            error_msg = f"Error deleting policies - {str(e)}"
+            _logger.error(error_msg)
+            res.error_msg = error_msg
+            res.code = EAPIResponseCode.internal_error
+
+        return res.json_response()
@@ -0,0 +1,365 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Union
+
+import casbin
+import casbin_sqlalchemy_adapter
+from casbin_sqlalchemy_adapter.adapter import Filter
+from common.services.logger_services.logger_factory_service import SrvLoggerFactory
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+from users.permissions.compiler import WILDCARD
+from users.permissions.compiler import PermissionMatrix
+from users.permissions.compiler import compile_enforcer
+from users.permissions.decision_cache import CacheStats
+from users.permissions.decision_cache import DecisionCache
+from users.permissions.shared_snapshot import MappedPermissionMatrix
+from users.permissions.shared_snapshot import SnapshotDirectory
+
+_logger = SrvLoggerFactory('policy_store').get_logger()
+
+# single row table bumped by a trigger on casbin_rule, see migration b7d2a4c91e05
+_VERSION_QUERY = text('SELECT version FROM casbin_policy_version WHERE id = 1')
+
+
+def _zone_filter(ptype: str, zones: List[str]) -> Filter:
+    """Select the rules of one type for the given zones, p rules hold the zone in v1 and g rules in v2."""
+
+    policy_filter = Filter()
+    policy_filter.ptype = [ptype]
+    if ptype == 'p':
+        policy_filter.v1 = zones
+    else:
+        policy_filter.v2 = zones
+    return policy_filter
+
+
+class PolicyNotLoaded(Exception):
+    """No policy is loaded yet, the startup load failed or has not finished."""
+
+
+class PolicySnapshot:
+    """Casbin enforcer holding the policy as it was loaded at one point in time.
+
+    A snapshot is never modified after it is published. Reloading builds a new snapshot and swaps it in, so a request
+    that already holds a snapshot keeps a consistent view of the policy. Decisions come from the compiled permission
+    matrix when the model could be compiled, and from the casbin matcher otherwise.
+    """
+
+    def __init__(
+        self,
+        enforcer: Optional[casbin.Enforcer],
+        version: Optional[int] = None,
+        cache: Optional[DecisionCache] = None,
+        matrix: Optional[Union[PermissionMatrix, MappedPermissionMatrix]] = None,
+    ):
+        self.enforcer = enforcer
+        self.version = version
+        self.loaded_at = time.time()
+        self.cache = cache if cache is not None else DecisionCache(0)
+        self.matrix = matrix
+        if enforcer is not None:
+            model = enforcer.get_model().model
+            self.rules = len(model['p']['p'].policy)
+            self.groupings = len(model['g']['g'].policy) if 'g' in model else 0
+        else:
+            self.rules = self.groupings = 0
+
+    @classmethod
+    def from_mapped(cls, matrix: MappedPermissionMatrix, cache: Optional[DecisionCache] = None) -> 'PolicySnapshot':
+        """Snapshot answering from a matrix another worker loaded and shared."""
+
+        snapshot = cls(None, matrix.version, cache, matrix)
+        snapshot.loaded_at = matrix.loaded_at
+        snapshot.rules = matrix.rules
+        snapshot.groupings = matrix.groupings
+        return snapshot
+
+    def enforce(self, role: str, zone: str, resource: str, operation: str) -> bool:
+        key = (role, zone, resource, operation)
+        decision = self.cache.get(key)
+        if decision is None:
+            if self.matrix is not None:
+                decision = self.matrix.enforce(role, zone, resource, operation)
+            else:
+                decision = bool(self.enforcer.enforce(role, zone, resource, operation))
+            self.cache.put(key, decision)
+        return decision
+
+    def permissions(self, role: str, zone: str) -> Dict[str, Set[str]]:
+        """Every resource ``role`` may access in ``zone`` with the allowed operations, ``*`` meaning any."""
+
+        if self.matrix is not None:
+            return self.matrix.permissions(role, zone)
+
+        permissions = defaultdict(set)
+        for resource, operation in {(rule[2], rule[3]) for rule in self.enforcer.get_policy()}:
+            if self.enforcer.enforce(role, zone, resource, operation):
+                permissions[resource].add(operation)
+        return dict(permissions)
+
+    @property
+    def etag(self) -> str:
+        """Entity tag of everything derived from this policy version."""
+
+        if self.version is not None:
+            return f'"{self.version}"'
+        return f'"loaded-{int(self.loaded_at * 1000)}"'
+
+
+class PolicyStore:
+    """Long-lived casbin enforcer shared by every request of a worker.
+
+    The policy is loaded once at startup. Afterwards the store polls the policy version every ``poll_interval``
+    seconds and reloads only when it changed. When the database has no version table, the whole policy is reloaded
+    every ``refresh_interval`` seconds instead. Each snapshot answers repeated requests from an LRU cache of up to
+    ``cache_size`` decisions, and compiles the policy into a permission matrix unless ``compile_policy`` is False.
+
+    When ``zones`` is given, only the rules of those zones and of the wildcard zone are loaded. Such a worker denies
+    every request for another zone, so it must only be routed the zones it serves.
+
+    With a ``snapshot_dir``, the workers of a pod share one compiled policy: the worker holding the directory lock
+    reads Postgres and publishes a memory-mapped snapshot, the others map it and follow ``CURRENT``. Workers read the
+    database themselves whenever no snapshot is published, for instance when the model cannot be compiled.
+    """
+
+    def __init__(
+        self,
+        engine_factory: Callable,
+        model_path: str,
+        refresh_interval: int = 30,
+        poll_interval: int = 2,
+        cache_size: int = 10000,
+        compile_policy: bool = True,
+        zones: Optional[Sequence[str]] = None,
+        snapshot_dir: Optional[str] = None,
+    ):
+        self._engine_factory = engine_factory
+        self._model_path = model_path
+        self._refresh_interval = refresh_interval
+        self._poll_interval = poll_interval
+        self._cache_size = cache_size
+        self._cache_stats = CacheStats()
+        self._compile_policy = compile_policy
+        self._zones = sorted(set(zones) | {WILDCARD}) if zones else None
+        self._snapshot = None
+        self._shared = SnapshotDirectory(snapshot_dir) if snapshot_dir else None
+        self._shared_name = None
+        self._load_lock = threading.Lock()
+        self._refresher = None
+        self._load_error = None
+        self._versioned = True
+        self.reloads = 0
+
+    @property
+    def snapshot(self) -> PolicySnapshot:
+        """Return the current snapshot.
+
+        The policy is never loaded here, that would block the event loop: ``start`` and the background refresh load
+        it in the threadpool. Until then PolicyNotLoaded is raised, with the error of the last load if it failed.
+        """
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            reason = f' - {self._load_error}' if self._load_error else ''
+            raise PolicyNotLoaded(f'Policy not loaded{reason}')
+        return snapshot
+
+    def read_version(self) -> Optional[int]:
+        """Return the policy version stored in the database, or None when versioning is not available."""
+
+        try:
+            with self._engine_factory().connect() as conn:
+                version = conn.execute(_VERSION_QUERY).scalar()
+        except SQLAlchemyError as e:
+            if self._versioned:
+                _logger.warning(f'Policy version is not available, falling back to periodic reload - {e}')
+            self._versioned = False
+            return None
+
+        self._versioned = True
+        return version
+
+    def load(self) -> PolicySnapshot:
+        """Load the whole policy into a new enforcer and publish it."""
+
+        with self._load_lock:
+            # read the version first so a change made while loading is picked up by the next poll
+            version = self.read_version()
+            enforcer = self._load_enforcer()
+            matrix = compile_enforcer(enforcer) if self._compile_policy else None
+            cache = DecisionCache(self._cache_size, self._cache_stats)
+            snapshot = PolicySnapshot(enforcer, version, cache, matrix)
+            self._snapshot = snapshot
+            self.reloads += 1
+            _logger.info(f'Policy version {version} loaded with {snapshot.rules} rules, compiled: {matrix is not None}')
+            if self._shared is not None and self._shared.leader:
+                self._publish(snapshot)
+            return snapshot
+
+    def _publish(self, snapshot: PolicySnapshot) -> None:
+        try:
+            if snapshot.matrix is None:
+                raise ValueError('the policy could not be compiled')
+            self._shared_name = self._shared.publish(
+                snapshot.matrix, snapshot.version, snapshot.loaded_at, snapshot.rules, snapshot.groupings
+            )
+        except (OSError, ValueError) as e:
+            _logger.warning(f'Policy snapshot not shared, workers read the database - {e}')
+            self._shared_name = None
+            self._shared.withdraw()
+
+    def _attach(self, name: str) -> bool:
+        """Switch to the snapshot published by the loader."""
+
+        try:
+            matrix = self._shared.open(name)
+        except (OSError, ValueError) as e:
+            _logger.warning(f'Error mapping policy snapshot {name} - {e}')
+            return False
+
+        self._snapshot = PolicySnapshot.from_mapped(matrix, DecisionCache(self._cache_size, self._cache_stats))
+        self._shared_name = name
+        self.reloads += 1
+        _logger.info(f'Policy version {matrix.version} mapped from {name}')
+        return True
+
+    def _load_enforcer(self) -> casbin.Enforcer:
+        if self._zones is None:
+            return casbin.Enforcer(self._model_path, casbin_sqlalchemy_adapter.Adapter(self._engine_factory()))
+
+        # a filtered adapter keeps the enforcer from loading the whole table on creation
+        adapter = casbin_sqlalchemy_adapter.Adapter(self._engine_factory(), filtered=True)
+        enforcer = casbin.Enforcer(self._model_path, adapter)
+        enforcer.load_filtered_policy(_zone_filter('p', self._zones))
+        enforcer.load_increment_filtered_policy(_zone_filter('g', self._zones))
+        return enforcer
+
+    def refresh(self) -> bool:
+        """Reload the policy if it changed since the current snapshot was loaded.
+
+        Returns True when a new snapshot was published.
+        """
+
+        if self._shared is not None and not self._shared.try_lead():
+            name = self._shared.current()
+            if name is not None:
+                if name == self._shared_name and self._snapshot is not None:
+                    return False
+                if self._attach(name):
+                    return True
+            # nothing shared yet, read the database like a standalone worker
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.load()
+            return True
+
+        # took the loader lock over while holding a policy read from the database
+        leading = self._shared is not None and self._shared.leader
+        if leading and self._shared_name is None and snapshot.matrix is not None:
+            self._publish(snapshot)
+
+        version = self.read_version()
+        if version is None:
+            if time.time() - snapshot.loaded_at < self._refresh_interval:
+                return False
+        elif version == snapshot.version:
+            return False
+
+        self.load()
+        return True
+
+    def stats(self) -> dict:
+        """Describe the policy currently loaded by this worker."""
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {'pid': os.getpid(), 'loaded': False}
+
+        return {
+            'pid': os.getpid(),
+            'loaded': True,
+            'version': snapshot.version,
+            'versioned': self._versioned,
+            'compiled': snapshot.matrix is not None,
+            'zones': self._zones,
+            'shared': None if self._shared is None else {
+                'path': self._shared.path,
+                'leader': self._shared.leader,
+                'current': self._shared_name,
+            },
+            'loaded_at': snapshot.loaded_at,
+            'rules': snapshot.rules,
+            'groupings': snapshot.groupings,
+            'reloads': self.reloads,
+            'decision_cache': dict(self._cache_stats.to_dict(), size=len(snapshot.cache), maxsize=self._cache_size),
+        }
+
+    async def start(self) -> None:
+        """Load the policy and start watching it for changes."""
+
+        try:
+            await run_in_threadpool(self.refresh)
+        except Exception as e:
+            self._load_error = e
+            _logger.error(f'Error loading policy on startup - {e}')
+
+        if self._refresher is None and self._poll_interval > 0:
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self) -> None:
+        """Stop watching the policy."""
+
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+        # let another worker take over loading the policy
+        if self._shared is not None:
+            self._shared.release()
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception as e:
+                self._load_error = e
+                _logger.error(f'Error reloading policy - {e}')
@@ -0,0 +1,260 @@
+# Copyright 2022 Indoc Research
+# 
+# Licensed under the EUPL, Version 1.2 or – as soon they
+# will be approved by the European Commission - subsequent
+# versions of the EUPL (the "Licence");
+# You may not use this work except in compliance with the
+# Licence.
+# You may obtain a copy of the Licence at:
+# 
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+# 
+# Unless required by applicable law or agreed to in
+# writing, software distributed under the Licence is
+# distributed on an "AS IS" basis,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.
+# See the Licence for the specific language governing
+# permissions and limitations under the Licence.
+# 
+
+
+"""Policy snapshot shared by the workers of a pod through a memory-mapped file.
+
+One worker, the loader, holds an exclusive ``flock`` on the snapshot directory. It is the only one reading the
+policy from Postgres, and it writes every compiled matrix to a new file and points ``CURRENT`` at it. The other
+workers map the file named by ``CURRENT`` read-only, so the pages are shared through the page cache instead of being
+copied into every worker. When the loader exits its lock is released and the next worker to poll takes over.
+
+File layout, little endian::
+
+    header   magic, version (-1 when unversioned), loaded_at, rules, groupings, record count
+    offsets  count + 1 unsigned 64 bit offsets of the records, relative to the first record
+    records  key fields joined by 0x1f, 0x1e, values joined by 0x1f, sorted by key
+
+The records are the ``PermissionMatrix.entries()``, sorted so a lookup is a binary search and every grant table is a
+contiguous range of records.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+from typing import FrozenSet
+from typing import Iterator
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from users.permissions.compiler import MatrixLookup
+from users.permissions.compiler import PermissionMatrix
+
+CURRENT = 'CURRENT'
+LOCK = 'loader.lock'
+
+_MAGIC = b'CASBSNP1'
+_HEADER = struct.Struct('<8sqdIII')
+_OFFSET = struct.Struct('<Q')
+_FIELD = b'\x1f'
+_RECORD = b'\x1e'
+# snapshots kept next to the current one, for workers that read CURRENT just before it moved
+_KEEP = 2
+
+
+def _encode(fields: Sequence[str]) -> bytes:
+    encoded = [field.encode() for field in fields]
+    if any(_FIELD in field or _RECORD in field for field in encoded):
+        raise ValueError(f'Policy value {fields!r} contains a reserved control character')
+    return _FIELD.join(encoded)
+
+
+def _write_atomic(path: str, content: bytes) -> None:
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp, path)
+
+
+def write_snapshot(
+    path: str, matrix: PermissionMatrix, version: Optional[int], loaded_at: float, rules: int, groupings: int
+) -> None:
+    """Serialize ``matrix`` to ``path``, replacing it atomically."""
+
+    records = sorted((_encode(key), _encode(sorted(values))) for key, values in matrix.entries())
+    offsets = [0]
+    for key, values in records:
+        offsets.append(offsets[-1] + len(key) + len(_RECORD) + len(values))
+
+    content = bytearray(_HEADER.pack(_MAGIC, -1 if version is None else version, loaded_at, rules, groupings,
+                                     len(records)))
+    for offset in offsets:
+        content += _OFFSET.pack(offset)
+    for key, values in records:
+        content += key + _RECORD + values
+    _write_atomic(path, bytes(content))
+
+
+class _MappedTable:
+    """Resource to operations table backed by a range of snapshot records."""
+
+    def __init__(self, matrix: 'MappedPermissionMatrix', prefix: Tuple[str, ...]):
+        self._matrix = matrix
+        self._prefix = prefix
+
+    def get(self, resource: str) -> Optional[FrozenSet[str]]:
+        return self._matrix.get(self._prefix + (resource,))
+
+    def items(self) -> Iterator[Tuple[str, FrozenSet[str]]]:
+        return self._matrix.scan(self._prefix)
+
+
+class MappedPermissionMatrix(MatrixLookup):
+    """Permission matrix answering from a memory-mapped snapshot file, without loading it into the heap."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.loaded_at, self.rules, self.groupings, self._count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError(f'{path} is not a policy snapshot')
+        self.version = None if version < 0 else version
+        self._records_at = _HEADER.size + (self._count + 1) * _OFFSET.size
+
+    def _record(self, index: int) -> Tuple[int, int, int]:
+        """Start, key/values separator and end of a record in the map."""
+
+        start, end = struct.unpack_from('<QQ', self._map, _HEADER.size + index * _OFFSET.size)
+        start += self._records_at
+        end += self._records_at
+        return start, self._map.find(_RECORD, start, end), end
+
+    def _key(self, index: int) -> bytes:
+        start, separator, _ = self._record(index)
+        return self._map[start:separator]
+
+    def _values(self, index: int) -> FrozenSet[str]:
+        _, separator, end = self._record(index)
+        return frozenset(self._map[separator + 1:end].decode().split('\x1f'))
+
+    def _lower_bound(self, key: bytes) -> int:
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, key: Tuple[str, ...]) -> Optional[FrozenSet[str]]:
+        """Values stored under ``key``, None when there are none."""
+
+        encoded = _encode(key)
+        index = self._lower_bound(encoded)
+        if index < self._count and self._key(index) == encoded:
+            return self._values(index)
+        return None
+
+    def scan(self, prefix: Tuple[str, ...]) -> Iterator[Tuple[str, FrozenSet[str]]]:
+        """Last key field and values of every record whose key starts with ``prefix``."""
+
+        encoded = _encode(prefix) + _FIELD
+        index = self._lower_bound(encoded)
+        while index < self._count:
+            key = self._key(index)
+            if not key.startswith(encoded):
+                break
+            yield key[len(encoded):].decode(), self._values(index)
+            index += 1
+
+    def _lookup_grants(self, subject: str, zone: str) -> _MappedTable:
+        return _MappedTable(self, ('g', subject, zone))
+
+    def _lookup_any_zone_grants(self, subject: str) -> _MappedTable:
+        return _MappedTable(self, ('a', subject))
+
+    def _lookup_admin_grants(self, zone: str) -> _MappedTable:
+        return _MappedTable(self, ('d', zone))
+
+    def _lookup_admin_any_zone_grants(self) -> _MappedTable:
+        return _MappedTable(self, ('z',))
+
+    def _lookup_roles(self, zone: str, user: str) -> FrozenSet[str]:
+        return self.get(('r', zone, user)) or frozenset()
+
+
+class SnapshotDirectory:
+    """Directory holding the shared snapshots, the ``CURRENT`` pointer and the loader lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock_file = None
+        self._published = 0
+
+    @property
+    def leader(self) -> bool:
+        return self._lock_file is not None
+
+    def try_lead(self) -> bool:
+        """Become the loader unless another process already is."""
+
+        if self._lock_file is not None:
+            return True
+
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, LOCK), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release(self) -> None:
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def current(self) -> Optional[str]:
+        """Name of the snapshot to map, None when the loader has not published one."""
+
+        try:
+            with open(os.path.join(self.path, CURRENT)) as current:
+                return current.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def publish(
+        self, matrix: PermissionMatrix, version: Optional[int], loaded_at: float, rules: int, groupings: int
+    ) -> str:
+        """Write a new snapshot, point ``CURRENT`` at it and return its name."""
+
+        self._published += 1
+        tag = 'unversioned' if version is None else version
+        name = f'policy-{tag}-{int(loaded_at * 1000)}-{os.getpid()}-{self._published}.snap'
+        write_snapshot(os.path.join(self.path, name), matrix, version, loaded_at, rules, groupings)
+        _write_atomic(os.path.join(self.path, CURRENT), name.encode())
+
+        snapshots = sorted(
+            (entry for entry in os.scandir(self.path) if entry.name.endswith('.snap') and entry.name != name),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        # workers that mapped an older snapshot keep their pages after the unlink
+        for entry in snapshots[:-_KEEP]:
+            os.unlink(entry.path)
+        return name
+
+    def withdraw(self) -> None:
+        """Tell the workers to read the database themselves."""
+
+        try:
+            os.unlink(os.path.join(self.path, CURRENT))
+        except FileNotFoundError:
+            pass
+
+    def open(self, name: str) -> MappedPermissionMatrix:
+        return MappedPermissionMatrix(os.path.join(self.path, name))
@@ -34,7 +34,7 @@ from models.user_account_management import UserADGroupOperationsPUT, \
 
 from module_keycloak.ops_admin import OperationsAdmin
 
-from services.data_providers.ldap_client import LdapClient
+from services.data_providers.ldap_client import AsyncLdapClient
 from services.data_providers.neo4j_client import Neo4jClient
 
 from common.services.logger_services.logger_factory_service import SrvLoggerFactory
@@ -71,18 +71,18 @@ class UserADGroupOperations:
             group_code = data.group_code
             user_email = data.user_email
            
-            ldap_cli = LdapClient()
+            ldap_cli = AsyncLdapClient()
             # kc_cli = OperationsAdmin(realm)
-            ldap_cli.connect(group_code)
-            ldap_users_gotten = ldap_cli.get_user_by_email(user_email)
+            await ldap_cli.connect(group_code)
+            ldap_users_gotten = await ldap_cli.get_user_by_email(user_email)
             user_dn = ldap_users_gotten[0]
             # user_entry = ldap_users_gotten[1]
             # operate on groups
             if operation_type == "remove":
-                remove_result = ldap_cli.remove_user_from_group(user_dn)
+                remove_result = await ldap_cli.remove_user_from_group(user_dn)
             if operation_type == "add":
-                add_result = ldap_cli.add_user_to_group(user_dn)
-            ldap_cli.disconnect()
+                add_result = await ldap_cli.add_user_to_group(user_dn)
+            await ldap_cli.disconnect()
 
             res.result = {"message": "Succeed."}
             res.code = EAPIResponseCode.success
@@ -155,8 +155,8 @@ class UserManagementV1:
             kc_cli = OperationsAdmin(realm)
 
             # get user information
-            respon_user_information = neo4j_client.get_user_by_geid(user_geid) if user_geid \
-                else neo4j_client.get_user_by_email(user_email)
+            respon_user_information = await neo4j_client.get_user_by_geid(user_geid) if user_geid \
+                else await neo4j_client.get_user_by_email(user_email)
             if respon_user_information['code'] == 404:
                 res.error_msg = 'User not found'
                 res.code = EAPIResponseCode.bad_request
@@ -173,7 +173,7 @@ class UserManagementV1:
                 return res.json_response()
 
             # Fetch all datasets that connected to the user
-            respon_linked_projects = neo4j_client.get_user_linked_projects(
+            respon_linked_projects = await neo4j_client.get_user_linked_projects(
                 user_data['id'])
             linked_projects = []
             if respon_linked_projects.status_code == 200:
@@ -203,11 +203,11 @@ class UserManagementV1:
                         pass
                     elif operation_type == "restore":
                         if project["relation_status"] != "active":
-                            on_project_restore(
+                            await on_project_restore(
                                 user_data['email'], project, kc_cli, access_token)
                     elif operation_type == "disable":
                         if project["relation_status"] == "active":
-                            on_project_disable(
+                            await on_project_disable(
                                 user_data['email'], project, kc_cli, access_token)
             except Exception as e:
                 res.error_msg = "relation update error: " + str(e)
@@ -217,19 +217,19 @@ class UserManagementV1:
             # extra operations
             try:
                 if operation_type == "disable":
-                    remove_from_user_group(user_data['email'], kc_cli, access_token)
+                    await remove_from_user_group(user_data['email'], kc_cli, access_token)
                 if operation_type == "enable":
-                    enable_from_user_group(user_data['email'], kc_cli, access_token)
+                    await enable_from_user_group(user_data['email'], kc_cli, access_token)
             except Exception as e:
                 return {"error_message": "remove/enable from users group error: " + str(e)}, 500
 
             # update user status in neo4j
             user_data['status'] = user_status
-            neo4j_client.update_user(user_data['id'], user_data)
+            await neo4j_client.update_user(user_data['id'], user_data)
 
             # update neo4j relations
             for project in linked_projects:
-                neo4j_client.update_relation(
+                await neo4j_client.update_relation(
                     user_data['id'], project['neo4j_id'], project['relation_name'], {'status': user_relationship_status}
                 )
 
@@ -247,61 +247,61 @@ class UserManagementV1:
         return res.json_response()
 
 
-def on_project_disable(email, project, kc_cli, access_token):
+async def on_project_disable(email, project, kc_cli, access_token):
     ldap_user_grouppen = ConfigSettings.LDAP_USER_GROUP
     # ldap
-    ldap_cli = LdapClient()
-    ldap_cli.connect(project['project_code'])
-    ldap_users_gotten = ldap_cli.get_user_by_email(email)
+    ldap_cli = AsyncLdapClient()
+    await ldap_cli.connect(project['project_code'])
+    ldap_users_gotten = await ldap_cli.get_user_by_email(email)
     user_dn = ldap_users_gotten[0]
     user_entry = ldap_users_gotten[1]
     _logger.info("removed project code: " + project['project_code'])
     _logger.info("removed user from group: " + user_dn)
-    remove_result = ldap_cli.remove_user_from_group(user_dn)
-    ldap_cli.disconnect()
+    remove_result = await ldap_cli.remove_user_from_group(user_dn)
+    await ldap_cli.disconnect()
 
 
-def on_project_enable(email, project, kc_cli, access_token):
+async def on_project_enable(email, project, kc_cli, access_token):
     pass
 
 
-def on_project_restore(email, project, kc_cli, access_token):
+async def on_project_restore(email, project, kc_cli, access_token):
     # update user in ad and keyclock
-    user_keyclock = kc_cli.get_user_by_email(email)
+    user_keyclock = await kc_cli.get_user_by_email(email)
     userid = user_keyclock['id']
     # keyclock
-    keyclock_res = kc_cli.assign_user_role(userid, project["ad_role"])
+    keyclock_res = await kc_cli.assign_user_role(userid, project["ad_role"])
     # ldap
-    ldap_cli = LdapClient()
-    ldap_cli.connect(project['project_code'])
-    ldap_users_gotten = ldap_cli.get_user_by_email(email)
+    ldap_cli = AsyncLdapClient()
+    await ldap_cli.connect(project['project_code'])
+    ldap_users_gotten = await ldap_cli.get_user_by_email(email)
     user_dn = ldap_users_gotten[0]
     user_entry = ldap_users_gotten[1]
-    result = ldap_cli.add_user_to_group(user_dn)
-    ldap_cli.disconnect()
+    result = await ldap_cli.add_user_to_group(user_dn)
+    await ldap_cli.disconnect()
 
 
-def remove_from_user_group(email, kc_cli, access_token):
+async def remove_from_user_group(email, kc_cli, access_token):
     # ldap user grouppen
-    ldap_cli = LdapClient()
-    ldap_cli.connect(ConfigSettings.LDAP_USER_GROUP)
-    ldap_users_gotten = ldap_cli.get_user_by_email(email)
+    ldap_cli = AsyncLdapClient()
+    await ldap_cli.connect(ConfigSettings.LDAP_USER_GROUP)
+    ldap_users_gotten = await ldap_cli.get_user_by_email(email)
     user_dn = ldap_users_gotten[0]
     user_entry = ldap_users_gotten[1]
     _logger.info("removed user dn: " + user_dn)
-    remove_result = ldap_cli.remove_user_from_group(user_dn)
-    ldap_cli.disconnect()
+    remove_result = await ldap_cli.remove_user_from_group(user_dn)
+    await ldap_cli.disconnect()
 
 
-def enable_from_user_group(email, kc_cli, access_token):
+async def enable_from_user_group(email, kc_cli, access_token):
     # ldap user grouppen
-    ldap_cli = LdapClient()
-    ldap_cli.connect(ConfigSettings.LDAP_USER_GROUP)
-    ldap_users_gotten = ldap_cli.get_user_by_email(email)
+    ldap_cli = AsyncLdapClient()
+    await ldap_cli.connect(ConfigSettings.LDAP_USER_GROUP)
+    ldap_users_gotten = await ldap_cli.get_user_by_email(email)
     user_dn = ldap_users_gotten[0]
     user_entry = ldap_users_gotten[1]
-    result = ldap_cli.add_user_to_group(user_dn)
-    ldap_cli.disconnect()
+    result = await ldap_cli.add_user_to_group(user_dn)
+    await ldap_cli.disconnect()
 
 
 def validate_operation_type(current_user_status, operation_type):